@@ -0,0 +1,954 @@
+"""
+Замеры производительности узких мест загрузки остатков.
+
+Запуск:
+    python benchmark.py insert --rows 5000000
+    python benchmark.py insert --rows 5000000 --table remnants_of_products_bench
+    python benchmark.py parse --rows 2000000
+    python benchmark.py replace --days 30 --rows 200000
+    python benchmark.py upsert --rows 1000000
+    python benchmark.py upsert --rows 1000000 --table inventory_balance_bench
+    python benchmark.py copy --rows 5000000
+    python benchmark.py fetch --rows 1000000
+    python benchmark.py read --rows 5000000
+    python benchmark.py read --table remnants_of_products --limit 10000000
+    python benchmark.py dtypes --rows 1000000
+    python benchmark.py preagg --rows 1000000 --products 2000
+    python benchmark.py pipeline --days 3 --rows 200000 --save before.json
+    python benchmark.py pipeline --days 3 --rows 200000 --pre-aggregate --compare before.json
+
+Без --table меряется только подготовка данных на клиенте (то, что делается до отправки
+в сокет). С --table данные реально вставляются в указанную таблицу ClickHouse
+(подключение берётся из .env, таблица должна иметь схему remnants_of_products).
+replace работает только с ClickHouse (локальный сервер из .env) и создаёт там таблицу remnants_bench.
+upsert с --table создаёт (пересоздаёт) указанную таблицу в PostgreSQL из .env.
+dtypes и preagg не ходят в базы: файл выгрузки и справочники синтетические, вставка в ClickHouse подменяется.
+pipeline запускает WorkForData целиком на синтетических выгрузках обоих форматов и справочниках spr_*:
+PostgreSQL и ClickHouse заменены заглушками в памяти процесса (MemoryPostConn, MemoryClickHouseClient),
+с --local-db - настоящие локальные серверы из .env (справочники по-прежнему синтетические в памяти,
+остатки пишутся в remnants_bench и inventory_balance_bench). Для сравнения запусков - --save и --compare.
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from metrics import max_rss_bytes
+
+
+def max_rss_mb():
+    """Пиковый RSS текущего процесса в МБ (на Windows - 0)"""
+    return max_rss_bytes() / 1024 ** 2
+
+
+def synthetic_remnants(rows, seed=42):
+    """DataFrame в том виде, в каком WorkForData.__data_to_DB отдаёт его в remnants_of_products"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "id_product": pd.array(rng.integers(1, 200_000, rows), dtype="UInt64"),
+            "id_store": pd.array(rng.integers(1, 3_000, rows), dtype="Int64"),
+            "inn": pd.array(rng.integers(10**9, 10**10, rows), dtype="Int64"),
+            "order_date": pd.Timestamp("2025-03-01"),
+        }
+    )
+    # Примерно половина остатков нулевые, как в реальных выгрузках
+    for column in ["opening_balance", "opening_balance_price", "final_balance_price", "final_balance"]:
+        values = rng.uniform(0, 1000, rows).round(3)
+        values[rng.random(rows) < 0.5] = 0
+        df[column] = values
+    # Часть ИНН не нашлась в справочнике
+    df.loc[rng.random(rows) < 0.01, "inn"] = pd.NA
+    return df
+
+
+def _run_insert_case(mode, rows, table):
+    from click_house_connect import ClickHouseConnection
+
+    df = synthetic_remnants(rows)
+    rss_before = max_rss_mb()
+    start = time.perf_counter()
+    if table:
+        click = ClickHouseConnection()
+        if mode == "columnar":
+            click.clickhouse_insert_columnar(table, df)
+        else:
+            click.clickhouse_insert(table, df)
+        click.close()
+    elif mode == "columnar":
+        ClickHouseConnection.columnar_data(df)
+    else:
+        # Повторяем подготовку из ClickHouseConnection.clickhouse_insert
+        for column in df.columns:
+            df[column] = df[column].replace({0: np.nan})
+            df[column] = df[column].replace(
+                {"None": None, "nan": None, "<NA>": None, "NaT": None, "NaN": None, np.nan: None}
+            )
+        df.to_dict(orient="records")
+    return time.perf_counter() - start, max_rss_mb() - rss_before
+
+
+def bench_insert(args):
+    print(f"Синтетический remnants_of_products: {args.rows} строк")
+    for mode in ["rows", "columnar"]:
+        # Каждый вариант в отдельном процессе, чтобы пиковый RSS не смешивался
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            seconds, rss = executor.submit(_run_insert_case, mode, args.rows, args.table).result()
+        print(f"{mode:>9}: {seconds:8.2f} с, прирост пикового RSS {rss:8.1f} МБ")
+
+
+BENCH_TABLE_DDL = """
+CREATE TABLE {name}
+(
+    id_product UInt64,
+    id_store Nullable(Int64),
+    inn Nullable(Int64),
+    order_date DateTime,
+    opening_balance Nullable(Float64),
+    opening_balance_price Nullable(Float64),
+    final_balance_price Nullable(Float64),
+    final_balance Nullable(Float64)
+)
+ENGINE = MergeTree
+PARTITION BY toYYYYMM(order_date)
+ORDER BY (order_date, id_store, id_product)
+"""
+
+
+def bench_replace(args):
+    from click_house_connect import ClickHouseConnection
+
+    click = ClickHouseConnection()
+    table, staging = "remnants_bench", "remnants_bench_staging"
+    days = pd.date_range("2025-03-01", periods=args.days, freq="D")
+    frames = []
+    for day in days:
+        df = synthetic_remnants(args.rows, seed=day.day)
+        df["order_date"] = day
+        frames.append(df)
+
+    def pending_mutations():
+        query = f"SELECT count() FROM system.mutations WHERE table = '{table}' AND database = currentDatabase() AND NOT is_done"
+        return click.clickhouse_to_scalar(query)
+
+    for mode in ["delete", "partition"]:
+        click.execute(f"DROP TABLE IF EXISTS {table}")
+        click.execute(f"DROP TABLE IF EXISTS {staging}")
+        click.execute(BENCH_TABLE_DDL.format(name=table))
+        # Исходное состояние: данные за все дни уже загружены, запуск их перезаливает
+        for df in frames:
+            click.clickhouse_insert_columnar(table, df)
+        start = time.perf_counter()
+        if mode == "delete":
+            for day, df in zip(days, frames):
+                click.clickhouse_del_date_on_insert(table, day.date(), day.date(), "", df, columnar=True)
+        else:
+            click.clickhouse_prepare_staging(table, staging)
+            for df in frames:
+                click.clickhouse_insert_columnar(staging, df)
+            click.clickhouse_replace_partitions(table, staging, {day.date() for day in days})
+        # Мутации ALTER ... DELETE выполняются в фоне - ждём, пока сервер их доделает
+        while pending_mutations():
+            time.sleep(0.5)
+        seconds = time.perf_counter() - start
+        rows = click.clickhouse_to_scalar(f"SELECT count() FROM {table}")
+        mutations = click.clickhouse_to_scalar(
+            f"SELECT count() FROM system.mutations WHERE table = '{table}' AND database = currentDatabase()"
+        )
+        print(f"{mode:>9}: {seconds:8.2f} с, мутаций {mutations}, строк в таблице {rows}")
+    click.execute(f"DROP TABLE IF EXISTS {table}")
+    click.execute(f"DROP TABLE IF EXISTS {staging}")
+    click.close()
+
+
+def _upsert_frame(rows):
+    """Данные для public.inventory_balance: ключ без повторов, как после группировки в __data_to_DB"""
+    df = synthetic_remnants(rows)
+    return df.drop_duplicates(["id_store", "id_product", "order_date", "inn"], ignore_index=True)
+
+
+def _run_upsert_case(method, rows):
+    # Без сервера меряем то, что делается на клиенте до отправки данных
+    from io import StringIO
+
+    from psycopg2.extensions import adapt
+
+    from postgress_connect import PostConn
+
+    df = _upsert_frame(rows)
+    rss_before = max_rss_mb()
+    start = time.perf_counter()
+    if method == "copy":
+        PostConn.csv_frame(df).to_csv(StringIO(), index=False, header=False)
+    else:
+        # Кортежи, как в psycopg2_upsert, и экранирование каждого значения, как в execute_values
+        values = [tuple(row) for row in df.astype(object).where(df.notna(), None).to_numpy()]
+        b",".join(b"(" + b",".join(adapt(value).getquoted() for value in row) + b")" for row in values)
+    return time.perf_counter() - start, max_rss_mb() - rss_before
+
+
+BENCH_UPSERT_DDL = """
+CREATE TABLE {name}
+(
+    id_product BIGINT,
+    id_store BIGINT,
+    inn BIGINT,
+    order_date DATE,
+    opening_balance NUMERIC,
+    initial_balance_price NUMERIC,
+    final_balance_price NUMERIC,
+    final_balance NUMERIC,
+    UNIQUE (id_store, id_product, order_date, inn)
+)
+"""
+
+
+def bench_upsert(args):
+    print(f"UPSERT в PostgreSQL: {args.rows} строк")
+    if not args.table:
+        for method in ["values", "copy"]:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                seconds, rss = executor.submit(_run_upsert_case, method, args.rows).result()
+            print(f"{method:>7}: подготовка {seconds:8.2f} с, прирост пикового RSS {rss:8.1f} МБ")
+        return
+
+    from postgress_connect import PostConn
+
+    df = _upsert_frame(args.rows)
+    conn = PostConn()
+    for method in ["values", "copy"]:
+        with conn.conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {args.table}")
+            cursor.execute(BENCH_UPSERT_DDL.format(name=args.table))
+        conn.conn.commit()
+        # Первый проход - вставка в пустую таблицу, второй - обновление всех строк по ключу
+        timings = []
+        for _ in range(2):
+            start = time.perf_counter()
+            conn.psycopg2_upsert(df.copy(), table_name=args.table, method=method)
+            timings.append(time.perf_counter() - start)
+        count = conn.fetch_to_dataframe(f"SELECT count(*) FROM {args.table}").iloc[0, 0]
+        print(f"{method:>7}: вставка {timings[0]:8.2f} с, обновление {timings[1]:8.2f} с, строк в таблице {count}")
+    with conn.conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {args.table}")
+    conn.conn.commit()
+    conn.close()
+
+
+def _run_copy_case(mode, rows):
+    # Поток COPY вычитывается так же, как это делает cursor.copy_expert, только без сервера
+    from io import StringIO
+
+    from postgress_connect import CopyStream, PostConn, binary_chunks, csv_chunks
+
+    df = synthetic_remnants(rows)
+    rss_before = max_rss_mb()
+    start = time.perf_counter()
+    if mode == "stringio":
+        # Прежний dataframe_to_db(method="copy"): весь CSV в одном буфере
+        buffer = StringIO()
+        df.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        stream = buffer
+    elif mode == "csv":
+        stream = CopyStream(csv_chunks(df))
+    else:
+        stream = CopyStream(binary_chunks(df))
+    sent = 0
+    while True:
+        block = stream.read(PostConn.COPY_READ_SIZE)
+        if not block:
+            break
+        sent += len(block)
+    return time.perf_counter() - start, max_rss_mb() - rss_before, sent
+
+
+def bench_copy(args):
+    print(f"Подготовка потока COPY для PostConn.dataframe_to_db: {args.rows} строк")
+    for mode in ["stringio", "csv", "binary"]:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            seconds, rss, sent = executor.submit(_run_copy_case, mode, args.rows).result()
+        print(f"{mode:>9}: {seconds:8.2f} с, прирост пикового RSS {rss:8.1f} МБ, отправлено {sent / 1024 ** 2:8.1f} МБ")
+
+
+class FakeProductCursor:
+    """Курсор с результатом SELECT id_product_code, id_product FROM spr_product, без сервера"""
+
+    description = [("id_product_code",), ("id_product",)]
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.position = 0
+
+    def __row(self, index):
+        return f"00-{index:08d}", index
+
+    def fetchall(self):
+        return [self.__row(index) for index in range(self.rows)]
+
+    def fetchmany(self, size):
+        end = min(self.position + size, self.rows)
+        rows = [self.__row(index) for index in range(self.position, end)]
+        self.position = end
+        return rows
+
+
+def _run_fetch_case(mode, rows):
+    from postgress_connect import concat_frames, cursor_frames
+    from work_data_itog import WorkForData
+
+    rss_before = max_rss_mb()
+    start = time.perf_counter()
+    cursor = FakeProductCursor(rows)
+    if mode == "fetchall":
+        # Прежний fetch_to_dataframe: весь список кортежей, затем DataFrame
+        df = pd.DataFrame(cursor.fetchall(), columns=[desc[0] for desc in cursor.description])
+    else:
+        df = concat_frames(cursor_frames(cursor, WorkForData.REFERENCE_FETCH_ROWS, WorkForData.REFERENCE_DTYPES))
+    memory = df.memory_usage(deep=True).sum() / 1024 ** 2
+    return time.perf_counter() - start, max_rss_mb() - rss_before, memory
+
+
+def bench_fetch(args):
+    print(f"Загрузка справочника spr_product в DataFrame: {args.rows} строк")
+    for mode in ["fetchall", "chunks"]:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            seconds, rss, memory = executor.submit(_run_fetch_case, mode, args.rows).result()
+        print(f"{mode:>9}: {seconds:8.2f} с, прирост пикового RSS {rss:8.1f} МБ, DataFrame {memory:8.1f} МБ")
+
+
+def _run_read_case(mode, rows, table, limit):
+    from click_house_connect import ClickHouseConnection
+
+    rss_before = max_rss_mb()
+    start = time.perf_counter()
+    read = 0
+    if table:
+        click = ClickHouseConnection()
+        query = f"SELECT * FROM {table} LIMIT {limit}"
+        if mode == "iter":
+            for chunk in click.execute_iter_df(query):
+                read += len(chunk)
+        else:
+            read = len(click.execute_df(query, columnar=mode == "columnar"))
+        click.close()
+    else:
+        # Без сервера: то, что делает клиент с уже полученными данными
+        df = synthetic_remnants(rows)
+        rss_before = max_rss_mb()
+        start = time.perf_counter()
+        if mode == "columnar":
+            columns = {column: df[column].to_numpy() for column in df.columns}
+            read = len(pd.DataFrame(columns, columns=list(columns)))
+        else:
+            # Драйвер отдаёт строки кортежами: execute_df - все сразу, execute_iter_df - кусками
+            chunk_size = 100_000 if mode == "iter" else len(df)
+            for begin in range(0, len(df), chunk_size):
+                tuples = list(df.iloc[begin:begin + chunk_size].itertuples(index=False, name=None))
+                read += len(pd.DataFrame(tuples, columns=list(df.columns)))
+    return time.perf_counter() - start, max_rss_mb() - rss_before, read
+
+
+def bench_read(args):
+    source = args.table or "синтетические данные"
+    print(f"Чтение из ClickHouse ({source}): execute_df построчно, колонками и потоком execute_iter_df")
+    for mode in ["rows", "columnar", "iter"]:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            seconds, rss, read = executor.submit(_run_read_case, mode, args.rows, args.table, args.limit).result()
+        print(f"{mode:>9}: {seconds:8.2f} с, прирост пикового RSS {rss:8.1f} МБ, строк {read}")
+
+
+def ru_number(value):
+    """Число в том виде, как его пишет 1С: '1 234,567' с неразрывным пробелом"""
+    return f"{value:,.3f}".replace(",", "\xa0").replace(".", ",")
+
+
+def bench_parse(args):
+    from work_data_itog import ru_number_to_float
+
+    rng = np.random.default_rng(42)
+    prices = rng.uniform(0, 5000, args.rows).round(3)
+    prices[rng.random(args.rows) < 0.5] = 0
+    columns = {
+        "себестоимость": pd.Series([ru_number(v) for v in prices], dtype=object),
+        "количество": pd.Series([ru_number(v) for v in rng.integers(0, 20, args.rows) * 1.0], dtype=object),
+    }
+
+    def replace_chain(column):
+        # Прежняя реализация WorkForData.__column_to_float
+        column = column.str.replace("\xa0", "").str.replace(" ", "").str.replace(",", ".")
+        return pd.to_numeric(column, errors="coerce")
+
+    print(f"Разбор чисел формата '1 234,567': {args.rows} строк")
+    for name, column in columns.items():
+        timings = {}
+        for parser in [replace_chain, ru_number_to_float]:
+            start = time.perf_counter()
+            result = parser(column)
+            timings[parser.__name__] = time.perf_counter() - start
+        pd.testing.assert_series_equal(replace_chain(column), result)
+        speedup = timings["replace_chain"] / timings["ru_number_to_float"]
+        print(
+            f"{name:>14}: replace x3 + to_numeric {timings['replace_chain']:6.2f} с, "
+            f"ru_number_to_float {timings['ru_number_to_float']:6.2f} с (x{speedup:.1f})"
+        )
+
+
+def write_export(path, rows, seed=42, products=30_000, old=False):
+    """
+    Синтетическая выгрузка остатков (8 строк шапки, числа с неразрывным пробелом, строка Итог в конце).
+    old=True - старый формат (Номенклатура, Код, Магазин.Номер магазина, По дням).
+    Чем меньше products, тем чаще повторяются пары "товар + магазин".
+    """
+    rng = np.random.default_rng(seed)
+    stores = rng.integers(0, 500, rows)
+    codes = [f"00-{i:08d}" for i in rng.integers(1, products, rows)]
+    costs = rng.uniform(0, 5000, rows).round(3)
+    costs[rng.random(rows) < 0.5] = 0
+    columns = {
+        "Организация": [f"ООО Организация {i}" for i in stores % 20],
+        "Магазин": [f"Магазин {i}" for i in stores],
+        "Номер магазина": stores,
+    }
+    if old:
+        columns.update(
+            {
+                "Номенклатура": [f"Товар {code}" for code in codes],
+                "Код": codes,
+                "Магазин.Номер магазина": stores,
+                "По дням": os.path.basename(path).rsplit(".", 1)[0],
+            }
+        )
+    else:
+        columns["Номенклатура.Код"] = codes
+    columns.update(
+        {
+            "Начальный остаток": [ru_number(v) for v in rng.integers(0, 20, rows) * 1.0],
+            "Начальный остаток себестоимость": [ru_number(v) for v in costs],
+            "Конечный остаток": [ru_number(v) for v in rng.integers(0, 20, rows) * 1.0],
+            "Конечный остаток себестоимость": [ru_number(v) for v in costs[::-1]],
+        }
+    )
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("Остатки товаров\n" * 8)
+        pd.DataFrame(columns).to_csv(file, sep="\t", header=False, index=False)
+        # В старом формате у строки Итог пустая Номенклатура - по ней её и отбрасываем
+        file.write("Итог" + "\t" * (len(columns) - 4) + "\t".join(["0"] * 4) + "\n")
+
+
+def synthetic_reference(products=30_000):
+    """
+    Справочники (store, store_channel, product, inn) под write_export.
+    Примерно 1/30 кодов товаров выгрузки в справочнике нет - как товары, ещё не заведённые в spr_product.
+    """
+    known = products - products // 30
+    store = pd.DataFrame({"search_store": [f"Магазин {i}" for i in range(500)], "id_store_rename": np.arange(1, 501)})
+    store_channel = pd.DataFrame({"id_store": np.arange(1, 501), "channel": ["ФРС", "Розница"] * 250})
+    product = pd.DataFrame(
+        {"id_product_code": [f"00-{i:08d}" for i in range(1, known)], "id_product": np.arange(1, known)}
+    )
+    inn = pd.DataFrame({"search_entity": [f"ООО Организация {i}" for i in range(20)], "inn": 7700000000 + np.arange(20)})
+    return store, store_channel, product, inn
+
+
+class CaptureClickHouse:
+    """Вместо вставки в ClickHouse запоминает итоговый DataFrame"""
+
+    def __init__(self):
+        self.df = None
+
+    def clickhouse_del_date_on_insert(self, df, **kwargs):
+        self.df = df
+
+
+def _process_export(path, **settings):
+    """Весь путь файла (чтение -> разбор -> id -> агрегация) без баз; возвращает то, что ушло бы в ClickHouse"""
+    from work_data_itog import WorkForData
+
+    work = WorkForData(
+        reference=synthetic_reference(),
+        path_to_directory=os.path.dirname(path),
+        ledger_path=os.path.join(os.path.dirname(path), "ledger.sqlite3"),
+        **settings,
+    )
+    work.click_house = CaptureClickHouse()
+    work.process_file(os.path.basename(path))
+    work.ledger.forget(os.path.basename(path))
+    return work.click_house.df
+
+
+def _run_dtypes_case(mode, path):
+    from work_data_itog import WorkForData
+
+    rss_before = max_rss_mb()
+    start = time.perf_counter()
+    if mode == "full":
+        # Весь путь обработки файла (типы по стадиям проверяет tests/test_dtypes.py)
+        df = _process_export(path)
+    else:
+        options = {"sep": "\t", "skiprows": 8, "names": WorkForData.NEW_FILE_COLUMNS, "encoding": "utf-8"}
+        if mode == "schema":
+            options["usecols"] = [c for c in WorkForData.NEW_FILE_COLUMNS if c not in WorkForData.SKIP_COLUMNS]
+            options["dtype"] = {c: WorkForData.READ_DTYPES[c] for c in options["usecols"]}
+        df = pd.read_csv(path, **options)
+    memory = df.memory_usage(deep=True).sum() / 1024 ** 2
+    return time.perf_counter() - start, max_rss_mb() - rss_before, memory, len(df)
+
+
+def bench_dtypes(args):
+    print(f"Схема типов выгрузки (WorkForData.READ_DTYPES): {args.rows} строк")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "01.03.2025.txt")
+        write_export(path, args.rows)
+        cases = {
+            "default": "чтение без схемы (object)",
+            "schema": "чтение по READ_DTYPES",
+            "full": "обработка файла целиком",
+        }
+        for mode, title in cases.items():
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                seconds, rss, memory, rows = executor.submit(_run_dtypes_case, mode, path).result()
+            print(
+                f"{title:>32}: {seconds:6.2f} с, прирост пикового RSS {rss:8.1f} МБ, "
+                f"DataFrame {memory:8.1f} МБ, строк {rows}"
+            )
+
+
+def _run_preagg_case(pre_aggregate, path):
+    rss_before = max_rss_mb()
+    start = time.perf_counter()
+    df = _process_export(path, pre_aggregate=pre_aggregate)
+    return time.perf_counter() - start, max_rss_mb() - rss_before, df
+
+
+def bench_preagg(args):
+    print(f"Предварительная группировка по исходным ключам: {args.rows} строк, {args.products} товаров")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "01.03.2025.txt")
+        write_export(path, args.rows, products=args.products)
+        results = {}
+        for pre_aggregate in [False, True]:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results[pre_aggregate] = executor.submit(_run_preagg_case, pre_aggregate, path).result()
+    pd.testing.assert_frame_equal(
+        results[False][2].sort_values(["id_product", "id_store", "inn"], ignore_index=True),
+        results[True][2].sort_values(["id_product", "id_store", "inn"], ignore_index=True),
+    )
+    for pre_aggregate, (seconds, rss, df) in results.items():
+        title = "pre_aggregate=True" if pre_aggregate else "pre_aggregate=False"
+        print(f"{title:>20}: {seconds:6.2f} с, прирост пикового RSS {rss:8.1f} МБ, итоговых строк {len(df)}")
+    print(f"Выигрыш по времени на файл: {results[False][0] - results[True][0]:.2f} с")
+
+
+
+class MemoryClickHouseClient:
+    """
+    Клиент clickhouse_driver без сервера для ClickHouseConnection.create_connection.
+    Данные вставки уже подготовлены ClickHouseConnection (колонки numpy или список словарей) -
+    клиент только считает строки по таблицам и ждёт latency секунд на запрос, как на сеть.
+    Удаления не выполняются: в rows - сколько строк было вставлено.
+    """
+
+    class Transport:
+        connected = False
+
+    def __init__(self, server):
+        self.server = server
+        self.connection = self.Transport()
+
+    def execute(self, query, params=None, with_column_types=False, columnar=False, settings=None):
+        time.sleep(self.server["latency"])
+        words = query.split()
+        command = words[0].upper()
+        result = []
+        with self.server["lock"]:
+            rows = self.server["rows"]
+            if command == "INSERT" and params is not None:
+                inserted = len(params[0]) if columnar and len(params) else len(params)
+                rows[words[2]] = rows.get(words[2], 0) + inserted
+                return inserted
+            if command == "TRUNCATE":
+                rows[words[2]] = 0
+            elif command == "SELECT" and "_partition_id" in query:
+                # Партиции staging: достаточно одной, если там есть строки
+                result = [("all",)] if rows.get(words[-1], 0) else []
+            elif command == "ALTER" and "REPLACE PARTITION" in query:
+                staging = words[-1]
+                rows[words[2]] = rows.get(words[2], 0) + rows.get(staging, 0)
+        return (result, [("result", "String")]) if with_column_types else result
+
+    def disconnect(self):
+        pass
+
+
+def memory_click_house(latency=0.0):
+    """ClickHouseConnection процесса, у которой подключения - MemoryClickHouseClient (пул и подготовка данных - настоящие)"""
+    import threading
+
+    from click_house_connect import ClickHouseConnection
+
+    click = ClickHouseConnection()
+    click.memory_server = {"latency": latency, "lock": threading.Lock(), "rows": {}}
+    click.create_connection = lambda use_numpy=False: MemoryClickHouseClient(click.memory_server)
+    return click
+
+
+class MemoryCursor:
+    """Курсор с готовым результатом SELECT (строки - кортежи), для cursor_frames"""
+
+    def __init__(self, df):
+        self.description = [(column,) for column in df.columns]
+        self.rows = list(df.itertuples(index=False, name=None))
+        self.position = 0
+
+    def fetchmany(self, size):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+
+class MemoryPostConn:
+    """
+    PostConn без сервера: справочники spr_* - синтетические таблицы из tables, результат
+    собирается теми же cursor_frames/concat_frames, что и у серверного курсора.
+    psycopg2_upsert готовит данные на клиенте (COPY - CSV кусками, values - кортежи строк) и не отправляет их.
+    """
+
+    tables = {}
+    latency = 0.0
+    upserted = 0
+
+    def __init__(self, db="test", pooled=False):
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @classmethod
+    def close_pool(cls):
+        pass
+
+    def fetch_to_dataframe(self, query, params=None, chunk_size=None, dtypes=None):
+        from postgress_connect import concat_frames, cursor_frames
+
+        time.sleep(self.latency)
+        table = query.split()[-1]
+        columns = [column.strip() for column in query.split("SELECT", 1)[1].split("FROM", 1)[0].split(",")]
+        cursor = MemoryCursor(self.tables[table][columns])
+        return concat_frames(cursor_frames(cursor, chunk_size or len(cursor.rows) or 1, dtypes))
+
+    def psycopg2_upsert(self, df, table_name="public.inventory_balance", method="values"):
+        from postgress_connect import PostConn, csv_chunks
+
+        time.sleep(self.latency)
+        if method == "copy":
+            for _ in csv_chunks(PostConn.csv_frame(df)):
+                pass
+        else:
+            list(df.itertuples(index=False, name=None))
+        MemoryPostConn.upserted += len(df)
+
+
+class LocalPostConn(MemoryPostConn):
+    """
+    Для pipeline --local-db: справочники spr_* - синтетические из памяти (под синтетические выгрузки
+    в настоящей базе их нет), UPSERT остатков - в настоящий PostgreSQL из .env, в таблицу table.
+    """
+
+    table = "inventory_balance_bench"
+
+    def psycopg2_upsert(self, df, table_name="public.inventory_balance", method="values"):
+        from postgress_connect import PostConn
+
+        with PostConn(db=self.db, pooled=True) as conn:
+            conn.psycopg2_upsert(df, table_name=self.table, method=method)
+
+
+# Серверы, на которых pipeline --local-db готов создавать и удалять свои таблицы
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+
+def _check_local_servers(postgres):
+    """pipeline --local-db только для локальных серверов: хосты из .env (CLICK_HOST, для UPSERT - HOST)"""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    hosts = {"CLICK_HOST": os.getenv("CLICK_HOST")}
+    if postgres:
+        hosts["HOST"] = os.getenv("HOST")
+    remote = {name: host for name, host in hosts.items() if host not in LOCAL_HOSTS}
+    if remote:
+        raise SystemExit(f"--local-db работает только с локальными серверами, в .env: {remote}")
+
+
+def _run_pipeline_case(directory, settings, latency, products, local_db):
+    """
+    Полный запуск WorkForData.first_start по папкам directory/files и directory/old_files.
+    Справочники всегда синтетические из MemoryPostConn. Без local_db вставка идёт в MemoryClickHouseClient;
+    с local_db - в настоящий ClickHouse из .env, но в таблицы remnants_bench (как в replace),
+    а UPSERT - в PostgreSQL из .env в inventory_balance_bench; таблицы пересоздаются и удаляются.
+    """
+    import work_data_itog
+    from work_data_itog import WorkForData
+
+    # Файлы ошибок, журнал и хранилища WorkForData пишутся в текущую папку
+    os.chdir(directory)
+    MemoryPostConn.tables = dict(
+        zip(
+            [table for _, table, _ in WorkForData.REFERENCE_TABLES.values()],
+            synthetic_reference(products),
+        )
+    )
+    if local_db:
+        from click_house_connect import ClickHouseConnection
+
+        click = ClickHouseConnection()
+        # Процессы-обработчики (executor="process") получают подмену через fork
+        WorkForData.TABLE_NAME = "remnants_bench"
+        WorkForData.STAGING_TABLE_NAME = "remnants_bench_staging"
+        for table in (WorkForData.TABLE_NAME, WorkForData.STAGING_TABLE_NAME):
+            click.execute(f"DROP TABLE IF EXISTS {table}")
+        click.execute(BENCH_TABLE_DDL.format(name=WorkForData.TABLE_NAME))
+        if settings["postgres_upsert"]:
+            _recreate_postgres_table(LocalPostConn.table)
+        work_data_itog.PostConn = LocalPostConn
+    else:
+        MemoryPostConn.latency = latency
+        work_data_itog.PostConn = MemoryPostConn
+        memory_click_house(latency)
+    rss_before = max_rss_mb()
+    start = time.perf_counter()
+    work = WorkForData(
+        path_to_directory="files",
+        path_to_directory_old="old_files",
+        reference_cache=None,
+        ledger_path="ledger.sqlite3",
+        **settings,
+    )
+    work.first_start()
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "rss_before_mb": rss_before,
+        # С executor="process" пик процессов-обработчиков приходит в пике стадий
+        "peak_rss_mb": max(
+            [max_rss_mb()] + [totals["peak_rss_bytes"] / 1024 ** 2 for totals in work.metrics.stage_totals().values()]
+        ),
+        "bytes_read": work.metrics.value("bytes_read_total"),
+        "files": {status: work.metrics.value("files_total", status=status) for status in ("ok", "error")},
+        "stages": work.metrics.stage_totals(),
+        "db": {
+            f"{system}.{operation}": work.metrics.value("db_seconds_total", system=system, operation=operation)
+            for system, operation in [
+                ("postgres", "SELECT"),
+                ("postgres", "UPSERT"),
+                ("clickhouse", "ALTER"),
+                ("clickhouse", "INSERT"),
+                ("clickhouse", "SELECT"),
+            ]
+        },
+        "inserted": (
+            _drop_local_bench_tables(work.click_house, WorkForData, settings["postgres_upsert"])
+            if local_db
+            else dict(work.click_house.memory_server["rows"])
+        ),
+    }
+
+
+def _recreate_postgres_table(table):
+    from postgress_connect import PostConn
+
+    conn = PostConn()
+    with conn.conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute(BENCH_UPSERT_DDL.format(name=table))
+    conn.conn.commit()
+    conn.close()
+
+
+def _drop_local_bench_tables(click, work_class, postgres_upsert):
+    """Число строк в таблицах замера pipeline --local-db, после чего таблицы удаляются"""
+    inserted = {work_class.TABLE_NAME: click.clickhouse_to_scalar(f"SELECT count() FROM {work_class.TABLE_NAME}")}
+    for table in (work_class.TABLE_NAME, work_class.STAGING_TABLE_NAME):
+        click.execute(f"DROP TABLE IF EXISTS {table}")
+    if postgres_upsert:
+        from postgress_connect import PostConn
+
+        conn = PostConn()
+        inserted[LocalPostConn.table] = int(conn.fetch_to_dataframe(f"SELECT count(*) FROM {LocalPostConn.table}").iloc[0, 0])
+        with conn.conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {LocalPostConn.table}")
+        conn.conn.commit()
+        conn.close()
+    return inserted
+
+
+def _pipeline_report(result, baseline=None):
+    """Таблица по стадиям: время, строки, строк/с, МБ/с (чтение), рост и пик RSS; с baseline - изменение строк/с"""
+    mb_read = result["bytes_read"] / 1024 ** 2
+    header = f"{'стадия':>14} {'с':>8} {'вызовов':>8} {'строк на входе':>15} {'строк/с':>12} {'МБ/с':>8} {'+RSS, МБ':>9} {'пик RSS, МБ':>12}"
+    print(header + ("  к прошлому запуску" if baseline else ""))
+    for stage, totals in result["stages"].items():
+        rows = totals["rows_in"] or totals["rows_out"]
+        speed = rows / totals["seconds"] if totals["seconds"] and rows else None
+        line = (
+            f"{stage:>14} {totals['seconds']:8.2f} {int(totals['calls']):8d} {int(rows):15d} "
+            f"{speed if speed is not None else float('nan'):12,.0f} "
+            f"{mb_read / totals['seconds'] if stage == 'read' and totals['seconds'] else float('nan'):8.1f} "
+            f"{totals['rss_growth_bytes'] / 1024 ** 2:9.1f} {totals['peak_rss_bytes'] / 1024 ** 2:12.1f}"
+        )
+        previous = (baseline or {}).get("stages", {}).get(stage)
+        if previous and speed:
+            previous_rows = previous["rows_in"] or previous["rows_out"]
+            if previous["seconds"] and previous_rows:
+                line += f"  x{speed / (previous_rows / previous['seconds']):.2f}"
+        print(line)
+    read_rows = result["stages"].get("read", {}).get("rows_out", 0)
+    print(
+        f"Итого: {result['seconds']:.2f} с, файлов {int(result['files']['ok'])} (ошибок {int(result['files']['error'])}), "
+        f"строк {int(read_rows)} ({read_rows / result['seconds']:,.0f} строк/с), "
+        f"{mb_read:.1f} МБ ({mb_read / result['seconds']:.1f} МБ/с), пиковый RSS {result['peak_rss_mb']:.1f} МБ"
+        + (f", раньше {baseline['seconds']:.2f} с" if baseline else "")
+    )
+    print("Запросы к БД, с: " + ", ".join(f"{name} {seconds:.2f}" for name, seconds in result["db"].items() if seconds))
+    if result["inserted"]:
+        print(f"Вставлено строк: {result['inserted']}")
+
+
+def bench_pipeline(args):
+    import json
+    import multiprocessing
+
+    if args.local_db:
+        _check_local_servers(postgres=args.postgres_upsert is not None)
+        if args.executor == "process" and multiprocessing.get_start_method() != "fork":
+            # Без fork процессы-обработчики заново импортируют WorkForData и пишут в remnants_of_products
+            raise SystemExit('--local-db с --executor process работает только при запуске процессов через fork')
+
+    settings = {
+        "executor": args.executor,
+        "max_workers": args.workers,
+        "chunk_size": args.chunk_size,
+        "pre_aggregate": args.pre_aggregate,
+        "replace_mode": args.replace_mode,
+        "insert_buffer": args.insert_buffer,
+        "postgres_upsert": args.postgres_upsert,
+        "load_old_files": True,
+    }
+    print(
+        f"Полный запуск WorkForData: {args.days} дней x (новый + старый формат) по {args.rows} строк, "
+        f"{args.products} товаров, {'локальные серверы из .env' if args.local_db else f'БД в памяти, задержка запроса {args.latency} с'}"
+    )
+    print("Настройки: " + ", ".join(f"{key}={value}" for key, value in settings.items()))
+    with tempfile.TemporaryDirectory() as directory:
+        for old, first_date in [(False, "2025-03-01"), (True, "2024-03-01")]:
+            # Журнал обработанных файлов ведётся по имени - у выгрузок старого формата свои даты
+            folder = os.path.join(directory, "old_files" if old else "files")
+            os.makedirs(folder, exist_ok=True)
+            dates = pd.date_range(first_date, periods=args.days).strftime("%d.%m.%Y")
+            for number, date in enumerate(dates):
+                write_export(
+                    os.path.join(folder, f"{date}.txt"),
+                    args.rows,
+                    seed=args.seed + 2 * number + old,
+                    products=args.products,
+                    old=old,
+                )
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(
+                _run_pipeline_case, directory, settings, args.latency, args.products, args.local_db
+            ).result()
+    result["settings"] = {**settings, "days": args.days, "rows": args.rows, "products": args.products, "seed": args.seed}
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+    print()
+    _pipeline_report(result, baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+        print(f"Результат сохранён в {args.save}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    insert = commands.add_parser("insert", help="построчная vs колоночная вставка в ClickHouse")
+    insert.add_argument("--rows", type=int, default=5_000_000)
+    insert.add_argument("--table", default=None, help="таблица ClickHouse для реальной вставки")
+    insert.set_defaults(func=bench_insert)
+
+    parse = commands.add_parser("parse", help="разбор чисел из выгрузок 1С")
+    parse.add_argument("--rows", type=int, default=2_000_000)
+    parse.set_defaults(func=bench_parse)
+
+    replace = commands.add_parser("replace", help="ALTER DELETE на каждый файл vs REPLACE PARTITION на запуск")
+    replace.add_argument("--days", type=int, default=30)
+    replace.add_argument("--rows", type=int, default=200_000)
+    replace.set_defaults(func=bench_replace)
+
+    upsert = commands.add_parser("upsert", help="execute_values vs COPY + INSERT ... ON CONFLICT в PostgreSQL")
+    upsert.add_argument("--rows", type=int, default=1_000_000)
+    upsert.add_argument("--table", default=None, help="таблица PostgreSQL для реальной загрузки")
+    upsert.set_defaults(func=bench_upsert)
+
+    copy = commands.add_parser("copy", help="COPY в PostgreSQL: CSV целиком vs потоком кусками vs BINARY")
+    copy.add_argument("--rows", type=int, default=5_000_000)
+    copy.set_defaults(func=bench_copy)
+
+    fetch = commands.add_parser("fetch", help="fetchall vs серверный курсор кусками для справочников PostgreSQL")
+    fetch.add_argument("--rows", type=int, default=1_000_000)
+    fetch.set_defaults(func=bench_fetch)
+
+    read = commands.add_parser("read", help="чтение из ClickHouse: построчно vs колонками vs потоком")
+    read.add_argument("--rows", type=int, default=5_000_000)
+    read.add_argument("--table", default=None, help="таблица ClickHouse для реального чтения")
+    read.add_argument("--limit", type=int, default=10_000_000)
+    read.set_defaults(func=bench_read)
+
+    dtypes = commands.add_parser("dtypes", help="память и время чтения выгрузки по схеме типов + проверка типов по стадиям")
+    dtypes.add_argument("--rows", type=int, default=1_000_000)
+    dtypes.set_defaults(func=bench_dtypes)
+
+    preagg = commands.add_parser("preagg", help="группировка по исходным ключам до поиска id: без неё и с ней")
+    preagg.add_argument("--rows", type=int, default=1_000_000)
+    preagg.add_argument("--products", type=int, default=2_000, help="число разных товаров в выгрузке")
+    preagg.set_defaults(func=bench_preagg)
+
+    pipeline = commands.add_parser(
+        "pipeline", help="весь путь WorkForData на синтетических выгрузках: пропускная способность и RSS по стадиям"
+    )
+    pipeline.add_argument("--days", type=int, default=3, help="дней выгрузок каждого формата")
+    pipeline.add_argument("--rows", type=int, default=200_000, help="строк в каждой выгрузке")
+    pipeline.add_argument("--products", type=int, default=30_000)
+    pipeline.add_argument("--seed", type=int, default=42)
+    pipeline.add_argument("--executor", default="thread", choices=["thread", "process", "pipeline"])
+    pipeline.add_argument("--workers", type=int, default=1, help="max_workers (1 - стадии не перекрываются)")
+    pipeline.add_argument("--chunk-size", type=int, default=None)
+    pipeline.add_argument("--pre-aggregate", action="store_true")
+    pipeline.add_argument("--replace-mode", default="delete", choices=["delete", "partition"])
+    pipeline.add_argument("--insert-buffer", action="store_true")
+    pipeline.add_argument("--postgres-upsert", default=None, choices=["values", "copy"])
+    pipeline.add_argument("--latency", type=float, default=0.0, help="задержка на запрос к БД в памяти, с")
+    pipeline.add_argument(
+        "--local-db", action="store_true", help="настоящие PostgreSQL и ClickHouse из .env (только локальные серверы!)"
+    )
+    pipeline.add_argument("--save", default=None, metavar="FILE", help="сохранить результат в JSON")
+    pipeline.add_argument("--compare", default=None, metavar="FILE", help="сравнить с сохранённым результатом")
+    pipeline.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
 import os
+import threading
+import time
 import traceback
+from contextlib import contextmanager
+
 import numpy as np
 import pandas as pd
 from clickhouse_driver import Client, errors
@@ -29,61 +33,227 @@ class ClickHouseConnection:
             self.user = os.getenv("CLIC_USER")
             self.password = os.getenv("CLICK_PASSWORD")
             self.database = typeBD
+            # Свободные подключения. Отдельный пул для клиентов с use_numpy: настройка задаётся при создании клиента
             self.pool = []
+            self.numpy_pool = []
+            # Не больше max_pool_size открытых подключений на процесс (оба пула вместе).
+            # Если все заняты, get_connection ждёт до pool_timeout секунд
+            self.max_pool_size = int(os.getenv("CLICK_POOL_SIZE", "10"))
+            self.pool_timeout = float(os.getenv("CLICK_POOL_TIMEOUT", "300"))
+            # Свободное подключение старше health_check_interval секунд перед выдачей проверяется ping
+            self.health_check_interval = float(os.getenv("CLICK_POOL_HEALTH_CHECK", "30"))
+            self.__pool_condition = threading.Condition()
+            self.__opened = 0
+            self.__idle_since = {}
+            self.pool_metrics = {
+                "checkouts": 0,
+                "created": 0,
+                "reconnects": 0,
+                "wait_seconds_total": 0.0,
+                "wait_seconds_max": 0.0,
+            }
+            # Замеры запросов (metrics.Metrics), задаёт WorkForData; None - не замерять
+            self.metrics = None
 
             self.engine = None
 
             self.initialized = True
 
-    def create_connection(self):
+    def create_connection(self, use_numpy=False):
         client = Client(
             host=self.host,
             port=self.port,
             user=self.user,
             password=self.password,
             database=self.database,
+            settings={"use_numpy": True} if use_numpy else None,
         )
         return client
 
-    def get_connection(self):
-        if not self.pool:
-            self.pool.append(self.create_connection())
-        return self.pool.pop(0)
+    def get_connection(self, use_numpy=False):
+        """Выдаёт подключение из пула; лучше пользоваться контекстным менеджером connection()"""
+        pool = self.numpy_pool if use_numpy else self.pool
+        other_pool = self.pool if use_numpy else self.numpy_pool
+        start = time.monotonic()
+        with self.__pool_condition:
+            while True:
+                if pool:
+                    connection = pool.pop()
+                    break
+                if self.__opened < self.max_pool_size:
+                    self.__opened += 1
+                    connection = None
+                    break
+                if other_pool:
+                    # Лимит занят свободными подключениями другого вида - закрываем одно из них
+                    self.__disconnect(other_pool.pop())
+                    connection = None
+                    break
+                remaining = self.pool_timeout - (time.monotonic() - start)
+                if remaining <= 0 or not self.__pool_condition.wait(remaining):
+                    raise TimeoutError(
+                        f"Нет свободного подключения к ClickHouse за {self.pool_timeout} с "
+                        f"(максимум {self.max_pool_size})"
+                    )
+            waited = time.monotonic() - start
+            self.pool_metrics["checkouts"] += 1
+            self.pool_metrics["wait_seconds_total"] += waited
+            self.pool_metrics["wait_seconds_max"] = max(self.pool_metrics["wait_seconds_max"], waited)
+            idle_since = self.__idle_since.pop(id(connection), None)
+
+        if connection is None:
+            try:
+                connection = self.create_connection(use_numpy=use_numpy)
+            except Exception:
+                with self.__pool_condition:
+                    self.__opened -= 1
+                    self.__pool_condition.notify()
+                raise
+            with self.__pool_condition:
+                self.pool_metrics["created"] += 1
+        elif idle_since is not None and time.monotonic() - idle_since > self.health_check_interval:
+            try:
+                self.__health_check(connection)
+            except Exception:
+                # Подключение не удалось ни проверить, ни закрыть: освобождаем его место в пуле,
+                # иначе оно потеряно навсегда и get_connection со временем будет только ждать
+                with self.__pool_condition:
+                    self.__opened -= 1
+                    self.__pool_condition.notify()
+                raise
+        return connection
 
-    def return_connection(self, connection):
-        self.pool.append(connection)
+    def return_connection(self, connection, use_numpy=False):
+        pool = self.numpy_pool if use_numpy else self.pool
+        with self.__pool_condition:
+            self.__idle_since[id(connection)] = time.monotonic()
+            pool.append(connection)
+            self.__pool_condition.notify()
 
-    def execute(self, query, params=None, with_transaction=False):
-        connection = self.get_connection()
+    @contextmanager
+    def connection(self, use_numpy=False):
+        """with click.connection() as client: ... - подключение возвращается в пул в любом случае"""
+        client = self.get_connection(use_numpy=use_numpy)
         try:
-            if with_transaction:
-                connection.execute("START TRANSACTION;")
-            result = connection.execute(query, params, with_column_types=True)
-            if with_transaction:
-                connection.execute("COMMIT;")
-            self.return_connection(connection)
-            return result
-        except errors.Error as e:
-            if with_transaction:
-                connection.execute("ROLLBACK;")
-            self.return_connection(connection)
-            raise e
-
-    def execute_df(self, query, params=None):
-        connection = self.get_connection()
+            yield client
+        finally:
+            self.return_connection(client, use_numpy=use_numpy)
+
+    def __health_check(self, connection):
+        """Долго простаивавшее подключение проверяем ping и при ошибке переподключаем"""
+        transport = connection.connection
+        if not transport.connected:
+            return
         try:
-            result = connection.execute(query, params, with_column_types=True)
-            self.return_connection(connection)
-            if isinstance(result, tuple):
-                result, columns = result
-                column_names = [column[0] for column in columns]
-                df = pd.DataFrame(result, columns=column_names)
-            else:
-                df = pd.DataFrame()
-            return df
-        except Exception as e:
-            self.return_connection(connection)
-            raise e
+            # Недочитанный результат (например, брошенный execute_iter) сломает следующий запрос
+            healthy = not transport.is_query_executing and transport.ping()
+        except Exception:
+            # ping возвращает False только при ошибке сокета, на чужой пакет - UnexpectedPacketFromServerError
+            print(traceback.format_exc())
+            healthy = False
+        if not healthy:
+            # Клиент переподключится сам при следующем запросе
+            connection.disconnect()
+            with self.__pool_condition:
+                self.pool_metrics["reconnects"] += 1
+
+    def __disconnect(self, connection):
+        self.__idle_since.pop(id(connection), None)
+        try:
+            connection.disconnect()
+        except Exception:
+            print(traceback.format_exc())
+
+    def pool_stats(self):
+        """Размер пула и время ожидания подключений"""
+        with self.__pool_condition:
+            idle = len(self.pool) + len(self.numpy_pool)
+            return {
+                "max_size": self.max_pool_size,
+                "opened": self.__opened,
+                "idle": idle,
+                "in_use": self.__opened - idle,
+                **self.pool_metrics,
+            }
+
+    def __timed_execute(self, connection, query, *args, **kwargs):
+        """connection.execute с замером времени запроса (по первому слову: SELECT, INSERT, ALTER...)"""
+        start = time.perf_counter()
+        try:
+            return connection.execute(query, *args, **kwargs)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_db("clickhouse", query.split(None, 1)[0].upper(), time.perf_counter() - start)
+
+    def execute(self, query, params=None, with_transaction=False):
+        with self.connection() as connection:
+            try:
+                if with_transaction:
+                    connection.execute("START TRANSACTION;")
+                result = self.__timed_execute(connection, query, params, with_column_types=True)
+                if with_transaction:
+                    connection.execute("COMMIT;")
+                return result
+            except errors.Error as e:
+                if with_transaction:
+                    connection.execute("ROLLBACK;")
+                raise e
+
+    def execute_df(self, query, params=None, columnar=False):
+        """columnar=True - чтение колонками numpy-клиентом (см. execute_columnar_df)"""
+        if columnar:
+            return self.execute_columnar_df(query, params)
+        with self.connection() as connection:
+            result = self.__timed_execute(connection, query, params, with_column_types=True)
+        if isinstance(result, tuple):
+            result, columns = result
+            column_names = [column[0] for column in columns]
+            df = pd.DataFrame(result, columns=column_names)
+        else:
+            df = pd.DataFrame()
+        return df
+
+    def execute_columnar_df(self, query, params=None):
+        """
+        Результат запроса колонками: клиент с use_numpy отдаёт по numpy-массиву на столбец,
+        и DataFrame собирается из них без промежуточного списка кортежей строк.
+        Для больших выборок, которые не нужны в памяти целиком, - execute_iter_df.
+        """
+        with self.connection(use_numpy=True) as connection:
+            data, columns = self.__timed_execute(connection, query, params, with_column_types=True, columnar=True)
+        column_names = [column[0] for column in columns]
+        # Nullable-столбцы numpy-клиент отдаёт object-массивами с None - приводим их к числовым типам
+        return pd.DataFrame(dict(zip(column_names, data)), columns=column_names).infer_objects()
+
+    def execute_iter_df(self, query, params=None, chunk_size=100_000, settings=None):
+        """
+        Потоковое чтение через execute_iter: DataFrame на каждые chunk_size строк.
+        В памяти одновременно только текущий кусок, поэтому подходит для выборок
+        на десятки миллионов строк. Пустой результат - один пустой DataFrame со столбцами.
+        """
+        with self.connection() as connection:
+            rows = connection.execute_iter(
+                query, params, with_column_types=True, chunk_size=chunk_size, settings=settings
+            )
+            column_names = None
+            yielded = False
+            finished = False
+            try:
+                for chunk in rows:
+                    if column_names is None:
+                        # Первым элементом execute_iter с with_column_types отдаёт описание столбцов
+                        column_names = [column[0] for column in chunk[0]]
+                        chunk = chunk[1:]
+                    if chunk:
+                        yielded = True
+                        yield pd.DataFrame(chunk, columns=column_names)
+                finished = True
+            finally:
+                if not finished:
+                    # Ответ дочитан не до конца - такое подключение в пул возвращать нельзя
+                    connection.disconnect()
+            if not yielded:
+                yield pd.DataFrame(columns=column_names or [])
 
     def command_clickhouse(self, query):
         try:
@@ -91,8 +261,10 @@ class ClickHouseConnection:
         except Exception as error:
             print(traceback.format_exc())
 
-    def clickhouse_to_dataframe(self, query):
+    def clickhouse_to_dataframe(self, query, columnar=False):
         try:
+            if columnar:
+                return self.execute_columnar_df(query)
             result = self.execute(query)
             if isinstance(result, tuple):
                 result, columns = result
@@ -140,10 +312,63 @@ class ClickHouseConnection:
 
             data_to_insert = df.to_dict(orient="records")
             self.execute(f"INSERT INTO {table_name} VALUES", data_to_insert)
+            return True
         except Exception as e:
             print(f"Ошибка загрузки в ClickHouse {table_name}: {str(e)}")
             print(traceback.format_exc())
             # _LOG_(type_log='connect', data=f'error clickhouse_insert {e}')
+            return False
+
+    @staticmethod
+    def columnar_data(df, skip_columns=("guid_bonus", "guid_discount")):
+        """
+        Готовит DataFrame к колоночной вставке: по одному numpy-массиву на столбец.
+
+        Повторяет правила clickhouse_insert (0, NaN и строки "None"/"nan"/... -> NULL),
+        но через маску по столбцу, а не через replace по всему фрейму.
+        Столбец без NULL уходит типизированным массивом как есть; столбец с NULL -
+        object-массивом, где по маске стоит None.
+        """
+        null_strings = ["None", "nan", "<NA>", "NaT", "NaN"]
+        data = []
+        for column in df.columns:
+            series = df[column]
+            mask = series.isna().to_numpy()
+            if pd.api.types.is_datetime64_any_dtype(series.dtype):
+                values = series.to_numpy(dtype="datetime64[ns]")
+            elif pd.api.types.is_numeric_dtype(series.dtype):
+                if column not in skip_columns:
+                    mask |= (series == 0).fillna(False).to_numpy(dtype=bool)
+                if mask.any():
+                    values = series.to_numpy(dtype=object, na_value=None)
+                else:
+                    values = series.to_numpy()
+            else:
+                if column not in skip_columns:
+                    mask |= series.isin(null_strings + [0]).to_numpy(dtype=bool)
+                values = series.to_numpy(dtype=object)
+            if mask.any():
+                values = values.astype(object)
+                values[mask] = None
+            data.append(values)
+        return data
+
+    def clickhouse_insert_columnar(self, table_name, df):
+        """Вставка DataFrame колонками через numpy-клиент (без to_dict по строкам)"""
+        try:
+            columns = ", ".join(df.columns)
+            with self.connection(use_numpy=True) as connection:
+                self.__timed_execute(
+                    connection,
+                    f"INSERT INTO {table_name} ({columns}) VALUES",
+                    self.columnar_data(df),
+                    columnar=True,
+                )
+            return True
+        except Exception as e:
+            print(f"Ошибка колоночной загрузки в ClickHouse {table_name}: {str(e)}")
+            print(traceback.format_exc())
+            return False
 
     def clickhouse_delete_date(self, table_name, date_start, date_end):
         try:
@@ -153,18 +378,117 @@ class ClickHouseConnection:
             print(traceback.format_exc())
         # _LOG_(type_log='connect', data=f'error clickhouse_delete_date {error}')
 
+    def clickhouse_delete_dates(self, table_name, dates):
+        """Удаление нескольких дат одной мутацией. Возвращает True, если запрос прошёл"""
+        try:
+            dates_list = ", ".join(f"'{date}'" for date in dates)
+            self.execute(f"ALTER TABLE {table_name} DELETE WHERE toDate(order_date) IN ({dates_list})")
+            return True
+        except Exception as error:
+            print(traceback.format_exc())
+            return False
+
+    def clickhouse_add_rows(self, table_name, staging_name, df, key_columns, columnar=True):
+        """
+        Досылка строк без перезаливки дат из файлов: df прибавляется к тому, что уже лежит в table_name
+        за его даты, строки с одинаковым ключом key_columns складываются (два кода товара с одним id).
+
+        Даты пересобираются в staging_name: df вставляется в соседнюю таблицу {staging_name}_delta,
+        в staging - текущие строки дат вместе с ней, свёрнутые по ключу, затем партиции подменяются
+        через clickhouse_replace_partitions. Ключи в текст запросов не попадают (размер запроса
+        не зависит от числа строк), а table_name до REPLACE PARTITION не меняется - при ошибке
+        в таблице остаются прежние данные. Возвращает True, если прошло.
+        """
+        delta_name = f"{staging_name}_delta"
+        try:
+            dates = sorted({f"{date:%Y-%m-%d}" for date in pd.to_datetime(df["order_date"])})
+            self.clickhouse_prepare_staging(table_name, staging_name)
+            self.clickhouse_prepare_staging(table_name, delta_name)
+            if columnar:
+                inserted = self.clickhouse_insert_columnar(delta_name, df)
+            else:
+                inserted = self.clickhouse_insert(delta_name, df)
+            if not inserted:
+                return False
+            value_columns = [column for column in df.columns if column not in key_columns]
+            columns = ", ".join(df.columns)
+            key_list = ", ".join(key_columns)
+            dates_list = ", ".join(f"'{date}'" for date in dates)
+            # Без псевдонимов: round(sum(x), 3) AS x ClickHouse принял бы за вложенную агрегацию
+            self.execute(
+                f"INSERT INTO {staging_name} ({key_list}, {', '.join(value_columns)}) "
+                f"SELECT {key_list}, {', '.join(f'round(sum({column}), 3)' for column in value_columns)} "
+                f"FROM (SELECT {columns} FROM {table_name} WHERE toDate(order_date) IN ({dates_list}) "
+                f"UNION ALL SELECT {columns} FROM {delta_name}) "
+                f"GROUP BY {key_list}"
+            )
+            replaced = self.clickhouse_replace_partitions(table_name, staging_name, dates)
+            self.execute(f"TRUNCATE TABLE {delta_name}")
+            return replaced
+        except Exception as error:
+            print(traceback.format_exc())
+            return False
+
     # Использовать
     def clickhouse_del_date_on_insert(
-        self, table_name, date_start, date_end, delete_columns, df
+        self, table_name, date_start, date_end, delete_columns, df, columnar=False
     ):
         try:
             delete_query = f"ALTER TABLE {table_name} DELETE WHERE toDate(order_date) >= '{date_start}' AND toDate(order_date) <= '{date_end}'"
             self.execute(delete_query, with_transaction=False)
-            self.clickhouse_insert(table_name, df, with_transaction=True)
+            if columnar:
+                self.clickhouse_insert_columnar(table_name, df)
+            else:
+                self.clickhouse_insert(table_name, df, with_transaction=True)
         except Exception as error:
             print(traceback.format_exc())
         # _LOG_(type_log='connect', data=f'error clickhouse_del_date_on_insert {error}')
 
+    def clickhouse_prepare_staging(self, table_name, staging_name):
+        """Пустая staging-таблица с той же структурой и ключом партиционирования, что и table_name"""
+        self.execute(f"CREATE TABLE IF NOT EXISTS {staging_name} AS {table_name}")
+        self.execute(f"TRUNCATE TABLE {staging_name}")
+
+    def clickhouse_replace_partitions(self, table_name, staging_name, dates):
+        """
+        Заменяет в table_name данные за даты dates данными из staging_name.
+
+        Вместо ALTER ... DELETE на каждый файл: в staging дописываются строки затронутых
+        партиций за остальные даты, после чего партиции целиком подменяются через
+        REPLACE PARTITION. Число тяжёлых операций - по числу партиций, а не файлов.
+        Возвращает True, если замена прошла.
+        """
+        try:
+            partitions = [
+                row[0]
+                for row in self.execute(f"SELECT DISTINCT _partition_id FROM {staging_name}")[0]
+            ]
+            if not partitions:
+                return True
+            partition_ids = ", ".join(f"'{partition}'" for partition in partitions)
+            dates_list = ", ".join(f"'{date}'" for date in sorted(dates))
+            self.execute(
+                f"INSERT INTO {staging_name} SELECT * FROM {table_name} "
+                f"WHERE _partition_id IN ({partition_ids}) AND toDate(order_date) NOT IN ({dates_list})"
+            )
+            self.execute(
+                f"ALTER TABLE {table_name} "
+                + ", ".join(
+                    f"REPLACE PARTITION ID '{partition}' FROM {staging_name}" for partition in partitions
+                )
+            )
+            self.execute(f"TRUNCATE TABLE {staging_name}")
+            return True
+        except Exception as error:
+            print(traceback.format_exc())
+            return False
+
     def close(self):
-        for connection in self.pool:
-            connection.disconnect()
+        """Закрывает свободные подключения; занятые закроются при следующем close после возврата"""
+        with self.__pool_condition:
+            for connection in self.pool + self.numpy_pool:
+                self.__disconnect(connection)
+                self.__opened -= 1
+            self.pool.clear()
+            self.numpy_pool.clear()
+            self.__pool_condition.notify_all()
@@ -0,0 +1,117 @@
+import os
+import threading
+from collections import defaultdict
+
+import pandas as pd
+
+
+class ErrorCollector:
+    """
+    Общий для потоков сборщик ключей, которых нет в справочниках.
+
+    Вместо перечитывания и перезаписи файлов ошибок на каждый загруженный файл
+    ключи копятся в множествах в памяти, а в конце запуска в файлы дописываются
+    только новые, ещё не записанные ключи. Дополнительно считается, сколько
+    разных неизвестных ключей каждого вида встретилось в каждом файле.
+
+    sinks - {вид: (путь к файлу, заголовок столбца или None для простого текстового файла)}.
+    """
+
+    SINKS = {
+        "product": ("Номенклатура_не_в_бд.csv", "Номенклатура.Код"),
+        "store": ("NON_DB_ERROR.txt", None),
+    }
+
+    def __init__(self, sinks=None):
+        self.sinks = dict(self.SINKS if sinks is None else sinks)
+        self.__lock = threading.Lock()
+        # Уже записанные в файлы ключи (читаются при первом flush) и новые, ждущие записи
+        self.__known = None
+        self.__new = {kind: set() for kind in self.sinks}
+        # файл -> вид -> неизвестные ключи файла (множество: файл может приходить кусками)
+        self.__files = defaultdict(lambda: defaultdict(set))
+
+    def __read(self, kind):
+        path, header = self.sinks[kind]
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return set()
+        if header is None:
+            with open(path, "r", encoding="utf-8") as file:
+                lines = file.read().splitlines()
+            keys = {line.strip() for line in lines if line.strip()}
+            clean = len(keys) == len(lines)
+        else:
+            df = pd.read_csv(path, dtype=str)
+            keys = set(df[header].dropna()) if header in df.columns else set()
+            clean = list(df.columns) == [header] and len(keys) == len(df)
+        if not clean:
+            # Файл в старом формате (повторы, столбцы индекса от to_csv) - один раз приводим в порядок
+            self.__write(kind, keys, mode="w")
+        return keys
+
+    def __write(self, kind, keys, mode="a"):
+        path, header = self.sinks[kind]
+        new_file = mode == "w" or not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, mode, encoding="utf-8") as file:
+            if header is not None and new_file:
+                file.write(header + "\n")
+            for key in sorted(keys):
+                file.write(key + "\n")
+
+    def add(self, kind, file, keys):
+        """Запомнить неизвестные ключи вида kind, встреченные в файле file"""
+        keys = {str(key) for key in pd.unique(pd.Series(keys, dtype=object).dropna())}
+        if not keys:
+            return
+        with self.__lock:
+            self.__files[file][kind].update(keys)
+            self.__new[kind].update(keys)
+
+    def counts(self):
+        """{файл: {вид: число разных неизвестных ключей}}"""
+        with self.__lock:
+            return {file: {kind: len(keys) for kind, keys in kinds.items()} for file, kinds in self.__files.items()}
+
+    def pop_counts(self):
+        """То же, что counts, но сводка по файлам очищается (режим службы печатает её на каждую пачку)"""
+        with self.__lock:
+            counts = {file: {kind: len(keys) for kind, keys in kinds.items()} for file, kinds in self.__files.items()}
+            self.__files.clear()
+            return counts
+
+    def pop_pending(self):
+        """Забирает накопленное (используется процессами-обработчиками, см. merge)"""
+        with self.__lock:
+            pending = (
+                {kind: set(keys) for kind, keys in self.__new.items()},
+                {file: dict(kinds) for file, kinds in self.__files.items()},
+            )
+            for keys in self.__new.values():
+                keys.clear()
+            self.__files.clear()
+            return pending
+
+    def merge(self, pending):
+        """Добавляет то, что вернул pop_pending другого сборщика"""
+        new, files = pending
+        with self.__lock:
+            for kind, keys in new.items():
+                self.__new[kind].update(keys)
+            for file, kinds in files.items():
+                for kind, keys in kinds.items():
+                    self.__files[file][kind].update(keys)
+
+    def flush(self):
+        """Дописывает в файлы только новые ключи. Возвращает {вид: сколько дописано}"""
+        with self.__lock:
+            if self.__known is None:
+                self.__known = {kind: self.__read(kind) for kind in self.sinks}
+            written = {}
+            for kind, keys in self.__new.items():
+                keys -= self.__known[kind]
+                if keys:
+                    self.__write(kind, keys)
+                    self.__known[kind].update(keys)
+                written[kind] = len(keys)
+                keys.clear()
+            return written
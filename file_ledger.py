@@ -0,0 +1,136 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+
+class FileLedger:
+    """
+    Журнал обработанных файлов в SQLite (вместо except.csv).
+
+    Ключ - имя файла, как и в except.csv, дополнительно хранятся путь, размер, mtime и sha256.
+    Каждая отметка - отдельная транзакция, поэтому падение посреди запуска не теряет
+    уже загруженные файлы, а потоки и процессы не затирают записи друг друга.
+    Проверка "обработан ли файл" идёт по словарю в памяти за O(1); файл с тем же путём,
+    но изменившимся содержимым считается необработанным и загружается заново.
+
+    Отметка делается после вставки, иногда много позже чтения (буфер, замена партиций),
+    поэтому в mark передаётся fingerprint(), снятый при открытии файла на чтение: если 1С
+    перезапишет выгрузку в этот промежуток, новое содержимое не будет считаться загруженным.
+    """
+
+    def __init__(self, path="processed_files.sqlite3", legacy_csv="except.csv"):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute(
+            """CREATE TABLE IF NOT EXISTS processed_files (
+                name TEXT PRIMARY KEY,
+                path TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sha256 TEXT,
+                processed_at REAL
+            )"""
+        )
+        self.__conn.commit()
+        self.__import_legacy(legacy_csv)
+        self.__entries = {}
+        self.reload()
+
+    def __import_legacy(self, legacy_csv):
+        """Однократный перенос имён из except.csv: для них известно только имя файла"""
+        if not legacy_csv or not os.path.exists(legacy_csv):
+            return
+        with self.__lock:
+            if self.__conn.execute("SELECT count(*) FROM processed_files").fetchone()[0]:
+                return
+            names = pd.read_csv(legacy_csv).iloc[:, 0].dropna().astype(str).unique()
+            self.__conn.executemany(
+                "INSERT OR IGNORE INTO processed_files (name, processed_at) VALUES (?, ?)",
+                [(name, time.time()) for name in names],
+            )
+            self.__conn.commit()
+        print(f"[журнал] Перенесено из {legacy_csv}: {len(names)} файлов")
+
+    def reload(self):
+        """Перечитать журнал (его могли дополнить другие процессы)"""
+        with self.__lock:
+            rows = self.__conn.execute(
+                "SELECT name, path, size, mtime_ns, sha256 FROM processed_files"
+            ).fetchall()
+            self.__entries = {row[0]: row[1:] for row in rows}
+
+    def is_processed(self, path):
+        path = os.path.normpath(path)
+        entry = self.__entries.get(os.path.basename(path))
+        if entry is None:
+            return False
+        stored_path, size, mtime_ns, sha256 = entry
+        # Запись из except.csv или одноимённый файл из другой папки - как раньше, по имени
+        if stored_path is None or stored_path != path:
+            return True
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # Файл удалили или переименовали после listdir - загружать нечего
+            return False
+        if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+            return True
+        return self.file_hash(path) == sha256
+
+    def mark(self, path, fingerprint=None):
+        """
+        Отметить файл обработанным (одна транзакция на файл). fingerprint - (size, mtime_ns, sha256)
+        из fingerprint() на момент чтения файла; None - снять сейчас
+        """
+        path = os.path.normpath(path)
+        entry = (path, *(fingerprint or self.fingerprint(path)))
+        name = os.path.basename(path)
+        with self.__lock:
+            self.__conn.execute(
+                "INSERT OR REPLACE INTO processed_files (name, path, size, mtime_ns, sha256, processed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (name, *entry, time.time()),
+            )
+            self.__conn.commit()
+            self.__entries[name] = entry
+
+    def names_in(self, directory, include_legacy=False):
+        """Имена обработанных файлов из папки directory (include_legacy - и записи из except.csv без пути)"""
+        directory = os.path.normpath(directory)
+        return [
+            name
+            for name, (stored_path, *_) in self.__entries.items()
+            if (stored_path is None and include_legacy)
+            or (stored_path is not None and os.path.dirname(stored_path) == directory)
+        ]
+
+    def forget(self, name):
+        """Убрать файл из журнала, чтобы он загрузился заново"""
+        with self.__lock:
+            self.__conn.execute("DELETE FROM processed_files WHERE name = ?", (name,))
+            self.__conn.commit()
+            self.__entries.pop(name, None)
+
+    @classmethod
+    def fingerprint(cls, path):
+        """(size, mtime_ns, sha256) файла; stat снимается до хэша - дозапись после него даст несовпадение"""
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns, cls.file_hash(path)
+
+    @staticmethod
+    def file_hash(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()
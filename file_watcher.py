@@ -0,0 +1,169 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+# Константы inotify из <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """Минимальная обёртка над inotify из libc (Linux), без сторонних пакетов"""
+
+    def __init__(self, directories):
+        # Все ошибки недоступности - OSError: на него FileWatcher переходит к сканированию папок
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, f"inotify есть только в Linux, а не в {sys.platform}")
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        except (TypeError, OSError) as error:
+            # Без libc CDLL(None) на части систем бросает TypeError, а не OSError
+            raise OSError(errno.ENOSYS, f"libc недоступна: {error}") from error
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify недоступен")
+        self.__libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.__directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(error, f"inotify_add_watch {directory}")
+            self.__directories[wd] = directory
+
+    def read(self, timeout):
+        """
+        Ждёт события до timeout секунд. Возвращает (пути файлов, переполнение очереди):
+        при переполнении часть событий потеряна и папки нужно пересканировать.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return [], False
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return [], False
+        paths, overflow, offset = [], False, 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif name and wd in self.__directories:
+                paths.append(os.path.join(self.__directories[wd], os.fsdecode(name)))
+        return paths, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    """
+    Следит за появлением и изменением файлов в папках.
+
+    Изменения узнаём от inotify, а если он недоступен (не Linux, исчерпан лимит
+    fs.inotify.max_user_watches) - сканированием папок раз в poll_interval секунд.
+    Файл отдаётся как готовый, только когда его размер и mtime не менялись
+    settle_seconds секунд: выгрузку 1С или копирование по сети не читаем на середине.
+    При старте все уже лежащие в папках файлы тоже считаются новыми,
+    что из них уже загружено - решает вызывающий (журнал обработанных).
+    """
+
+    def __init__(self, directories, suffix=".txt", settle_seconds=2.0, poll_interval=5.0, use_inotify=True):
+        self.directories = [os.path.normpath(directory) for directory in directories]
+        self.suffix = suffix
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.__inotify = None
+        if use_inotify:
+            try:
+                self.__inotify = Inotify(self.directories)
+            except OSError as error:
+                print(f"[!] inotify недоступен ({error}), папки будут сканироваться раз в {poll_interval} с")
+        self.mode = "inotify" if self.__inotify is not None else "polling"
+        # Файлы, которые ещё пишутся: путь -> [(размер, mtime), с какого момента не меняется]
+        self.__candidates = {}
+        # Что видели при последнем сканировании (для режима polling)
+        self.__known = {}
+        self.__last_scan = 0.0
+        self.__scan()
+
+    def __scan(self):
+        """Сканирование папок: новые и изменившиеся с прошлого раза файлы становятся кандидатами"""
+        self.__last_scan = time.monotonic()
+        seen = {}
+        for directory in self.directories:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(self.suffix) or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    signature = (stat.st_size, stat.st_mtime_ns)
+                    seen[entry.path] = signature
+                    if self.__known.get(entry.path) != signature:
+                        self.__candidates.setdefault(entry.path, [None, None])
+        self.__known = seen
+
+    def __settled(self):
+        """Кандидаты, которые не менялись settle_seconds секунд"""
+        now = time.monotonic()
+        ready = []
+        for path, state in list(self.__candidates.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Удалили или переименовали, не дописав
+                del self.__candidates[path]
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if state[0] != signature:
+                state[0], state[1] = signature, now
+            elif stat.st_size > 0 and now - state[1] >= self.settle_seconds:
+                del self.__candidates[path]
+                ready.append(path)
+        return sorted(ready)
+
+    def wait(self, timeout=1.0):
+        """Ждёт до timeout секунд и возвращает пути файлов, которые дописаны и готовы к загрузке"""
+        deadline = time.monotonic() + timeout
+        while True:
+            ready = self.__settled()
+            remaining = deadline - time.monotonic()
+            if ready or remaining <= 0:
+                return ready
+            # Пока есть недописанные файлы, проверяем их чаще
+            step = min(remaining, self.settle_seconds / 2 if self.__candidates else remaining)
+            if self.__inotify is not None:
+                paths, overflow = self.__inotify.read(step)
+                if overflow:
+                    self.__scan()
+                for path in paths:
+                    if path.endswith(self.suffix):
+                        self.__candidates.setdefault(path, [None, None])
+            else:
+                time.sleep(step)
+                if time.monotonic() - self.__last_scan >= self.poll_interval:
+                    self.__scan()
+
+    def close(self):
+        if self.__inotify is not None:
+            self.__inotify.close()
+            self.__inotify = None
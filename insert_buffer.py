@@ -0,0 +1,170 @@
+import threading
+import time
+import traceback
+
+import pandas as pd
+
+
+class InsertBuffer:
+    """
+    Общий для потоков буфер вставки в ClickHouse.
+
+    Потоки кладут сюда уже агрегированные DataFrame по одному файлу, буфер копит их
+    и отправляет одной вставкой, когда набирается max_rows строк, max_bytes байт
+    или с первой записи прошло max_seconds секунд. Так вместо множества мелких
+    кусков (parts) на каждый файл ClickHouse получает несколько крупных.
+
+    Семантика "удалить дату и вставить заново" сохраняется: при сбросе сначала
+    одним ALTER ... DELETE удаляются все даты буфера, затем вставляются их данные.
+    Если дата уже лежит в буфере, новый файл за ту же дату заменяет прежние данные,
+    как если бы файлы грузились по очереди. on_flush([(файл, дата), ...]) вызывается
+    только после успешной вставки - там файлы и отмечаются обработанными.
+    Если сброс не прошёл, данные возвращаются в буфер; повтор по размеру или времени -
+    не раньше чем через max_seconds, явный flush() пробует сразу.
+    Запрос к ClickHouse идёт без блокировки буфера: потоки, закончившие файл, его не ждут.
+    """
+
+    def __init__(
+        self,
+        click_house,
+        table_name,
+        on_flush,
+        replace_dates=True,
+        columnar=True,
+        max_rows=500_000,
+        max_bytes=256 * 1024 * 1024,
+        max_seconds=30,
+    ):
+        self.click_house = click_house
+        self.table_name = table_name
+        self.on_flush = on_flush
+        self.replace_dates = replace_dates
+        self.columnar = columnar
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+
+        # Последний сброс не прошёл и его данные ждут повторной отправки
+        self.failed = False
+        self.__failed_at = None
+
+        # __lock - состояние буфера (его берут потоки в add), __flush_lock - сама отправка:
+        # пока идёт запрос к ClickHouse, потоки продолжают складывать файлы в буфер
+        self.__lock = threading.RLock()
+        self.__flush_lock = threading.Lock()
+        # дата -> (список файлов, DataFrame)
+        self.__entries = {}
+        # Забранное текущим сбросом, пока он идёт
+        self.__flushing = {}
+        self.__rows = 0
+        self.__bytes = 0
+        self.__first_added = None
+
+        # Сброс по времени, даже если новые файлы перестали приходить
+        self.__stop = threading.Event()
+        self.__timer = threading.Thread(target=self.__flush_by_time, daemon=True)
+        self.__timer.start()
+
+    def add(self, file, date, df):
+        with self.__lock:
+            files, previous = self.__entries.get(date, ([], None))
+            if previous is not None:
+                self.__rows -= len(previous)
+                self.__bytes -= previous.memory_usage(index=True).sum()
+            self.__entries[date] = (files + [file], df)
+            self.__rows += len(df)
+            self.__bytes += df.memory_usage(index=True).sum()
+            if self.__first_added is None:
+                self.__first_added = time.monotonic()
+            full = self.__rows >= self.max_rows or self.__bytes >= self.max_bytes
+            # После неудачного сброса повтор по размеру - тоже не раньше чем через max_seconds
+            backoff = self.failed and time.monotonic() - self.__failed_at < self.max_seconds
+        if full and not backoff:
+            # Если сброс уже идёт в другом потоке, не ждём его: остальное уйдёт следующим сбросом
+            self.flush(blocking=False)
+
+    def pending_files(self):
+        """Файлы, данные которых лежат в буфере или отправляются и ещё не отмечены"""
+        with self.__lock:
+            return [
+                file
+                for entries in (self.__flushing, self.__entries)
+                for files, _ in entries.values()
+                for file in files
+            ]
+
+    def flush(self, blocking=True):
+        """
+        Отправляет всё накопленное. Возвращает True, если вставка прошла (или буфер пуст).
+        blocking=False - не ждать уже идущий сброс (тогда False)
+        """
+        if not self.__flush_lock.acquire(blocking=blocking):
+            return False
+        try:
+            with self.__lock:
+                if not self.__entries:
+                    return True
+                entries = self.__flushing = self.__entries
+                self.__entries = {}
+                self.__rows = 0
+                self.__bytes = 0
+                self.__first_added = None
+            return self.__send(entries)
+        finally:
+            self.__flush_lock.release()
+
+    def __send(self, entries):
+        dates = sorted(entries)
+        flushed = [(file, date) for date in dates for file in entries[date][0]]
+        df = pd.concat([entries[date][1] for date in dates], ignore_index=True)
+        print(f"[буфер] Сброс в {self.table_name}: файлов {len(flushed)}, дат {len(dates)}, строк {len(df)}")
+        try:
+            if self.replace_dates and not self.click_house.clickhouse_delete_dates(self.table_name, dates):
+                raise RuntimeError(f"Не удалось удалить даты {dates} из {self.table_name}")
+            if self.columnar:
+                inserted = self.click_house.clickhouse_insert_columnar(self.table_name, df)
+            else:
+                inserted = self.click_house.clickhouse_insert(self.table_name, df)
+            if not inserted:
+                raise RuntimeError(f"Не удалось загрузить данные в {self.table_name}")
+        except Exception:
+            # Данные возвращаются в буфер, повторный сброс (по размеру или времени) - не раньше
+            # чем через max_seconds. Если и при close() не пройдёт, файлы не отмечены обработанными
+            # и загрузятся в следующий запуск
+            self.__restore(entries)
+            print(f"[!] Сброс буфера не прошёл, данные оставлены в буфере, файлы: {[file for file, _ in flushed]}")
+            print(traceback.format_exc())
+            return False
+        with self.__lock:
+            self.__flushing = {}
+            self.failed = False
+        self.on_flush(flushed)
+        return True
+
+    def __restore(self, entries):
+        with self.__lock:
+            for date, (files, df) in entries.items():
+                # За время сброса могли прийти новые данные этой даты - они новее и остаются
+                newer_files, newer = self.__entries.get(date, ([], None))
+                self.__entries[date] = (files + newer_files, df if newer is None else newer)
+            self.__rows = sum(len(df) for _, df in self.__entries.values())
+            self.__bytes = sum(df.memory_usage(index=True).sum() for _, df in self.__entries.values())
+            self.__flushing = {}
+            self.__first_added = self.__failed_at = time.monotonic()
+            self.failed = True
+
+    def __flush_by_time(self):
+        while not self.__stop.wait(1):
+            with self.__lock:
+                expired = (
+                    self.__first_added is not None
+                    and time.monotonic() - self.__first_added >= self.max_seconds
+                )
+            if expired:
+                self.flush(blocking=False)
+
+    def close(self):
+        """Остановка таймера и финальный сброс"""
+        self.__stop.set()
+        self.__timer.join()
+        return self.flush()
@@ -1,5 +1,95 @@
+import argparse
+from contextlib import nullcontext
+
+from metrics import Profiler
 from work_data_itog import WorkForData
 
 if __name__ == "__main__":
-    work = WorkForData()
-    work.first_start()
+    parser = argparse.ArgumentParser(description="Загрузка выгрузок остатков в ClickHouse")
+    parser.add_argument(
+        "--watch", action="store_true", help="режим службы: не завершаться и загружать новые файлы сразу"
+    )
+    parser.add_argument("--settle", type=float, default=2.0, help="сколько секунд файл не должен меняться")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="период сканирования папок без inotify")
+    parser.add_argument("--refresh", type=float, default=3600, help="период обновления справочников, с")
+    parser.add_argument("--polling", action="store_true", help="не использовать inotify, только сканирование")
+    parser.add_argument(
+        "--parse-cache", default=None, metavar="DIR", help="папка кэша разобранных файлов (например .parse_cache)"
+    )
+    parser.add_argument(
+        "--parse-cache-max-age",
+        type=float,
+        default=30,
+        metavar="DAYS",
+        help="удалять из кэша разбора записи уже загруженных файлов старше DAYS дней",
+    )
+    parser.add_argument(
+        "--parse-cache-max-mb",
+        type=float,
+        default=None,
+        metavar="MB",
+        help="держать кэш разбора не больше MB мегабайт (удаляются самые старые записи загруженных файлов)",
+    )
+    parser.add_argument(
+        "--reresolve",
+        action="store_true",
+        help="перезагрузить из кэша разбора файлы, где появились товары, которых не было в spr_product",
+    )
+    parser.add_argument(
+        "--repair",
+        action="store_true",
+        help="дослать в ClickHouse сохранённые строки товаров, которые появились в spr_product",
+    )
+    parser.add_argument(
+        "--old-files",
+        action="store_true",
+        help="загружать и выгрузки старого формата (кроме дат, за которые есть выгрузка нового формата)",
+    )
+    parser.add_argument("--metrics-log", default=None, metavar="FILE", help="JSON-лог замеров по файлам и стадиям")
+    parser.add_argument(
+        "--metrics-textfile", default=None, metavar="FILE", help="файл счётчиков Prometheus для node_exporter"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=None, metavar="PORT", help="отдавать счётчики на 127.0.0.1:PORT/metrics"
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="profile",
+        default=None,
+        metavar="PATH",
+        help="профилировать запуск (cProfile + tracemalloc), отчёт в PATH.txt и PATH.pstats; "
+        "файлы обрабатываются по очереди в основном потоке",
+    )
+    args = parser.parse_args()
+
+    if args.reresolve and not args.parse_cache:
+        args.parse_cache = ".parse_cache"
+    with Profiler(args.profile) if args.profile else nullcontext() as profiler:
+        work = WorkForData(
+            # cProfile снимается с основного потока - под профилем файлы обрабатываются в нём самом
+            **({"executor": "serial"} if args.profile else {}),
+            parse_cache=args.parse_cache,
+            parse_cache_max_age=args.parse_cache_max_age * 24 * 3600,
+            parse_cache_max_bytes=args.parse_cache_max_mb * 1024 ** 2 if args.parse_cache_max_mb else None,
+            load_old_files=args.old_files,
+            metrics_log=args.metrics_log,
+            metrics_textfile=args.metrics_textfile,
+            metrics_port=args.metrics_port,
+        )
+        if profiler is not None:
+            # Время потоков-обработчиков в отчёт профиля - из замеров по стадиям
+            profiler.metrics = work.metrics
+        if args.repair:
+            work.repair_unmatched()
+        elif args.reresolve:
+            work.reresolve_unknown()
+        elif args.watch:
+            work.watch(
+                settle_seconds=args.settle,
+                poll_interval=args.poll_interval,
+                refresh_seconds=args.refresh,
+                use_inotify=not args.polling,
+            )
+        else:
+            work.first_start()
@@ -0,0 +1,343 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:
+    # Windows: модуля resource нет, память не замеряется
+    resource = None
+
+
+def max_rss_bytes():
+    """Пиковый RSS процесса с его запуска (Linux отдаёт ru_maxrss в КБ); без модуля resource (Windows) - 0"""
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Metrics:
+    """
+    Замеры обработки: время и строки на входе/выходе по стадиям каждого файла,
+    прочитанные байты, пиковая память и время запросов к БД.
+
+    Запросы к БД относятся к файлу, стадия которого сейчас идёт в этом же потоке.
+    Пиковый RSS (ru_maxrss) только растёт, поэтому у стадии считается, на сколько она его подняла;
+    при нескольких потоках рост может достаться соседней стадии.
+    По каждому файлу в log_path пишется строка JSON (событие "file"), в конце запуска - "run".
+    Счётчики отдаются в формате Prometheus: файлом textfile (для node_exporter) и/или
+    по HTTP на 127.0.0.1:http_port/metrics.
+    """
+
+    PREFIX = "ost"
+    # имя -> (тип, описание)
+    DESCRIPTIONS = {
+        "stage_seconds_total": ("counter", "Время стадий обработки файлов, с"),
+        "stage_calls_total": ("counter", "Число вызовов стадий"),
+        "stage_rows_in_total": ("counter", "Строк на входе стадий"),
+        "stage_rows_out_total": ("counter", "Строк на выходе стадий"),
+        "stage_rss_growth_bytes_total": ("counter", "На сколько стадии подняли пиковый RSS процесса, байт"),
+        "stage_peak_rss_bytes": ("gauge", "Пиковый RSS процесса на конец стадии, байт"),
+        "db_seconds_total": ("counter", "Время запросов к БД, с"),
+        "db_calls_total": ("counter", "Число запросов к БД"),
+        "db_seconds_max": ("gauge", "Самый долгий запрос к БД, с"),
+        "files_total": ("counter", "Обработанные файлы по статусу"),
+        "bytes_read_total": ("counter", "Прочитано байт из выгрузок"),
+        "peak_rss_bytes": ("gauge", "Пиковый RSS процесса, байт"),
+    }
+
+    def __init__(self, log_path=None, textfile=None, http_port=None):
+        self.log_path = log_path
+        self.textfile = textfile
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        # (имя, метки) -> значение
+        self.__values = defaultdict(float)
+        # файл -> накопленное по файлу до file_done
+        self.__files = {}
+        self.__server = None
+        if http_port is not None:
+            # 0 - любой свободный порт
+            self.serve(http_port)
+
+    def __add(self, name, value, **labels):
+        self.__values[(name, tuple(sorted(labels.items())))] += value
+
+    def __set_max(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.__values[key] = max(self.__values[key], value)
+
+    def __file_record(self, file):
+        return self.__files.setdefault(
+            file, {"started": time.time(), "stages": {}, "db": {}, "bytes": 0}
+        )
+
+    @contextmanager
+    def stage(self, file, stage):
+        """
+        with metrics.stage(file, "read") as info: ... info["rows_in"] = ...; info["rows_out"] = ...
+        file=None - стадия запуска, а не файла (например, загрузка справочников).
+        """
+        info = {}
+        previous = getattr(self.__local, "file", None)
+        self.__local.file = file
+        rss = max_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.__local.file = previous
+            self.__record_stage(file, stage, time.perf_counter() - start, rss, info)
+
+    def __record_stage(self, file, stage, seconds, rss_before, info, calls=1):
+        rss = max_rss_bytes()
+        with self.__lock:
+            self.__add("stage_seconds_total", seconds, stage=stage)
+            self.__add("stage_calls_total", calls, stage=stage)
+            self.__add("stage_rss_growth_bytes_total", rss - rss_before, stage=stage)
+            self.__set_max("stage_peak_rss_bytes", rss, stage=stage)
+            for key in ("rows_in", "rows_out"):
+                if key in info:
+                    self.__add(f"stage_{key}_total", info[key], stage=stage)
+            if file is not None:
+                record = self.__file_record(file)["stages"].setdefault(
+                    stage, dict.fromkeys(["seconds", "calls", "rows_in", "rows_out", "rss_growth_bytes"], 0)
+                )
+                record["seconds"] += seconds
+                record["calls"] += calls
+                record["rss_growth_bytes"] += rss - rss_before
+                for key in ("rows_in", "rows_out"):
+                    record[key] += info.get(key, 0)
+
+    def timed_parts(self, file, stage, parts):
+        """Генератор кусков, где отдельно замеряется получение каждого куска (чтение, кэш)"""
+        parts = iter(parts)
+        while True:
+            previous = getattr(self.__local, "file", None)
+            self.__local.file = file
+            rss = max_rss_bytes()
+            start = time.perf_counter()
+            try:
+                part = next(parts, None)
+            finally:
+                self.__local.file = previous
+            # Последний, пустой вызов (конец файла) добавляет время, но не считается вызовом
+            self.__record_stage(
+                file,
+                stage,
+                time.perf_counter() - start,
+                rss,
+                {} if part is None else {"rows_out": len(part)},
+                calls=0 if part is None else 1,
+            )
+            if part is None:
+                return
+            yield part
+
+    def observe_db(self, system, operation, seconds):
+        """Один запрос к БД (system - clickhouse/postgres, operation - SELECT/INSERT/ALTER/...)"""
+        file = getattr(self.__local, "file", None)
+        with self.__lock:
+            self.__add("db_seconds_total", seconds, system=system, operation=operation)
+            self.__add("db_calls_total", 1, system=system, operation=operation)
+            self.__set_max("db_seconds_max", seconds, system=system, operation=operation)
+            if file is not None:
+                record = self.__file_record(file)["db"].setdefault(
+                    f"{system}.{operation}", {"seconds": 0.0, "calls": 0, "max_seconds": 0.0}
+                )
+                record["seconds"] += seconds
+                record["calls"] += 1
+                record["max_seconds"] = max(record["max_seconds"], seconds)
+
+    def add_bytes(self, file, size):
+        with self.__lock:
+            self.__add("bytes_read_total", size)
+            self.__file_record(file)["bytes"] += size
+
+    def file_done(self, file, status="ok", **fields):
+        """Итог по файлу: событие "file" в JSON-лог"""
+        rss = max_rss_bytes()
+        with self.__lock:
+            record = self.__files.pop(file, None) or {"started": time.time(), "stages": {}, "db": {}, "bytes": 0}
+            self.__add("files_total", 1, status=status)
+            self.__set_max("peak_rss_bytes", rss)
+        self.emit(
+            "file",
+            file=file,
+            status=status,
+            seconds=round(time.time() - record["started"], 3),
+            bytes=record["bytes"],
+            # ru_maxrss - пик процесса с его запуска, а не память этого файла
+            process_peak_rss_bytes=rss,
+            stages=record["stages"],
+            db=record["db"],
+            **fields,
+        )
+
+    def stage_seconds(self):
+        """{стадия: секунды} за всё время (для сводки в конце запуска)"""
+        return {stage: totals["seconds"] for stage, totals in self.stage_totals().items()}
+
+    def stage_totals(self):
+        """
+        {стадия: {"seconds", "calls", "rows_in", "rows_out", "rss_growth_bytes", "peak_rss_bytes"}}
+        за всё время, в порядке первого вызова стадий
+        """
+        fields = {
+            "stage_seconds_total": "seconds",
+            "stage_calls_total": "calls",
+            "stage_rows_in_total": "rows_in",
+            "stage_rows_out_total": "rows_out",
+            "stage_rss_growth_bytes_total": "rss_growth_bytes",
+            "stage_peak_rss_bytes": "peak_rss_bytes",
+        }
+        totals = {}
+        with self.__lock:
+            for (name, labels), value in self.__values.items():
+                if name in fields:
+                    stage = dict(labels)["stage"]
+                    totals.setdefault(stage, dict.fromkeys(fields.values(), 0))[fields[name]] = value
+        return totals
+
+    def value(self, name, **labels):
+        """Текущее значение счётчика, например value("bytes_read_total")"""
+        with self.__lock:
+            return self.__values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def emit(self, event, **fields):
+        """Строка JSON в log_path (несколько процессов дописывают в один файл построчно)"""
+        if not self.log_path:
+            return
+        line = json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, ensure_ascii=False, default=str)
+        with self.__lock:
+            with open(self.log_path, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+
+    def pop_pending(self):
+        """Забирает накопленные счётчики (используется процессами-обработчиками, см. merge)"""
+        with self.__lock:
+            values = dict(self.__values)
+            self.__values.clear()
+            return values
+
+    def merge(self, values):
+        """Добавляет счётчики, которые вернул pop_pending другого процесса"""
+        with self.__lock:
+            for (name, labels), value in values.items():
+                if self.DESCRIPTIONS[name][0] == "gauge":
+                    self.__values[(name, labels)] = max(self.__values[(name, labels)], value)
+                else:
+                    self.__values[(name, labels)] += value
+
+    def prometheus_text(self):
+        with self.__lock:
+            self.__set_max("peak_rss_bytes", max_rss_bytes())
+            values = dict(self.__values)
+        lines = []
+        for name, (kind, description) in self.DESCRIPTIONS.items():
+            series = sorted((labels, value) for (key, labels), value in values.items() if key == name)
+            if not series:
+                continue
+            full_name = f"{self.PREFIX}_{name}"
+            lines += [f"# HELP {full_name} {description}", f"# TYPE {full_name} {kind}"]
+            for labels, value in series:
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f"{full_name}{{{label_text}}} {value}" if labels else f"{full_name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self):
+        """Файл для textfile collector node_exporter (пишется целиком и переименовывается)"""
+        if not self.textfile:
+            return
+        with open(self.textfile + ".tmp", "w", encoding="utf-8") as file:
+            file.write(self.prometheus_text())
+        os.replace(self.textfile + ".tmp", self.textfile)
+
+    def serve(self, port, host="127.0.0.1"):
+        """Отдача счётчиков по HTTP (GET /metrics) в фоновом потоке"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        print(f"Метрики: http://{host}:{self.__server.server_address[1]}/metrics")
+
+    def close(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+
+class Profiler:
+    """
+    Профилирование запуска (itog_main.py --profile): cProfile + tracemalloc.
+
+    cProfile снимается только с основного потока: с Python 3.12 в процессе может быть
+    включён лишь один профилировщик, поэтому вложенные профили потоков-обработчиков не заводим,
+    а itog_main.py --profile обрабатывает файлы в основном потоке (executor="serial").
+    Время по стадиям из Metrics (metrics - Metrics запуска, задаётся после создания WorkForData)
+    тоже добавляется в отчёт.
+    В path + ".pstats" - данные для pstats/snakeviz, в path + ".txt" - текстовый отчёт.
+    """
+
+    def __init__(self, path="profile", top=40):
+        self.path = path
+        self.top = top
+        self.metrics = None
+        self.__profile = cProfile.Profile()
+
+    def __enter__(self):
+        tracemalloc.start(25)
+        self.__profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.__profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.__profile.dump_stats(self.path + ".pstats")
+        report = io.StringIO()
+        report.write(f"Память (tracemalloc): сейчас {current / 1024 ** 2:.1f} МБ, пик {peak / 1024 ** 2:.1f} МБ\n")
+        report.write(f"Пиковый RSS: {max_rss_bytes() / 1024 ** 2:.1f} МБ\n\n")
+        if self.metrics is not None:
+            report.write("Стадии по всем потокам и процессам (Metrics):\n")
+            for stage, totals in self.metrics.stage_totals().items():
+                report.write(
+                    f"  {stage:>14}: {totals['seconds']:8.2f} с, вызовов {int(totals['calls'])}, "
+                    f"строк на входе {int(totals['rows_in'])}, на выходе {int(totals['rows_out'])}, "
+                    f"рост пикового RSS {totals['rss_growth_bytes'] / 1024 ** 2:.1f} МБ\n"
+                )
+            report.write("\n")
+        report.write(f"Больше всего памяти занимают (топ {self.top}):\n")
+        for statistic in snapshot.statistics("lineno")[: self.top]:
+            report.write(f"  {statistic}\n")
+        report.write("\nОсновной поток (cProfile):\n")
+        pstats.Stats(self.__profile, stream=report).sort_stats("cumulative").print_stats(self.top)
+        with open(self.path + ".txt", "w", encoding="utf-8") as file:
+            file.write(report.getvalue())
+        print(f"Профиль: {self.path}.txt, {self.path}.pstats (пик памяти {peak / 1024 ** 2:.1f} МБ)")
+        return False
@@ -0,0 +1,149 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+
+from file_ledger import FileLedger
+
+
+class ParseCache:
+    """
+    Кэш разобранных выгрузок 1С в Parquet (папка .parse_cache).
+
+    Ключ - формат файла (новый/старый), версия разбора и sha256 содержимого: изменившийся
+    файл или новая версия разбора дают промах. Хранится результат разбора чисел до отбора
+    магазинов по каналам и подстановки id, поэтому кэш не зависит от справочников: после их
+    обновления файл загружается заново без разбора текста.
+
+    Запись <ключ>/ - куски в том виде, как их отдавал разбор (part-00000.parquet, ...),
+    и meta.json: имя файла, формат, число строк и коды товаров, которых не было
+    в spr_product при последней подстановке id.
+
+    Каждая запись - полная копия выгрузки, поэтому prune() удаляет записи уже загруженных
+    файлов старше max_age секунд и, если кэш больше max_bytes, самые старые из них.
+    """
+
+    # Незавершённая запись (.tmp-...) старше этого - след упавшего разбора
+    TMP_MAX_AGE = 3600
+
+    def __init__(self, directory=".parse_cache", version=1, max_age=None, max_bytes=None):
+        self.directory = directory
+        self.version = version
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, path, old, sha256=None):
+        """sha256 - уже посчитанный хэш содержимого (FileLedger.fingerprint при чтении), иначе файл читается здесь"""
+        return f"{'old' if old else 'new'}-v{self.version}-{sha256 or FileLedger.file_hash(path)}"
+
+    def __meta_path(self, key):
+        return os.path.join(self.directory, key, "meta.json")
+
+    def read(self, key):
+        """Куски разобранного файла (генератор DataFrame) или None, если записи нет"""
+        entry = os.path.join(self.directory, key)
+        if not os.path.exists(self.__meta_path(key)):
+            return None
+        parts = sorted(name for name in os.listdir(entry) if name.endswith(".parquet"))
+        return (pd.read_parquet(os.path.join(entry, name)) for name in parts)
+
+    @contextmanager
+    def writer(self, key, file, old):
+        """
+        Запись кусков: with cache.writer(...) as add_part: add_part(df).
+        Пишем во временную папку и переименовываем только после последнего куска,
+        чтобы прерванный разбор не оставил неполную запись.
+        """
+        entry = os.path.join(self.directory, key)
+        tmp = f"{entry}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(tmp)
+        rows = []
+
+        def add_part(df):
+            df.to_parquet(os.path.join(tmp, f"part-{len(rows):05d}.parquet"), index=False)
+            rows.append(len(df))
+
+        try:
+            yield add_part
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        meta = {"file": file, "old": old, "version": self.version, "rows": sum(rows), "saved_at": time.time()}
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as meta_file:
+            json.dump(meta, meta_file, ensure_ascii=False)
+        with self.__lock:
+            # Тот же файл мог параллельно разобрать другой поток - оставляем одну запись
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp, entry)
+
+    def set_unknown_products(self, key, codes):
+        """Запомнить коды товаров файла, которых нет в spr_product"""
+        path = self.__meta_path(key)
+        with self.__lock:
+            if not os.path.exists(path):
+                return
+            with open(path, "r", encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+            meta["unknown_products"] = sorted(codes)
+            with open(path + ".tmp", "w", encoding="utf-8") as meta_file:
+                json.dump(meta, meta_file, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+
+    def entries(self):
+        """(ключ, meta) всех записей текущей версии разбора"""
+        for key in sorted(os.listdir(self.directory)):
+            meta = self.__read_meta(key)
+            if meta is not None and meta.get("version") == self.version:
+                yield key, meta
+
+    def prune(self, loaded):
+        """
+        Чистка кэша. Всегда удаляются записи прежних версий разбора и брошенные .tmp-папки.
+        Записи, для которых loaded(meta) - True (файл уже в журнале обработанных или удалён),
+        удаляются, если старше max_age секунд, а пока кэш больше max_bytes - начиная с самых старых.
+        Записи ещё не загруженных файлов не трогаем: их прочитает следующий запуск.
+        Возвращает (сколько записей удалено, сколько байт освобождено).
+        """
+        now = time.time()
+        removable, removed, freed, total = [], 0, 0, 0
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if not os.path.isdir(entry):
+                continue
+            size = sum(item.stat().st_size for item in os.scandir(entry) if item.is_file())
+            if ".tmp-" in name:
+                stale = now - os.path.getmtime(entry) > self.TMP_MAX_AGE
+            else:
+                meta = self.__read_meta(name)
+                stale = meta is None or meta.get("version") != self.version
+                if not stale and loaded(meta):
+                    saved_at = meta.get("saved_at", 0)
+                    stale = self.max_age is not None and now - saved_at > self.max_age
+                    if not stale:
+                        removable.append((saved_at, entry, size))
+            if stale:
+                shutil.rmtree(entry, ignore_errors=True)
+                removed, freed = removed + 1, freed + size
+            else:
+                total += size
+        if self.max_bytes is not None:
+            for _, entry, size in sorted(removable):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                removed, freed, total = removed + 1, freed + size, total - size
+        return removed, freed
+
+    def __read_meta(self, key):
+        path = self.__meta_path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as meta_file:
+            return json.load(meta_file)
@@ -0,0 +1,83 @@
+import queue
+import threading
+import time
+import traceback
+
+# Признак конца данных в очереди стадии
+_STOP = object()
+
+
+class Pipeline:
+    """
+    Конвейер из нескольких стадий на потоках с ограниченными очередями между ними.
+
+    stages - список (имя, функция, число потоков). Функция стадии получает элемент
+    от предыдущей стадии и возвращает элемент для следующей (результат последней
+    стадии отбрасывается). Пока одна стадия ждёт сеть или диск, другие работают
+    со своими файлами, поэтому время запуска стремится к времени самой медленной
+    стадии, а не к сумме всех. Очереди размером queue_size не дают быстрой стадии
+    набрать в память больше данных, чем успевает обработать следующая.
+
+    Ошибка на элементе не останавливает конвейер: вызывается on_error(элемент, ошибка),
+    элемент дальше не идёт.
+    """
+
+    def __init__(self, stages, queue_size=2, on_error=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self.__lock = threading.Lock()
+        # Сколько секунд потоки каждой стадии были заняты работой
+        self.busy_seconds = {name: 0.0 for name, _, _ in stages}
+
+    def run(self, items):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        alive = [workers for _, _, workers in self.stages]
+        threads = []
+        for index, (name, function, workers) in enumerate(self.stages):
+            for _ in range(workers):
+                thread = threading.Thread(
+                    target=self.__work,
+                    args=(index, name, function, queues, alive),
+                    name=f"{name}-{len(threads)}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        start = time.perf_counter()
+        for item in items:
+            queues[0].put(item)
+        for _ in range(alive[0]):
+            queues[0].put(_STOP)
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def __work(self, index, name, function, queues, alive):
+        last = index == len(self.stages) - 1
+        while True:
+            item = queues[index].get()
+            if item is _STOP:
+                break
+            start = time.perf_counter()
+            try:
+                result = function(item)
+            except Exception as error:
+                result = None
+                if self.on_error:
+                    self.on_error(item, error)
+                else:
+                    print(traceback.format_exc())
+            with self.__lock:
+                self.busy_seconds[name] += time.perf_counter() - start
+            if result is not None and not last:
+                queues[index + 1].put(result)
+
+        # Последний завершившийся поток стадии останавливает следующую стадию
+        with self.__lock:
+            alive[index] -= 1
+            finished = alive[index] == 0
+        if finished and not last:
+            for _ in range(alive[index + 1]):
+                queues[index + 1].put(_STOP)
@@ -1,29 +1,275 @@
 import os
+import struct
+import threading
+import uuid
 
+import numpy as np
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 from dotenv import load_dotenv
-from pandas import DataFrame
+from pandas import CategoricalDtype, DataFrame, concat, factorize
+from pandas.api.types import (
+    is_bool_dtype,
+    is_datetime64_any_dtype,
+    is_float_dtype,
+    is_integer_dtype,
+    union_categoricals,
+)
 
 load_dotenv()
 
+# Начало отсчёта timestamp в бинарном формате PostgreSQL (2000-01-01) в микросекундах от 1970-01-01
+PG_EPOCH_US = 946_684_800_000_000
+# Заголовок и конец потока COPY ... WITH (FORMAT binary)
+PG_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PG_COPY_TRAILER = struct.pack(">h", -1)
+
+
+class CopyStream:
+    """
+    Файлоподобный объект для cursor.copy_expert поверх генератора кусков bytes.
+
+    Данные готовятся по кускам по мере того, как psycopg2 их вычитывает,
+    поэтому в памяти одновременно только один кусок, а не весь CSV.
+    """
+
+    def __init__(self, chunks):
+        self.__chunks = iter(chunks)
+        self.__chunk = b""
+        self.__position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            rest = self.__chunk[self.__position:]
+            self.__chunk, self.__position = b"", 0
+            return rest + b"".join(self.__chunks)
+        parts = []
+        while size > 0:
+            if self.__position >= len(self.__chunk):
+                self.__chunk = next(self.__chunks, None)
+                self.__position = 0
+                if self.__chunk is None:
+                    self.__chunk = b""
+                    break
+            part = self.__chunk[self.__position:self.__position + size]
+            self.__position += len(part)
+            size -= len(part)
+            parts.append(part)
+        return b"".join(parts)
+
+
+def csv_chunks(df, chunk_rows=100_000):
+    """DataFrame кусками в CSV (пропуски - пустые поля, то есть NULL)"""
+    for start in range(0, len(df), chunk_rows):
+        chunk = PostConn.csv_frame(df.iloc[start:start + chunk_rows])
+        yield chunk.to_csv(index=False, header=False).encode("utf-8")
+
+
+def binary_chunks(df, chunk_rows=100_000):
+    """DataFrame кусками в бинарном формате COPY: только числа, даты и bool"""
+    yield PG_COPY_HEADER
+    for start in range(0, len(df), chunk_rows):
+        yield _binary_rows(df.iloc[start:start + chunk_rows])
+    yield PG_COPY_TRAILER
+
+
+def binary_sql_type(dtype):
+    """Тип столбца PostgreSQL, который принимает значения из binary_chunks"""
+    if is_bool_dtype(dtype):
+        return "BOOLEAN"
+    if is_integer_dtype(dtype):
+        return "BIGINT"
+    if is_float_dtype(dtype):
+        return "DOUBLE PRECISION"
+    if is_datetime64_any_dtype(dtype):
+        return "TIMESTAMPTZ" if getattr(dtype, "tz", None) is not None else "TIMESTAMP"
+    return None
+
+
+def _binary_column(series):
+    """Значения столбца numpy-массивом в порядке байт PostgreSQL и маска NULL"""
+    null = series.isna().to_numpy()
+    dtype = series.dtype
+    if is_bool_dtype(dtype):
+        return series.to_numpy(dtype="bool", na_value=False), null, "?"
+    if is_integer_dtype(dtype):
+        return series.to_numpy(dtype="int64", na_value=0), null, ">i8"
+    if is_float_dtype(dtype):
+        # NaN отправляем как NULL, как и в CSV
+        return series.to_numpy(dtype="float64", na_value=np.nan), null, ">f8"
+    if is_datetime64_any_dtype(dtype):
+        if getattr(dtype, "tz", None) is not None:
+            series = series.dt.tz_convert("UTC").dt.tz_localize(None)
+        values = series.to_numpy(dtype="datetime64[us]").view("int64") - PG_EPOCH_US
+        return values, null, ">i8"
+    raise ValueError(
+        f"COPY BINARY поддерживает только числа, даты и bool: столбец '{series.name}' ({dtype})"
+    )
+
+
+def _binary_rows(df):
+    """
+    Строки куска в бинарном формате COPY одним numpy-массивом.
+
+    Каждая строка - структура (число полей, [длина, значение]...). У NULL длина -1
+    и нет байтов значения, поэтому эти байты вырезаются маской перед склейкой.
+    """
+    rows = len(df)
+    fields = [("count", ">i2")]
+    columns = []
+    for index, column in enumerate(df.columns):
+        values, null, fmt = _binary_column(df[column])
+        fields += [(f"length{index}", ">i4"), (f"value{index}", fmt)]
+        columns.append((values, null))
+
+    data = np.zeros(rows, dtype=fields)
+    data["count"] = len(columns)
+    keep = None
+    for index, (values, null) in enumerate(columns):
+        value_dtype, offset = data.dtype.fields[f"value{index}"][:2]
+        data[f"length{index}"] = np.where(null, -1, value_dtype.itemsize)
+        data[f"value{index}"] = values
+        if null.any():
+            if keep is None:
+                keep = np.ones((rows, data.dtype.itemsize), dtype=bool)
+            keep[null, offset:offset + value_dtype.itemsize] = False
+
+    raw = data.view(np.uint8).reshape(rows, data.dtype.itemsize)
+    return raw.tobytes() if keep is None else raw[keep].tobytes()
+
+
+class LazyConnectionPool(ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool, который открывает подключения по мере надобности.
+    В psycopg2 minconn - и число подключений, открываемых сразу, и сколько свободных
+    подключений пул хранит (остальные закрывает при возврате). Здесь заранее ничего
+    не открывается, а хранятся до maxconn свободных подключений.
+    """
+
+    def __init__(self, maxconn, *args, **kwargs):
+        super().__init__(0, maxconn, *args, **kwargs)
+        self.minconn = maxconn
+
+
+def cursor_frames(cursor, chunk_size, dtypes=None):
+    """
+    Результат выполненного запроса кусками DataFrame по chunk_size строк.
+    dtypes - {столбец: тип} для astype каждого куска (например, "category" или "Int32").
+    Хотя бы один кусок отдаётся всегда, чтобы у пустого результата были столбцы.
+    """
+    columns = None
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if columns is None:
+            columns = [desc[0] for desc in cursor.description]
+        elif not rows:
+            break
+        frame = DataFrame(rows, columns=columns)
+        if dtypes:
+            frame = frame.astype({col: dtype for col, dtype in dtypes.items() if col in frame.columns})
+        yield frame
+        if not rows:
+            break
+
+
+def concat_frames(frames):
+    """
+    Склейка кусков. У категориальных столбцов в разных кусках разные категории,
+    pd.concat превратил бы их обратно в object - объединяем их через union_categoricals.
+    """
+    frames = list(frames)
+    if len(frames) == 1:
+        return frames[0]
+    categorical = [col for col in frames[0].columns if isinstance(frames[0][col].dtype, CategoricalDtype)]
+    df = concat([frame.drop(columns=categorical) for frame in frames], ignore_index=True)
+    for col in categorical:
+        df[col] = union_categoricals([frame[col] for frame in frames], ignore_order=True)
+    return df[frames[0].columns]
+
 
 class PostConn:
-    def __init__(self, db="test"):
+    # Сколько байт psycopg2 за раз читает из потока COPY
+    COPY_READ_SIZE = 1024 * 1024
+    # Общий пул подключений процесса (PostConn(pooled=True)). Не больше POSTGRES_POOL_SIZE
+    # подключений одновременно; если все заняты, ждём до POSTGRES_POOL_TIMEOUT секунд
+    _pool = None
+    _pool_pid = None
+    _pool_slots = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self, db="test", pooled=False):
 
         self.host = os.getenv("HOST")
         self.port = os.getenv("PORT")
         self.user = os.getenv("LOGIN")
         self.password = os.getenv("PASS")
         self.database = os.getenv("DATABASE_NAME")
-        self.conn = psycopg2.connect(
-            dbname=self.database,
-            user=self.user,
-            password=self.password,
-            host=self.host,
-            port=self.port,
-        )
+        self.pooled = pooled
+        if pooled:
+            self.conn = self.__checkout()
+        else:
+            self.conn = psycopg2.connect(**self.__connect_params())
+
+    def __connect_params(self):
+        return {
+            "dbname": self.database,
+            "user": self.user,
+            "password": self.password,
+            "host": self.host,
+            "port": self.port,
+        }
+
+    def __shared_pool(self):
+        cls = PostConn
+        with cls._pool_lock:
+            # После fork сокеты родительского пула трогать нельзя - у процесса свой пул
+            if cls._pool is None or cls._pool_pid != os.getpid():
+                size = int(os.getenv("POSTGRES_POOL_SIZE", "8"))
+                cls._pool = LazyConnectionPool(size, **self.__connect_params())
+                cls._pool_slots = threading.BoundedSemaphore(size)
+                cls._pool_pid = os.getpid()
+            return cls._pool, cls._pool_slots
+
+    def __checkout(self):
+        pool, slots = self.__shared_pool()
+        timeout = float(os.getenv("POSTGRES_POOL_TIMEOUT", "300"))
+        if not slots.acquire(timeout=timeout):
+            raise RuntimeError(f"Нет свободного подключения к PostgreSQL за {timeout} с")
+        try:
+            conn = pool.getconn()
+            if conn.closed:
+                # Подключение закрылось, пока лежало в пуле - берём новое
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        except Exception:
+            slots.release()
+            raise
+        self.__pool, self.__slots = pool, slots
+        return conn
+
+    @classmethod
+    def close_pool(cls):
+        """Закрывает все свободные подключения пула текущего процесса"""
+        with cls._pool_lock:
+            if cls._pool is not None and cls._pool_pid == os.getpid():
+                cls._pool.closeall()
+            cls._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def psycopg2_upsert(self, df: DataFrame, table_name="public.inventory_balance", method="values"):
+        """
+        UPSERT DataFrame в table_name по ключу (id_store, id_product, order_date, inn).
 
-    def psycopg2_upsert(self, df: DataFrame, table_name="public.inventory_balance"):
+        method : str, default 'values'
+            - 'values': INSERT ... VALUES через execute_values (DataFrame превращается в список кортежей)
+            - 'copy': COPY во временную таблицу и один INSERT ... SELECT ... ON CONFLICT
+              (для больших объёмов: данные уходят CSV-потоком, без построчных Python-объектов)
+        """
         connection = self.conn
         df.rename(
             columns={
@@ -54,6 +300,9 @@ class PostConn:
             if col not in df.columns:
                 raise ValueError(f"DataFrame должен содержать столбец '{col}'")
 
+        if method == "copy":
+            return self.__copy_upsert(df, table_name, key_columns)
+
         # Формируем строки для запроса
         columns = ", ".join(df.columns)
         update_set = ", ".join(
@@ -69,8 +318,8 @@ class PostConn:
         DO UPDATE SET {update_set}
         """
 
-        # Получаем данные из DataFrame как список кортежей
-        values = [tuple(row) for row in df.to_numpy()]
+        # Получаем данные из DataFrame как список кортежей (pd.NA psycopg2 не понимает - меняем на None)
+        values = [tuple(row) for row in df.astype(object).where(df.notna(), None).to_numpy()]
 
         # Выполняем запрос
         with connection.cursor() as cursor:
@@ -81,6 +330,39 @@ class PostConn:
 
         return len(values)  # Возвращаем количество обработанных строк
 
+    def __copy_upsert(self, df: DataFrame, table_name, key_columns):
+        """COPY во временную таблицу (удаляется при COMMIT) и слияние одним запросом"""
+        staging = "upsert_staging"
+        columns = ", ".join(df.columns)
+        update_set = ", ".join(
+            [f"{col} = excluded.{col}" for col in df.columns if col not in key_columns]
+        )
+
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE TEMP TABLE {staging} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP"
+                )
+                cursor.copy_expert(
+                    f"COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)",
+                    CopyStream(csv_chunks(df)),
+                    size=self.COPY_READ_SIZE,
+                )
+                cursor.execute(
+                    f"""
+                    INSERT INTO {table_name} ({columns})
+                    SELECT {columns} FROM {staging}
+                    ON CONFLICT ({", ".join(key_columns)})
+                    DO UPDATE SET {update_set}
+                    """
+                )
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        return len(df)
+
     def dataframe_to_db(
         self,
         df: DataFrame,
@@ -88,6 +370,9 @@ class PostConn:
         schema="public",
         if_exists="replace",
         method="insert",
+        binary=False,
+        chunk_rows=100_000,
+        assume_exists=False,
     ):
         """
         Передает DataFrame в указанную таблицу базы данных
@@ -109,6 +394,14 @@ class PostConn:
             Метод вставки данных:
             - 'insert': использовать INSERT запросы
             - 'copy': использовать PostgreSQL COPY (быстрее для больших объемов)
+        binary : bool, default False
+            Для method='copy': передавать данные в бинарном формате COPY вместо CSV.
+            Только для столбцов с числами, датами и bool; новая таблица создаётся
+            с типами BIGINT / DOUBLE PRECISION / TIMESTAMP / BOOLEAN
+        chunk_rows : int, default 100000
+            Сколько строк готовится и отправляется за раз (память не растёт с размером DataFrame)
+        assume_exists : bool, default False
+            При if_exists='append' не проверять существование таблицы (без лишних запросов)
 
         Возвращает:
         ----------
@@ -120,7 +413,47 @@ class PostConn:
 
         full_table_name = f"{schema}.{table_name}"
 
-        # Проверяем существование таблицы и создаем новую, если необходимо
+        if not (assume_exists and if_exists == "append"):
+            self.__prepare_table(df, full_table_name, if_exists, binary and method == "copy")
+
+        # Вставляем данные выбранным методом
+        columns = ", ".join(df.columns)
+        if method == "copy":
+            # Используем COPY метод: данные готовятся кусками по мере чтения
+            if binary:
+                stream = CopyStream(binary_chunks(df, chunk_rows))
+                copy_format = "binary"
+            else:
+                stream = CopyStream(csv_chunks(df, chunk_rows))
+                copy_format = "csv"
+            with self.conn.cursor() as cursor:
+                cursor.copy_expert(
+                    f"COPY {full_table_name} ({columns}) FROM STDIN WITH (FORMAT {copy_format})",
+                    stream,
+                    size=self.COPY_READ_SIZE,
+                )
+                self.conn.commit()
+        else:
+            # Используем INSERT метод
+            placeholders = ", ".join(["%s"] * len(df.columns))
+            insert_query = (
+                f"INSERT INTO {full_table_name} ({columns}) VALUES ({placeholders})"
+            )
+
+            from psycopg2.extras import execute_batch
+
+            with self.conn.cursor() as cursor:
+                # Кортежи строим по кускам, а не на весь DataFrame сразу
+                for start in range(0, len(df), chunk_rows):
+                    chunk = df.iloc[start:start + chunk_rows]
+                    records = [tuple(row) for row in chunk.astype(object).where(chunk.notna(), None).to_numpy()]
+                    execute_batch(cursor, insert_query, records)
+                self.conn.commit()
+
+        return len(df)
+
+    def __prepare_table(self, df: DataFrame, full_table_name, if_exists, binary):
+        """Проверяем существование таблицы и создаем новую, если необходимо"""
         with self.conn.cursor() as cursor:
             cursor.execute(f"SELECT to_regclass('{full_table_name}')")
             table_exists = cursor.fetchone()[0] is not None
@@ -138,7 +471,14 @@ class PostConn:
                 columns_with_types = []
                 for col in df.columns:
                     dtype = df[col].dtype
-                    if "int" in str(dtype):
+                    if binary:
+                        # Бинарный COPY требует точного совпадения типов
+                        col_type = binary_sql_type(dtype)
+                        if col_type is None:
+                            raise ValueError(
+                                f"COPY BINARY поддерживает только числа, даты и bool: столбец '{col}' ({dtype})"
+                            )
+                    elif "int" in str(dtype):
                         col_type = "INTEGER"
                     elif "float" in str(dtype):
                         col_type = "NUMERIC"
@@ -154,43 +494,21 @@ class PostConn:
                 cursor.execute(create_table_sql)
                 self.conn.commit()
 
-        # Вставляем данные выбранным методом
-        if method == "copy":
-            # Используем COPY метод
-            from io import StringIO
-            import csv
-
-            # Создаем буфер для данных
-            buffer = StringIO()
-            df.to_csv(buffer, index=False, header=False, quoting=csv.QUOTE_MINIMAL)
-            buffer.seek(0)
-
-            # Выполняем COPY
-            with self.conn.cursor() as cursor:
-                cursor.copy_expert(
-                    f"COPY {full_table_name} ({', '.join(df.columns)}) FROM STDIN WITH CSV",
-                    buffer,
-                )
-                self.conn.commit()
-        else:
-            # Используем INSERT метод
-            columns = ", ".join(df.columns)
-            placeholders = ", ".join(["%s"] * len(df.columns))
-            insert_query = (
-                f"INSERT INTO {full_table_name} ({columns}) VALUES ({placeholders})"
-            )
-
-            records = [tuple(row) for row in df.to_numpy()]
-
-            with self.conn.cursor() as cursor:
-                from psycopg2.extras import execute_batch
-
-                execute_batch(cursor, insert_query, records)
-                self.conn.commit()
-
-        return len(df)
-
-    def fetch_to_dataframe(self, query: str, params=None) -> DataFrame:
+    @staticmethod
+    def csv_frame(df: DataFrame) -> DataFrame:
+        """
+        Готовит DataFrame к выгрузке в CSV для COPY: даты форматируются один раз
+        на уникальное значение (в файле остатков дата одна), а не на каждую строку.
+        """
+        df = df.copy(deep=False)
+        for col in df.columns:
+            if is_datetime64_any_dtype(df[col].dtype):
+                codes, uniques = factorize(df[col])
+                formatted = np.append(np.asarray(uniques.astype(str), dtype=object), None)
+                df[col] = formatted.take(codes)
+        return df
+
+    def fetch_to_dataframe(self, query: str, params=None, chunk_size=None, dtypes=None) -> DataFrame:
         """
         Выполняет SQL-запрос и возвращает результаты в виде pandas DataFrame.
 
@@ -200,12 +518,20 @@ class PostConn:
             SQL-запрос для выполнения.
         params : tuple или dict, optional
             Параметры для подстановки в SQL-запрос (если есть).
+        chunk_size : int, optional
+            Читать результат серверным курсором по chunk_size строк (см. fetch_chunks):
+            в памяти не держится весь список кортежей одновременно с DataFrame.
+        dtypes : dict, optional
+            Типы столбцов {столбец: тип}, например "category" для названий и "Int32" для id.
 
         Возвращает:
         ----------
         DataFrame
             Результаты запроса в виде pandas DataFrame.
         """
+        if chunk_size:
+            return concat_frames(self.fetch_chunks(query, params, chunk_size, dtypes))
+
         with self.conn.cursor() as cursor:
             cursor.execute(query, params)
             columns = [
@@ -213,7 +539,30 @@ class PostConn:
             ]  # Получаем имена столбцов
             data = cursor.fetchall()
 
-        return DataFrame(data, columns=columns)
+        df = DataFrame(data, columns=columns)
+        if dtypes:
+            df = df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
+        return df
+
+    def fetch_chunks(self, query: str, params=None, chunk_size=50_000, dtypes=None):
+        """
+        Выполняет SELECT серверным (именованным) курсором и отдаёт результат кусками DataFrame.
+        С сервера за раз приходит chunk_size строк (itersize), а не весь результат.
+        """
+        with self.conn.cursor(name=f"fetch_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(query, params)
+            yield from cursor_frames(cursor, chunk_size, dtypes)
     def close(self):
-        if self.conn:
-            self.conn.close()
\ No newline at end of file
+        if not self.conn:
+            return
+        if self.pooled:
+            # Незавершённую транзакцию пул откатывает сам
+            if not self.__pool.closed:
+                self.__pool.putconn(self.conn, close=bool(self.conn.closed))
+            else:
+                self.conn.close()
+            self.__slots.release()
+        else:
+            self.conn.close()
+        self.conn = None
\ No newline at end of file
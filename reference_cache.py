@@ -0,0 +1,99 @@
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from postgress_connect import PostConn
+
+
+class ReferenceCache:
+    """
+    Локальный кэш справочников PostgreSQL в Parquet.
+
+    Для каждой таблицы рядом с данными лежит <table>.json с отпечатком таблицы
+    (количество строк и сумма хэшей выбираемых столбцов, считается на стороне сервера).
+    При старте отпечатки всех таблиц запрашиваются одновременно, и заново
+    выгружаются только таблицы, у которых отпечаток изменился или кэш старше ttl секунд.
+    """
+
+    def __init__(self, directory=".reference_cache", ttl=None):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(self.directory, exist_ok=True)
+
+    def load(self, tables, fetch):
+        """
+        tables - {имя: (список столбцов, таблица, db)},
+        fetch(columns_list, table, db) - выгрузка таблицы из PostgreSQL, если кэш не подошёл.
+        Таблицы с промахом выгружаются одновременно. Возвращает {имя: DataFrame}.
+        """
+        fingerprints = self.__fingerprints(tables)
+        result = {}
+        misses = []
+        for name, (columns_list, table, db) in tables.items():
+            df = self.__read(table, columns_list, fingerprints.get(table))
+            if df is not None:
+                print(f"[кэш] {table}: попадание, {len(df)} строк")
+                result[name] = df
+            else:
+                print(f"[кэш] {table}: промах, выгружаем из PostgreSQL")
+                misses.append(name)
+
+        def fetch_and_save(name):
+            columns_list, table, db = tables[name]
+            df = fetch(columns_list, table, db)
+            self.__write(table, columns_list, fingerprints.get(table), df)
+            return df
+
+        if misses:
+            with ThreadPoolExecutor(max_workers=len(misses)) as executor:
+                result.update(zip(misses, executor.map(fetch_and_save, misses)))
+        return {name: result[name] for name in tables}
+
+    def __fingerprints(self, tables):
+        """Отпечатки всех таблиц, запросы идут одновременно. При ошибке отпечаток None - таблица выгрузится заново"""
+        targets = [(columns_list, table) for columns_list, table, _ in tables.values()]
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            fingerprints = executor.map(lambda target: self.__fingerprint(*target), targets)
+            return {table: fingerprint for (_, table), fingerprint in zip(targets, fingerprints)}
+
+    def __fingerprint(self, columns_list, table):
+        columns = ", ".join(f"{column}::text" for column in columns_list)
+        query = f"""SELECT count(*), coalesce(sum(hashtext(concat_ws('|', {columns}))), 0) FROM {table}"""
+        try:
+            with PostConn(pooled=True) as conn:
+                count, checksum = conn.fetch_to_dataframe(query).iloc[0]
+            return f"{int(count)}:{int(checksum)}"
+        except Exception:
+            print(traceback.format_exc())
+            return None
+
+    def __paths(self, table):
+        base = os.path.join(self.directory, table)
+        return base + ".parquet", base + ".json"
+
+    def __read(self, table, columns_list, fingerprint):
+        data_path, meta_path = self.__paths(table)
+        if fingerprint is None or not os.path.exists(data_path) or not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        if meta.get("fingerprint") != fingerprint or meta.get("columns") != columns_list:
+            return None
+        if self.ttl is not None and time.time() - meta.get("saved_at", 0) > self.ttl:
+            return None
+        return pd.read_parquet(data_path)
+
+    def __write(self, table, columns_list, fingerprint, df):
+        if fingerprint is None:
+            return
+        data_path, meta_path = self.__paths(table)
+        # Пишем во временные файлы и переименовываем, чтобы не оставить полузаписанный кэш
+        df.to_parquet(data_path + ".tmp", index=False)
+        os.replace(data_path + ".tmp", data_path)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump({"fingerprint": fingerprint, "columns": columns_list, "saved_at": time.time()}, file)
+        os.replace(meta_path + ".tmp", meta_path)
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+
+class KeyIndex:
+    """
+    Словарь "ключ -> значение" по одному справочнику.
+
+    Ключи лежат в pd.Index (хэш-таблица строится один раз), значения - в numpy-массиве
+    с дописанным в конец NaN: get_indexer отдаёт -1 для ненайденных ключей,
+    и take(-1) сразу даёт пропуск, как левое соединение pd.merge.
+    Для категориальных ключей ищутся только категории, а по строкам значения раскладываются по кодам.
+    """
+
+    def __init__(self, df, key_column, value_column, table):
+        duplicated = df[key_column].duplicated(keep=False)
+        if duplicated.any():
+            # pd.merge размножил бы такие строки, здесь берём первое значение
+            examples = df.loc[duplicated, key_column].drop_duplicates().head(5).tolist()
+            print(
+                f"[!] В справочнике {table} повторяются ключи {key_column}: "
+                f"{df.loc[duplicated, key_column].nunique()} шт., например {examples}. Берём первое значение"
+            )
+        unique = df.drop_duplicates(key_column, keep="first")
+        self.index = pd.Index(unique[key_column])
+        values = unique[value_column].to_numpy()
+        if pd.api.types.is_numeric_dtype(values.dtype):
+            values = values.astype("float64")
+        else:
+            values = values.astype(object)
+        self.values = np.append(values, np.nan)
+
+    def get(self, keys):
+        if isinstance(keys.dtype, pd.CategoricalDtype):
+            # У пропуска код -1 - попадает на дописанный в конец NaN
+            found = self.values.take(self.index.get_indexer(keys.cat.categories))
+            return np.append(found, np.nan).take(keys.cat.codes.to_numpy())
+        return self.values.take(self.index.get_indexer(keys))
+
+
+class ReferenceLookup:
+    """Подстановка id товара, магазина, ИНН и канала продаж из справочников вместо цепочки pd.merge"""
+
+    CHANNELS = ["Франшиза в аренду", "Франшиза инвестиционная", "ФРС"]
+
+    def __init__(self, store, store_channel, product, inn, channels=None):
+        self.product = KeyIndex(product, "id_product_code", "id_product", "spr_product")
+        self.store = KeyIndex(store, "search_store", "id_store_rename", "spr_store_rename")
+        self.inn = KeyIndex(inn, "search_entity", "inn", "spr_legal_entity_rename")
+        self.store_channel = KeyIndex(store_channel, "id_store", "channel", "spr_store")
+        self.channels = list(self.CHANNELS if channels is None else channels)
+        # Названия магазинов нужных каналов (spr_store_rename + spr_store.channel):
+        # по ним строки отбрасываются сразу после чтения файла, до разбора чисел и поиска id
+        channel = pd.Series(self.store_channel.get(self.store.values[:-1]))
+        self.allowed_stores = self.store.index[channel.isin(self.channels).to_numpy()]
+
+    def store_mask(self, stores):
+        """Маска строк, магазины которых относятся к нужным каналам"""
+        return stores.isin(self.allowed_stores).to_numpy()
+
+    def unknown_stores(self, stores):
+        """Названия магазинов, которых нет в spr_store_rename"""
+        unique = pd.Index(stores.dropna().unique())
+        return unique[~unique.isin(self.store.index)]
+
+    def resolve(self, df, product_column, store_column="Магазин", entity_column="Организация"):
+        """
+        Возвращает маску строк магазинов нужных каналов и словарь
+        {id_product, id_store_rename, inn} с массивами только для этих строк.
+        id_product для ненайденных товаров - NaN, как после левого соединения.
+        """
+        id_store = self.store.get(df[store_column])
+        mask = pd.Series(self.store_channel.get(id_store)).isin(self.channels).to_numpy()
+        # take по номерам строк сохраняет категории (берутся только коды)
+        rows = np.flatnonzero(mask)
+        return mask, {
+            "id_product": self.product.get(df[product_column].take(rows)),
+            "id_store_rename": id_store[mask],
+            "inn": self.inn.get(df[entity_column].take(rows)),
+        }
@@ -0,0 +1,160 @@
+"""
+Досылка строк в ClickHouse (ClickHouseConnection.clickhouse_add_rows, используется repair_unmatched):
+суммы по ключу складываются с уже загруженными, остальные строки дат и партиций не меняются,
+при ошибке таблица остаётся прежней, а размер запросов не зависит от числа строк.
+
+Сервер заменён FakeClickHouseClient: таблицы - DataFrame, партиция - месяц order_date,
+разбираются только запросы, которые отправляют clickhouse_add_rows и clickhouse_replace_partitions.
+
+Запуск: python -m pytest -q test_add_rows.py
+"""
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from click_house_connect import ClickHouseConnection
+
+KEY_COLUMNS = ["id_product", "id_store", "inn", "order_date"]
+VALUE_COLUMNS = ["opening_balance", "opening_balance_price", "final_balance_price", "final_balance"]
+
+
+def dates_in(text):
+    return [pd.Timestamp(date) for date in re.findall(r"'(\d{4}-\d{2}-\d{2})'", text)]
+
+
+def partition(df):
+    return df["order_date"].dt.strftime("%Y%m")
+
+
+class FakeClickHouseClient:
+    """Клиент clickhouse_driver поверх словаря таблиц server["tables"]"""
+
+    class Transport:
+        connected = False
+
+    def __init__(self, server):
+        self.server = server
+        self.connection = self.Transport()
+
+    def execute(self, query, params=None, with_column_types=False, columnar=False, settings=None):
+        self.server["queries"].append(query)
+        if query.startswith(self.server["fail_on"] or "\0"):
+            raise RuntimeError(f"Запрос не прошёл: {query[:40]}")
+        tables = self.server["tables"]
+        result = []
+        if match := re.fullmatch(r"CREATE TABLE IF NOT EXISTS (\w+) AS (\w+)", query):
+            tables.setdefault(match[1], tables[match[2]].iloc[:0].copy())
+        elif match := re.fullmatch(r"TRUNCATE TABLE (\w+)", query):
+            tables[match[1]] = tables[match[1]].iloc[:0]
+        elif match := re.fullmatch(r"INSERT INTO (\w+) \(([\w, ]+)\) VALUES", query):
+            df = pd.DataFrame(dict(zip(match[2].split(", "), params)))
+            self.__append(match[1], df.astype({column: "float64" for column in VALUE_COLUMNS}))
+        elif match := re.fullmatch(
+            r"INSERT INTO (\w+) \([\w, ]+\) SELECT .* FROM \(SELECT [\w, ]+ FROM (\w+) "
+            r"WHERE toDate\(order_date\) IN \(([^)]*)\) UNION ALL SELECT [\w, ]+ FROM (\w+)\) GROUP BY [\w, ]+",
+            query,
+        ):
+            current = tables[match[2]]
+            current = current[current["order_date"].isin(dates_in(match[3]))]
+            df = pd.concat([current, tables[match[4]]], ignore_index=True)
+            # sum по Nullable: NULL пропускаются, из одних NULL получается NULL
+            df = df.groupby(KEY_COLUMNS, as_index=False)[VALUE_COLUMNS].sum(min_count=1)
+            self.__append(match[1], df.round(3))
+        elif match := re.fullmatch(r"SELECT DISTINCT _partition_id FROM (\w+)", query):
+            result = [(value,) for value in partition(tables[match[1]]).unique()]
+        elif match := re.fullmatch(
+            r"INSERT INTO (\w+) SELECT \* FROM (\w+) WHERE _partition_id IN \(([^)]*)\) "
+            r"AND toDate\(order_date\) NOT IN \(([^)]*)\)",
+            query,
+        ):
+            source = tables[match[2]]
+            keep = partition(source).isin(re.findall(r"'(\w+)'", match[3])) & ~source["order_date"].isin(
+                dates_in(match[4])
+            )
+            self.__append(match[1], source[keep])
+        elif match := re.fullmatch(r"ALTER TABLE (\w+) (REPLACE PARTITION .*)", query):
+            table = tables[match[1]]
+            for partition_id, staging in re.findall(r"REPLACE PARTITION ID '(\w+)' FROM (\w+)", match[2]):
+                rows = tables[staging][partition(tables[staging]) == partition_id]
+                table = pd.concat([table[partition(table) != partition_id], rows], ignore_index=True)
+            tables[match[1]] = table
+        else:
+            raise AssertionError(f"FakeClickHouseClient не знает запрос: {query}")
+        return (result, [("result", "String")]) if with_column_types else result
+
+    def __append(self, table, df):
+        tables = self.server["tables"]
+        tables[table] = pd.concat([tables[table], df[list(tables[table].columns)]], ignore_index=True)
+
+    def disconnect(self):
+        pass
+
+
+def remnants(keys, seed):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(keys, columns=KEY_COLUMNS).astype({"order_date": "datetime64[ns]"})
+    for column in VALUE_COLUMNS:
+        df[column] = rng.integers(1, 10_000, len(df)) / 100
+    return df
+
+
+def sorted_table(df):
+    df = df.copy()
+    df[VALUE_COLUMNS] = df[VALUE_COLUMNS].fillna(0).round(3)
+    return df.sort_values(KEY_COLUMNS).reset_index(drop=True)[KEY_COLUMNS + VALUE_COLUMNS]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(ClickHouseConnection, "_click", None)
+    click = ClickHouseConnection()
+    server = {"tables": {}, "queries": [], "fail_on": None}
+    monkeypatch.setattr(click, "create_connection", lambda use_numpy=False: FakeClickHouseClient(server))
+    server["click"] = click
+    # 01.03 и 02.03 - одна партиция (месяц), 01.04 - другая
+    server["tables"]["remnants"] = remnants(
+        [
+            (product, store, 7700000000.0, date)
+            for date in ("2025-03-01", "2025-03-02", "2025-04-01")
+            for product in range(1, 101)
+            for store in range(1, 51)
+        ],
+        seed=1,
+    )
+    return server
+
+
+def test_add_rows_sums_keys_and_keeps_other_dates(server):
+    before = server["tables"]["remnants"].copy()
+    # Половина ключей уже есть в таблице (тот же id у другого кода товара), половина новые; 20 000 строк
+    delta = remnants(
+        [(product, store, 7700000000.0, "2025-03-01") for product in range(51, 251) for store in range(1, 101)],
+        seed=2,
+    )
+
+    assert server["click"].clickhouse_add_rows("remnants", "remnants_repair", delta, KEY_COLUMNS)
+
+    expected = pd.concat([before, delta], ignore_index=True)
+    expected = expected.groupby(KEY_COLUMNS, as_index=False)[VALUE_COLUMNS].sum()
+    pd.testing.assert_frame_equal(sorted_table(server["tables"]["remnants"]), sorted_table(expected))
+    # Ключи в текст запросов не попадают: max_query_size ClickHouse по умолчанию - 256 КиБ
+    assert max(len(query) for query in server["queries"]) < 2000
+
+
+@pytest.mark.parametrize("fail_on", ["INSERT INTO remnants_repair_delta", "INSERT INTO remnants_repair (", "ALTER"])
+def test_add_rows_failure_keeps_table(server, fail_on):
+    before = server["tables"]["remnants"].copy()
+    server["fail_on"] = fail_on
+    delta = remnants([(1, 1, 7700000000.0, "2025-03-01"), (500, 1, 7700000000.0, "2025-03-01")], seed=3)
+
+    assert not server["click"].clickhouse_add_rows("remnants", "remnants_repair", delta, KEY_COLUMNS)
+
+    pd.testing.assert_frame_equal(server["tables"]["remnants"], before)
+    # Повтор после ошибки начинает с пустых staging-таблиц и прибавляет строки один раз
+    server["fail_on"] = None
+    assert server["click"].clickhouse_add_rows("remnants", "remnants_repair", delta, KEY_COLUMNS)
+    expected = pd.concat([before, delta], ignore_index=True)
+    expected = expected.groupby(KEY_COLUMNS, as_index=False)[VALUE_COLUMNS].sum()
+    pd.testing.assert_frame_equal(sorted_table(server["tables"]["remnants"]), sorted_table(expected))
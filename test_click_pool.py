@@ -0,0 +1,76 @@
+"""
+Пул подключений ClickHouseConnection: проверка простаивавшего подключения (ping)
+не должна терять место в пуле, даже если ping или disconnect бросают исключение.
+
+Запуск: python -m pytest -q test_click_pool.py
+"""
+import pytest
+from clickhouse_driver import errors
+
+from click_house_connect import ClickHouseConnection
+
+
+class FakeTransport:
+    def __init__(self, ping_error=None):
+        self.connected = True
+        self.is_query_executing = False
+        self.ping_error = ping_error
+
+    def ping(self):
+        if self.ping_error is not None:
+            raise self.ping_error
+        return True
+
+
+class FakeClient:
+    def __init__(self, ping_error=None, disconnect_error=None):
+        self.connection = FakeTransport(ping_error)
+        self.disconnect_error = disconnect_error
+        self.disconnects = 0
+
+    def disconnect(self):
+        self.disconnects += 1
+        if self.disconnect_error is not None:
+            raise self.disconnect_error
+        self.connection.connected = False
+
+
+@pytest.fixture
+def click(monkeypatch):
+    monkeypatch.setattr(ClickHouseConnection, "_click", None)
+    click = ClickHouseConnection()
+    click.max_pool_size = 1
+    click.pool_timeout = 0.1
+    # Каждое свободное подключение перед выдачей проверяется
+    click.health_check_interval = -1
+    return click
+
+
+def test_unexpected_packet_on_ping_reconnects(click, monkeypatch):
+    client = FakeClient(ping_error=errors.UnexpectedPacketFromServerError("Unexpected packet from server"))
+    monkeypatch.setattr(click, "create_connection", lambda use_numpy=False: client)
+    with click.connection():
+        pass
+
+    with click.connection() as connection:
+        assert connection is client
+        assert client.disconnects == 1
+
+    assert click.pool_stats()["reconnects"] == 1
+    assert click.pool_stats()["opened"] == 1
+
+
+def test_failed_disconnect_releases_slot(click, monkeypatch):
+    broken = FakeClient(ping_error=EOFError(), disconnect_error=OSError("Bad file descriptor"))
+    clients = [broken, FakeClient()]
+    monkeypatch.setattr(click, "create_connection", lambda use_numpy=False: clients.pop(0))
+    with click.connection():
+        pass
+
+    with pytest.raises(OSError):
+        click.get_connection()
+
+    # Место сломанного подключения свободно: новое создаётся сразу, без TimeoutError
+    assert click.pool_stats()["opened"] == 0
+    with click.connection() as connection:
+        assert connection is not broken
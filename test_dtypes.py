@@ -0,0 +1,70 @@
+"""
+Типы столбцов по стадиям обработки файла: READ_DTYPES после чтения, PARSED_DTYPES после
+разбора чисел, RESOLVED_DTYPES после подстановки id. Синтетическая выгрузка из benchmark.py
+проходит весь путь без баз - целиком и кусками, в новом и старом формате.
+
+Запуск: python -m pytest -q test_dtypes.py
+"""
+import os
+
+import pytest
+
+from benchmark import CaptureClickHouse, synthetic_reference, write_export
+from work_data_itog import WorkForData
+
+
+def wrong_dtypes(df, schema):
+    return {
+        column: f"{df[column].dtype} вместо {dtype}"
+        for column, dtype in schema.items()
+        if column in df.columns and df[column].dtype != dtype
+    }
+
+
+@pytest.fixture
+def checked_stages(monkeypatch):
+    """Оборачивает стадии разбора и подстановки id; возвращает найденные расхождения по стадиям"""
+    found = {"чтение": [], "разбор чисел": [], "подстановка id": []}
+    parse_part = WorkForData._WorkForData__parse_part
+    resolve_ids = WorkForData._WorkForData__resolve_ids
+
+    def checked_parse_part(self, df, file):
+        found["чтение"].append(wrong_dtypes(df, WorkForData.READ_DTYPES))
+        df = parse_part(self, df, file)
+        found["разбор чисел"].append(wrong_dtypes(df, WorkForData.PARSED_DTYPES))
+        return df
+
+    def checked_resolve_ids(self, df, file, code_column):
+        df = resolve_ids(self, df, file, code_column)
+        found["подстановка id"].append(wrong_dtypes(df, WorkForData.RESOLVED_DTYPES))
+        return df
+
+    monkeypatch.setattr(WorkForData, "_WorkForData__parse_part", checked_parse_part)
+    monkeypatch.setattr(WorkForData, "_WorkForData__resolve_ids", checked_resolve_ids)
+    return found
+
+
+@pytest.mark.parametrize("old", [False, True], ids=["new", "old"])
+@pytest.mark.parametrize("chunk_size", [None, 700], ids=["whole", "chunks"])
+def test_stage_dtypes(tmp_path, monkeypatch, checked_stages, chunk_size, old):
+    monkeypatch.chdir(tmp_path)
+    write_export(tmp_path / "01.03.2025.txt", 3000, products=500, old=old)
+    work = WorkForData(
+        reference=synthetic_reference(products=500),
+        reference_cache=None,
+        path_to_directory=str(tmp_path),
+        path_to_directory_old=str(tmp_path),
+        load_old_files=old,
+        chunk_size=chunk_size,
+        ledger_path=os.path.join(tmp_path, "ledger.sqlite3"),
+        unmatched_store=None,
+    )
+    work.click_house = CaptureClickHouse()
+    work.process_file("01.03.2025.txt", old=old)
+
+    assert work.click_house.df is not None and len(work.click_house.df)
+    for stage, problems in checked_stages.items():
+        assert problems, f"стадия '{stage}' не вызывалась"
+        assert not any(problems), f"типы после стадии '{stage}' не по схеме: {problems}"
+    if chunk_size:
+        assert len(checked_stages["чтение"]) > 1
@@ -0,0 +1,33 @@
+"""
+Журнал обработанных файлов (FileLedger): отметка по отпечатку, снятому при чтении,
+и файлы, пропавшие между listdir и проверкой.
+
+Запуск: python -m pytest -q test_file_ledger.py
+"""
+from file_ledger import FileLedger
+
+
+def test_rewritten_after_read_is_not_processed(tmp_path):
+    ledger = FileLedger(str(tmp_path / "ledger.sqlite3"), legacy_csv=None)
+    path = tmp_path / "01.03.2025.txt"
+    path.write_text("первая выгрузка\n", encoding="utf-8")
+    fingerprint = FileLedger.fingerprint(str(path))
+    # 1С перезаписала файл, пока его данные ждали вставки
+    path.write_text("вторая выгрузка, длиннее\n", encoding="utf-8")
+
+    ledger.mark(str(path), fingerprint)
+
+    assert not ledger.is_processed(str(path))
+    ledger.mark(str(path))
+    assert ledger.is_processed(str(path))
+
+
+def test_missing_file_is_not_processed(tmp_path):
+    ledger = FileLedger(str(tmp_path / "ledger.sqlite3"), legacy_csv=None)
+    path = tmp_path / "01.03.2025.txt"
+    path.write_text("выгрузка\n", encoding="utf-8")
+    ledger.mark(str(path))
+
+    path.unlink()
+
+    assert not ledger.is_processed(str(path))
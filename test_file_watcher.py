@@ -0,0 +1,33 @@
+"""
+FileWatcher без inotify (не Linux или нет libc) переходит к сканированию папок, а не падает.
+
+Запуск: python -m pytest -q test_file_watcher.py
+"""
+import ctypes
+import sys
+
+import file_watcher
+from file_watcher import FileWatcher
+
+
+def test_not_linux_falls_back_to_polling(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "platform", "win32")
+    watcher = FileWatcher([str(tmp_path)], settle_seconds=0, poll_interval=0)
+    assert watcher.mode == "polling"
+    watcher.close()
+
+
+def test_libc_load_type_error_falls_back_to_polling(tmp_path, monkeypatch):
+    def no_libc(name, use_errno=False):
+        raise TypeError("LoadLibrary() argument 1 must be str, not None")
+
+    monkeypatch.setattr(file_watcher.ctypes.util, "find_library", lambda name: None)
+    monkeypatch.setattr(file_watcher.ctypes, "CDLL", no_libc)
+    watcher = FileWatcher([str(tmp_path)], settle_seconds=0, poll_interval=0)
+    assert watcher.mode == "polling"
+    (tmp_path / "01.03.2025.txt").write_text("выгрузка\n", encoding="utf-8")
+    ready = []
+    for _ in range(5):
+        ready += watcher.wait(timeout=0.2)
+    assert ready == [str(tmp_path / "01.03.2025.txt")]
+    watcher.close()
@@ -0,0 +1,81 @@
+"""
+Чистка кэша разбора (ParseCache.prune): удаляются только записи загруженных файлов -
+по возрасту и по размеру кэша, а также записи прежних версий разбора; sha256 файла
+считается один раз на загрузку.
+
+Запуск: python -m pytest -q test_parse_cache.py
+"""
+import json
+import os
+import time
+
+import pandas as pd
+
+from benchmark import CaptureClickHouse, synthetic_reference, write_export
+from file_ledger import FileLedger
+from parse_cache import ParseCache
+from work_data_itog import WorkForData
+
+
+def add_entry(cache, file, sha256, saved_at, rows=1000):
+    key = cache.key(None, old=False, sha256=sha256)
+    with cache.writer(key, file, old=False) as add_part:
+        add_part(pd.DataFrame({"value": range(rows)}))
+    meta_path = os.path.join(cache.directory, key, "meta.json")
+    with open(meta_path, "r", encoding="utf-8") as meta_file:
+        meta = json.load(meta_file)
+    meta["saved_at"] = saved_at
+    with open(meta_path, "w", encoding="utf-8") as meta_file:
+        json.dump(meta, meta_file)
+    return key
+
+
+def test_prune_by_age_keeps_files_not_loaded(tmp_path):
+    cache = ParseCache(str(tmp_path), max_age=3600)
+    old_loaded = add_entry(cache, "01.03.2025.txt", "a" * 64, time.time() - 7200)
+    old_pending = add_entry(cache, "02.03.2025.txt", "b" * 64, time.time() - 7200)
+    fresh_loaded = add_entry(cache, "03.03.2025.txt", "c" * 64, time.time())
+    stale_version = add_entry(ParseCache(str(tmp_path), version=0), "04.03.2025.txt", "d" * 64, time.time())
+
+    removed, freed = cache.prune(lambda meta: meta["file"] != "02.03.2025.txt")
+
+    assert removed == 2 and freed > 0
+    assert sorted(os.listdir(tmp_path)) == sorted([old_pending, fresh_loaded])
+    assert stale_version not in os.listdir(tmp_path) and old_loaded not in os.listdir(tmp_path)
+
+
+def test_prune_by_size_removes_oldest_loaded(tmp_path):
+    cache = ParseCache(str(tmp_path))
+    keys = [add_entry(cache, f"0{day}.03.2025.txt", str(day) * 64, time.time() - 100 * (10 - day)) for day in range(1, 5)]
+    entry_size = sum(item.stat().st_size for item in os.scandir(tmp_path / keys[0]))
+    cache.max_bytes = int(entry_size * 2.5)
+
+    removed, _ = cache.prune(lambda meta: True)
+
+    assert removed == 2
+    assert sorted(os.listdir(tmp_path)) == sorted(keys[2:])
+
+
+def test_load_hashes_file_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_export(tmp_path / "01.03.2025.txt", 3000, products=500)
+    work = WorkForData(
+        reference=synthetic_reference(products=500),
+        reference_cache=None,
+        path_to_directory=str(tmp_path),
+        path_to_directory_old=str(tmp_path),
+        ledger_path=os.path.join(tmp_path, "ledger.sqlite3"),
+        unmatched_store=None,
+        parse_cache=str(tmp_path / "cache"),
+    )
+    work.click_house = CaptureClickHouse()
+    hashed = []
+    file_hash = FileLedger.file_hash
+    monkeypatch.setattr(FileLedger, "file_hash", staticmethod(lambda path: hashed.append(path) or file_hash(path)))
+
+    work.process_file("01.03.2025.txt", old=False)
+
+    # Один sha256 на загрузку: ключ кэша и отметка в журнале берут его из отпечатка при чтении
+    assert len(hashed) == 1
+    assert work.ledger.is_processed(str(tmp_path / "01.03.2025.txt"))
+    assert len(list(work.parse_cache.entries())) == 1
@@ -0,0 +1,50 @@
+import os
+import re
+
+import pandas as pd
+
+
+class UnmatchedStore:
+    """
+    Строки выгрузок с товарами не из spr_product, которые не попали в ClickHouse
+    (id_product == 0 отбрасывается в WorkForData.__aggregate_for_DB).
+
+    На каждую загруженную дату остатков - Parquet со строками, уже свёрнутыми по
+    (код товара, магазин, ИНН, дата): код - категория, id - int32, суммы - float64.
+    Ключ - дата, а не файл: когда дату заменяет загрузка другого файла (например, выгрузка
+    другого формата за тот же день), строки прежнего файла к ней больше не относятся
+    и перезаписываются. После досылки (WorkForData.repair_unmatched) в записи остаются
+    только всё ещё неизвестные товары.
+    """
+
+    KEY_COLUMNS = ["code", "id_store_rename", "inn", "order_date"]
+    # Имя записи - дата остатков
+    ENTRY_NAME = re.compile(r"^(\d{4}-\d{2}-\d{2})\.parquet$")
+
+    def __init__(self, directory=".unmatched_rows"):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __path(self, date):
+        return os.path.join(self.directory, f"{pd.Timestamp(date):%Y-%m-%d}.parquet")
+
+    def save(self, date, df):
+        """Записать строки даты вместо прежних (пустой DataFrame - удалить запись)"""
+        path = self.__path(date)
+        if df.empty:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        df.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+
+    def entries(self):
+        """(дата, DataFrame) по всем записям"""
+        for name in sorted(os.listdir(self.directory)):
+            match = self.ENTRY_NAME.match(name)
+            if match is None:
+                if name.endswith(".parquet"):
+                    # Записи по файлам из прежней версии: к какой загрузке даты они относятся, неизвестно
+                    print(f"[!] {name}: запись не по дате, пропущена (перезагрузите файл, чтобы её обновить)")
+                continue
+            yield pd.Timestamp(match.group(1)), pd.read_parquet(os.path.join(self.directory, name))
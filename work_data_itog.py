@@ -1,65 +1,545 @@
 import numpy as np
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 pd.set_option("expand_frame_repr", False)
 pd.set_option("display.max_colwidth", None)
 from dotenv import load_dotenv
 import os
+import signal
+import threading
+import time
 
 from click_house_connect import ClickHouseConnection
-from postgress_connect import PostConn
+from error_collector import ErrorCollector
+from file_ledger import FileLedger
+from file_watcher import FileWatcher
+from insert_buffer import InsertBuffer
+from metrics import Metrics
+from pipeline import Pipeline
+from parse_cache import ParseCache
+from postgress_connect import PostConn, concat_frames
+from reference_cache import ReferenceCache
+from reference_lookup import ReferenceLookup
+from unmatched_store import UnmatchedStore
+
+# Числа в выгрузках 1С вида "1 234,567": пробелы (обычные и неразрывные) убираем, запятую меняем на точку
+RU_NUMBER_TRANSLATION = str.maketrans({"\xa0": None, " ": None, ",": "."})
+
+
+def ru_number_to_float(column):
+    """
+    Преобразует столбец с числами в формате "1 234,567" в числовой за один проход.
+
+    Строки сначала сворачиваются в уникальные значения (в остатках много повторов:
+    нули, целые количества), чистится и парсится только словарь, а результат
+    раскладывается обратно по кодам. Всё, что не число, становится NaN, как в pd.to_numeric(errors="coerce").
+    Результат всегда float64, даже если в столбце только целые.
+    """
+    if pd.api.types.is_numeric_dtype(column.dtype):
+        return pd.to_numeric(column, errors="coerce").astype("float64")
+    codes, uniques = pd.factorize(column)
+    parsed = pd.to_numeric(
+        pd.Series(uniques, dtype=object).str.translate(RU_NUMBER_TRANSLATION),
+        errors="coerce",
+    ).to_numpy(dtype="float64")
+    if (codes < 0).any():
+        # Пропуски имеют код -1, а take(-1) берёт последний элемент - добавляем туда NaN
+        parsed = np.append(parsed, np.nan)
+    return pd.Series(parsed.take(codes), index=column.index, name=column.name)
 
 
 class WorkForData:
-    def __init__(self):
+    # Столбцы выгрузки нового формата
+    NEW_FILE_COLUMNS = [
+        "Организация",
+        "Магазин",
+        "Номер магазина",
+        "Номенклатура.Код",
+        "Начальный остаток",
+        "Начальный остаток себестоимость",
+        "Конечный остаток",
+        "Конечный остаток себестоимость",
+    ]
+    # Столбцы выгрузки старого формата
+    OLD_FILE_COLUMNS = [
+        "Организация",
+        "Магазин",
+        "Номер магазина",
+        "Номенклатура",
+        "Код",
+        "Магазин.Номер магазина",
+        "По дням",
+        "Начальный остаток",
+        "Начальный остаток себестоимость",
+        "Конечный остаток",
+        "Конечный остаток себестоимость",
+    ]
+    # Числовые столбцы выгрузок (в файле - текст вида "1 234,567")
+    MEASURE_COLUMNS = [
+        "Начальный остаток",
+        "Начальный остаток себестоимость",
+        "Конечный остаток",
+        "Конечный остаток себестоимость",
+    ]
+    # Столбцы, которые дальше не используются: при чтении пропускаются
+    SKIP_COLUMNS = ["Номер магазина", "Магазин.Номер магазина", "По дням"]
+    # Типы столбцов при чтении файла. Названия организаций, магазинов и коды товаров
+    # сильно повторяются - category (словарь + коды); текст чисел до разбора - строки Arrow,
+    # они в разы компактнее object-строк и одинаково читаются целым файлом и кусками
+    READ_DTYPES = {
+        "Организация": "category",
+        "Магазин": "category",
+        "Номенклатура": "category",
+        "Номенклатура.Код": "category",
+        "Код": "category",
+        **{column: "string[pyarrow]" for column in MEASURE_COLUMNS},
+    }
+    # Типы после разбора чисел и после подстановки id из справочников.
+    # Суммы остаются float64: у себестоимости float32 теряет копейки уже на сотнях тысяч
+    PARSED_DTYPES = {column: "float64" for column in MEASURE_COLUMNS}
+    RESOLVED_DTYPES = {
+        **PARSED_DTYPES,
+        "id_product": "int32",
+        "id_store_rename": "int32",
+        "inn": "float64",
+    }
+    # Версия разбора выгрузок: ключ кэша разбора (ParseCache). Увеличить при любом изменении
+    # того, что получается из текста: столбцы, READ_DTYPES, ru_number_to_float, отбрасывание строки Итог
+    PARSER_VERSION = 1
+    # Справочники из PostgreSQL: имя атрибута -> (столбцы, таблица, db)
+    REFERENCE_TABLES = {
+        "store": (["search_store", "id_store_rename"], "spr_store_rename", "not_test"),
+        "store_channel": (["id_store", "channel"], "spr_store", "not_test"),
+        "product": (["id_product_code", "id_product"], "spr_product", "not_test"),
+        "inn": (["search_entity", "inn"], "spr_legal_entity_rename", "test"),
+    }
+    # Типы столбцов справочников: id помещаются в Int32, каналов продаж всего несколько
+    REFERENCE_DTYPES = {
+        "id_store_rename": "Int32",
+        "id_store": "Int32",
+        "id_product": "Int32",
+        "channel": "category",
+    }
+    # Справочники читаются серверным курсором кусками по столько строк
+    REFERENCE_FETCH_ROWS = 50_000
+    # Таблица остатков в ClickHouse и staging-таблица для replace_mode="partition"
+    TABLE_NAME = "remnants_of_products"
+    STAGING_TABLE_NAME = "remnants_of_products_staging"
+    # Своя staging-таблица для repair_unmatched: досылка не трогает staging идущей загрузки (режим службы)
+    REPAIR_STAGING_TABLE_NAME = "remnants_of_products_repair"
+    # Ключ агрегации до переименования столбцов в __data_to_DB
+    GROUP_COLUMNS = ["id_product", "id_store_rename", "inn", "order_date"]
+
+    def __init__(
+        self,
+        columnar_insert=True,
+        chunk_size=None,
+        executor="thread",
+        max_workers=5,
+        path_to_directory="files",
+        path_to_directory_old="old_files",
+        load_old_files=False,
+        reference=None,
+        reference_cache=".reference_cache",
+        reference_cache_ttl=None,
+        channels=None,
+        replace_mode="delete",
+        insert_buffer=False,
+        buffer_max_rows=500_000,
+        buffer_max_bytes=256 * 1024 * 1024,
+        buffer_max_seconds=30,
+        pipeline_workers=(2, 2, 2),
+        pipeline_queue_size=2,
+        ledger_path="processed_files.sqlite3",
+        postgres_upsert=None,
+        pre_aggregate=False,
+        parse_cache=None,
+        parse_cache_max_age=30 * 24 * 3600,
+        parse_cache_max_bytes=None,
+        unmatched_store=".unmatched_rows",
+        metrics_log=None,
+        metrics_textfile=None,
+        metrics_port=None,
+    ):
+        """
+        executor - чем обрабатывать файлы: "thread" (ThreadPoolExecutor) или "process"
+        (ProcessPoolExecutor, pandas почти всё время держит GIL, поэтому потоки не дают
+        загрузить больше одного ядра). max_workers - число потоков/процессов.
+        "pipeline" - конвейер (Pipeline) из стадий чтения, обработки и загрузки в БД, чтобы
+        разбор следующих файлов шёл, пока ClickHouse занят предыдущими; pipeline_workers -
+        число потоков каждой стадии, pipeline_queue_size - сколько файлов ждут между стадиями.
+        "serial" - файлы по очереди в вызывающем потоке (itog_main.py --profile: cProfile видит только его).
+        load_old_files - загружать выгрузки старого формата из path_to_directory_old (по умолчанию нет).
+        Файл старого формата пропускается, если его дату уже покрывает файл нового формата (лежит
+        в path_to_directory или уже загружен оттуда): иначе старая выгрузка затёрла бы более новые данные.
+        reference - уже загруженные справочники (store, store_channel, product, inn);
+        используется процессами-обработчиками, чтобы не ходить в PostgreSQL повторно.
+        reference_cache - папка локального кэша справочников (None - всегда выгружать из PostgreSQL),
+        reference_cache_ttl - максимальный возраст кэша в секундах.
+        channels - каналы продаж магазинов, которые грузим (по умолчанию ReferenceLookup.CHANNELS - франшиза).
+        replace_mode - как заменять данные за дату в ClickHouse: "delete" - ALTER ... DELETE и вставка
+        на каждый файл, "partition" - все файлы запуска грузятся в staging-таблицу, а в конце
+        затронутые партиции подменяются разом (REPLACE PARTITION). Файлы попадают в журнал
+        обработанных только после успешной замены.
+        insert_buffer - копить данные нескольких файлов и вставлять их в ClickHouse одним запросом
+        (InsertBuffer), пока не наберётся buffer_max_rows строк, buffer_max_bytes байт или не пройдёт
+        buffer_max_seconds секунд. Не работает с executor="process": буфер общий для потоков одного процесса.
+        ledger_path - журнал обработанных файлов (FileLedger, SQLite) вместо except.csv;
+        при первом запуске в него переносятся имена из except.csv.
+        postgres_upsert - дополнительно писать остатки в PostgreSQL (public.inventory_balance)
+        через PostConn.psycopg2_upsert: None - не писать, "values" или "copy" - способ загрузки.
+        pre_aggregate - сразу после разбора чисел сворачивать строки с одинаковыми исходными ключами
+        (код товара, магазин, организация), чтобы в поиск id шло меньше строк; окончательная
+        группировка по id остаётся в __aggregate_for_DB. По каждому файлу печатается,
+        во сколько раз сократились строки и сколько заняли группировка и подстановка id.
+        parse_cache - папка кэша разобранных файлов (ParseCache, например ".parse_cache"; None - без кэша).
+        Повторная загрузка того же файла (после обновления справочников) не разбирает текст заново,
+        а reresolve_unknown() перезагружает только файлы, где появились ранее неизвестные товары.
+        parse_cache_max_age, parse_cache_max_bytes - после запуска (и каждой пачки в режиме службы)
+        из кэша удаляются записи уже загруженных файлов старше parse_cache_max_age секунд, а пока кэш
+        больше parse_cache_max_bytes байт - самые старые из них (None - без ограничения).
+        unmatched_store - папка UnmatchedStore для строк товаров не из spr_product (None - не сохранять);
+        repair_unmatched() досылает из неё в ClickHouse только строки товаров, появившихся в справочнике.
+        metrics_log - файл JSON-лога замеров (Metrics): по строке на файл со временем и строками
+        на входе/выходе каждой стадии, прочитанными байтами, пиковой памятью и временем запросов к БД.
+        metrics_textfile - файл счётчиков в формате Prometheus (для textfile collector node_exporter),
+        обновляется в конце запуска и после каждой пачки в режиме службы;
+        metrics_port - отдавать те же счётчики по HTTP на 127.0.0.1:metrics_port/metrics.
+        """
         # Подбираем из окружения данные
         load_dotenv()
-        # Записываем в переменные
-        self.click_house = ClickHouseConnection()
-        # Получаем данные о магазинах
-        self.post_conn_analyt = PostConn(db="an")
-        print("Получаем данные о магазинах! К-к-арамба!")
-        self.store = self.__take_data_for_DB(
-            ["search_store", "id_store_rename"], "spr_store_rename", db="not_test"
-        )
-        self.store_channel = self.__take_data_for_DB(
-            ["id_store", "channel"], "spr_store", db="not_test"
-        )
-        print("Получили данные с магазинов! К-к-арамба!")
-        # Получаем данные о продуктах
-        print("Получаем данные о продуктах! К-к-арамба!")
-        self.product = self.__take_data_for_DB(
-            ["id_product_code", "id_product"], "spr_product", db="not_test"
+        # Замеры по стадиям; Prometheus-счётчики отдаёт только основной процесс
+        self.metrics_log = metrics_log
+        self.metrics = Metrics(log_path=metrics_log, textfile=metrics_textfile, http_port=metrics_port)
+        # Вставка в ClickHouse колонками (numpy), False - старая построчная вставка
+        self.columnar_insert = columnar_insert
+        # Читать файлы кусками по chunk_size строк (None - весь файл целиком)
+        self.chunk_size = chunk_size
+        if executor not in ("thread", "process", "pipeline", "serial"):
+            raise ValueError(f"Неизвестный executor: {executor}")
+        self.executor = executor
+        self.max_workers = max_workers
+        self.pipeline_workers = pipeline_workers
+        self.pipeline_queue_size = pipeline_queue_size
+        if replace_mode not in ("delete", "partition"):
+            raise ValueError(f"Неизвестный replace_mode: {replace_mode}")
+        self.replace_mode = replace_mode
+        if postgres_upsert not in (None, "values", "copy"):
+            raise ValueError(f"Неизвестный postgres_upsert: {postgres_upsert}")
+        self.postgres_upsert = postgres_upsert
+        self.pre_aggregate = pre_aggregate
+        self.parse_cache_directory = parse_cache
+        self.parse_cache = (
+            ParseCache(
+                parse_cache,
+                version=self.PARSER_VERSION,
+                max_age=parse_cache_max_age,
+                max_bytes=parse_cache_max_bytes,
+            )
+            if parse_cache
+            else None
         )
-        print("Получили данные с инн! К-к-арамба!")
-        self.inn = self.__take_data_for_DB(
-            ["search_entity", "inn"], "spr_legal_entity_rename", db="test"
+        self.unmatched_store_directory = unmatched_store
+        self.unmatched = UnmatchedStore(unmatched_store) if unmatched_store else None
+        # Сведения по обрабатываемым файлам (файл может приходить кусками): статистика
+        # предварительной группировки, ключ кэша разбора, строки неизвестных товаров
+        # и отпечаток файла (FileLedger.fingerprint) на момент чтения
+        self.__pre_aggregation = {}
+        self.__cache_keys = {}
+        self.__unmatched_rows = {}
+        self.__fingerprints = {}
+        # Отпечатки файлов, чьи данные ждут сброса буфера вставки: путь -> отпечаток
+        self.__buffered_fingerprints = {}
+        self.__file_stats_lock = threading.Lock()
+        if insert_buffer and executor == "process":
+            raise ValueError('insert_buffer не работает с executor="process"')
+        self.buffer_settings = (
+            {
+                "max_rows": buffer_max_rows,
+                "max_bytes": buffer_max_bytes,
+                "max_seconds": buffer_max_seconds,
+            }
+            if insert_buffer
+            else None
         )
-        print("Получили данные с инн! К-к-арамба!")
+        # Создаётся на время first_start
+        self.insert_buffer = None
+        # Файлы, загруженные в staging и ждущие замены партиций: (путь к файлу, дата, отпечаток)
+        self.__staged = []
+        # Журнал обработанных файлов
+        self.ledger_path = ledger_path
+        self.ledger = FileLedger(ledger_path)
+        # Товары и магазины, которых нет в справочниках (пишутся в файлы в конце запуска)
+        self.errors = ErrorCollector()
+        # Записываем в переменные
+        self.click_house = ClickHouseConnection()
+        self.click_house.metrics = self.metrics
+        # Подключение к аналитической БД открывается при первом обращении (см. post_conn_analyt)
+        self.__post_conn_analyt = None
+        self.reference_cache = reference_cache
+        self.reference_cache_ttl = reference_cache_ttl
+        self.channels = channels
+        if reference is not None:
+            self.store, self.store_channel, self.product, self.inn = reference
+            self.__build_lookup()
+        else:
+            self.refresh_reference()
         # Путь до папки с нашими файлами
-        self.path_to_directory = "files"
+        self.path_to_directory = path_to_directory
         # Путь до старого формата
-        self.path_to_directory_old = "old_files"
+        self.path_to_directory_old = path_to_directory_old
+        self.load_old_files = load_old_files
+
+    def refresh_reference(self):
+        """
+        (Пере)загрузка справочников из PostgreSQL или кэша и словарей по ним.
+        С кэшем заново выгружаются только изменившиеся таблицы - так справочники
+        обновляются и в режиме службы (watch).
+        """
+        with self.metrics.stage(None, "references"):
+            self.__load_reference()
+        self.__build_lookup()
+
+    def __load_reference(self):
+        if self.reference_cache:
+            print("Получаем справочники из кэша! К-к-арамба!")
+            cache = ReferenceCache(self.reference_cache, ttl=self.reference_cache_ttl)
+            for name, df in cache.load(self.REFERENCE_TABLES, self.__take_data_for_DB).items():
+                setattr(self, name, df)
+        else:
+            # Все справочники выгружаются одновременно, каждый своим подключением из пула
+            print("Получаем справочники: магазины, продукты, инн! К-к-арамба!")
+            with ThreadPoolExecutor(max_workers=len(self.REFERENCE_TABLES)) as executor:
+                loaded = executor.map(lambda args: self.__take_data_for_DB(*args), self.REFERENCE_TABLES.values())
+                for name, df in zip(self.REFERENCE_TABLES, loaded):
+                    setattr(self, name, df)
+            print("Получили справочники! К-к-арамба!")
+
+    def __build_lookup(self):
+        # Словари "ключ -> id" по справочникам строятся один раз на загрузку справочников
+        self.lookup = ReferenceLookup(
+            self.store, self.store_channel, self.product, self.inn, channels=self.channels
+        )
+
+    @property
+    def post_conn_analyt(self):
+        """Подключение к аналитической БД, открывается только при первом обращении"""
+        if self.__post_conn_analyt is None:
+            self.__post_conn_analyt = PostConn(db="an")
+        return self.__post_conn_analyt
 
     def first_start(self):
         print("Start!")
-        self.__take_all_file()
-        self.__take_all_old_file()
+        self.__start_run()
+        try:
+            self.__take_all_file()
+            self.__take_all_old_file()
+        finally:
+            # Всё, что накопилось в буфере, уходит в ClickHouse при завершении
+            self.__close_insert_buffer()
+        self.__finish_run()
+
+    def __start_run(self):
+        if self.replace_mode == "partition":
+            self.click_house.clickhouse_prepare_staging(self.TABLE_NAME, self.STAGING_TABLE_NAME)
+        if self.buffer_settings:
+            self.insert_buffer = self.__make_insert_buffer()
+
+    def __close_insert_buffer(self):
+        if self.insert_buffer is not None:
+            self.insert_buffer.close()
+            self.insert_buffer = None
+
+    def __finish_run(self):
+        if self.replace_mode == "partition":
+            self.__replace_staged()
+        self.__report_errors()
+        self.__prune_parse_cache()
+        self.__report_metrics()
+        self.metrics.close()
+        print(f"Пул подключений ClickHouse: {self.click_house.pool_stats()}")
+        PostConn.close_pool()
+
+    def __report_metrics(self):
+        """Сводка времени по стадиям, событие "run" в JSON-лог и файл счётчиков Prometheus"""
+        seconds = self.metrics.stage_seconds()
+        if seconds:
+            print("Время по стадиям: " + ", ".join(f"{stage} {value:.2f} с" for stage, value in seconds.items()))
+        self.metrics.emit("run", stage_seconds=seconds, clickhouse_pool=self.click_house.pool_stats())
+        self.metrics.write_textfile()
+
+    # -------- РЕЖИМ СЛУЖБЫ: файлы загружаются сразу, как только их дописали --------
+    def watch(self, settle_seconds=2.0, poll_interval=5.0, refresh_seconds=3600, use_inotify=True):
+        """
+        Долгоживущий режим вместо запуска по cron: справочники и подключения остаются
+        в памяти, новые .txt в папках нового и старого формата замечаются через inotify
+        (или сканированием раз в poll_interval секунд) и загружаются, как только файл
+        не менялся settle_seconds секунд. Справочники обновляются раз в refresh_seconds секунд.
+        SIGINT/SIGTERM - мягкая остановка: текущие файлы догружаются, буфер и staging сбрасываются.
+        Ошибка в файле не останавливает службу, файл не отмечается обработанным.
+        """
+        stop = threading.Event()
+
+        def request_stop(signum, frame):
+            print(f"Получен сигнал {signal.Signals(signum).name}, завершаем после текущих файлов")
+            stop.set()
+
+        previous_handlers = {
+            signum: signal.signal(signum, request_stop) for signum in (signal.SIGINT, signal.SIGTERM)
+        }
+        formats = {os.path.normpath(self.path_to_directory): False}
+        if self.load_old_files:
+            formats[os.path.normpath(self.path_to_directory_old)] = True
+        watcher = FileWatcher(
+            list(formats), settle_seconds=settle_seconds, poll_interval=poll_interval, use_inotify=use_inotify
+        )
+        print(f"Режим службы: слежу за {', '.join(formats)} ({watcher.mode})")
+        self.__start_run()
+        executor = self.__make_watch_executor()
+        refreshed = time.monotonic()
+        # Время неудачной отправки пачки: пока она не прошла, повторяем раз в poll_interval секунд
+        failed_at = None
+        try:
+            while not stop.is_set():
+                ready = watcher.wait(timeout=1.0)
+                if ready:
+                    flushed = self.__watch_batch(executor, ready, formats)
+                    failed_at = None if flushed else time.monotonic()
+                elif failed_at is not None and time.monotonic() - failed_at >= poll_interval:
+                    print("Повторная отправка данных, не ушедших в ClickHouse")
+                    failed_at = None if self.__watch_flush() else time.monotonic()
+                if refresh_seconds and time.monotonic() - refreshed >= refresh_seconds and not stop.is_set():
+                    self.refresh_reference()
+                    refreshed = time.monotonic()
+                    if self.executor == "process":
+                        # В процессах-обработчиках остались старые справочники
+                        executor.shutdown()
+                        executor = self.__make_watch_executor()
+        finally:
+            executor.shutdown()
+            watcher.close()
+            self.__close_insert_buffer()
+            self.__finish_run()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        print("Режим службы остановлен")
+
+    def __make_watch_executor(self):
+        # Конвейер рассчитан на пачку файлов за запуск, в режиме службы файлы приходят по одному
+        if self.executor == "pipeline":
+            return ThreadPoolExecutor(max_workers=self.max_workers)
+        return self.__make_executor()
+
+    def __watch_batch(self, executor, paths, formats):
+        """Загрузка дописанных файлов, пришедших за один проход. False - данные пачки не ушли в ClickHouse"""
+        self.ledger.reload()
+        futures = {}
+        for path in paths:
+            if self.ledger.is_processed(path):
+                continue
+            file = os.path.basename(path)
+            old = formats[os.path.dirname(path)]
+            if old and not self.__old_files_allowed([file]):
+                continue
+            futures[executor.submit(self.__file_task(old=old), file)] = file
+        if not futures:
+            return True
+        start = time.perf_counter()
+        results = []
+        for future, file in futures.items():
+            try:
+                results.append(future.result())
+            except Exception as error:
+                print(f"[!] Файл {file} не загружен, служба продолжает работу: {error}")
+        self.__collect_staged(results)
+        flushed = self.__watch_flush()
+        self.__report_errors()
+        self.__prune_parse_cache()
+        self.metrics.write_textfile()
+        print(f"Пачка из {len(futures)} файлов обработана за {time.perf_counter() - start:.1f} с")
+        return flushed
+
+    def __watch_flush(self):
+        """
+        Отправка накопленного после пачки. Буфер и staging при неудаче сохраняют данные,
+        поэтому повторный вызов досылает их; False - что-то из них ещё не отправлено
+        """
+        if self.replace_mode != "partition":
+            # Без замены партиций буфер сбрасывается сам по размеру и времени, повторяем только неудачный сброс
+            return self.insert_buffer is None or not self.insert_buffer.failed or self.insert_buffer.flush()
+        # Замена партиций на каждую пачку, иначе данные не появятся в таблице до остановки службы
+        flushed = self.insert_buffer is None or self.insert_buffer.flush()
+        if not flushed:
+            print("[!] Буфер не сброшен в staging, файлы останутся в буфере до повторной отправки")
+        return self.__replace_staged() and flushed
+
+    def __prune_parse_cache(self):
+        """Записи кэша разбора уже загруженных (или удалённых) файлов чистятся по возрасту и размеру"""
+        if self.parse_cache is None:
+            return
+        # Файлы могли отметить процессы-обработчики
+        self.ledger.reload()
+
+        def loaded(meta):
+            path = self.__file_path(meta["file"], meta["old"])
+            return not os.path.exists(path) or self.ledger.is_processed(path)
+
+        removed, freed = self.parse_cache.prune(loaded)
+        if removed:
+            print(f"[кэш разбора] Удалено записей: {removed}, освобождено {freed / 1024 ** 2:.1f} МБ")
+
+    def __report_errors(self):
+        """Дописываем новые неизвестные товары и магазины в файлы ошибок и печатаем сводку по файлам"""
+        for file, kinds in sorted(self.errors.pop_counts().items()):
+            print(f"[?] {file}: нет в справочниках товаров {kinds.get('product', 0)}, магазинов {kinds.get('store', 0)}")
+        written = self.errors.flush()
+        print(f"Новых ключей в файлах ошибок: товаров {written['product']}, магазинов {written['store']}")
+
+    def __make_insert_buffer(self):
+        partition = self.replace_mode == "partition"
+        return InsertBuffer(
+            self.click_house,
+            self.STAGING_TABLE_NAME if partition else self.TABLE_NAME,
+            on_flush=self.__on_buffer_flush,
+            # В staging даты не удаляем: замена происходит через REPLACE PARTITION
+            replace_dates=not partition,
+            columnar=self.columnar_insert,
+            **self.buffer_settings,
+        )
+
+    def __on_buffer_flush(self, flushed):
+        # Файл, перезагруженный за время ожидания в буфере, встречается в списке дважды
+        for path, date in dict.fromkeys(flushed):
+            with self.__file_stats_lock:
+                fingerprint = self.__buffered_fingerprints.pop(path, None)
+            self.__mark_loaded(path, date, fingerprint)
+
+    def __replace_staged(self):
+        """Одна замена партиций на весь запуск, после неё файлы отмечаются обработанными"""
+        if not self.__staged:
+            return True
+        dates = {date for _, date, _ in self.__staged}
+        print(f"Замена партиций в {self.TABLE_NAME}: файлов {len(self.__staged)}, дат {len(dates)}")
+        if not self.click_house.clickhouse_replace_partitions(
+            self.TABLE_NAME, self.STAGING_TABLE_NAME, dates
+        ):
+            print("[!] Замена партиций не прошла, файлы не отмечены обработанными")
+            return False
+        for path, _, fingerprint in self.__staged:
+            self.ledger.mark(path, fingerprint)
+        self.__staged = []
+        return True
+
+    def pop_staged(self):
+        """Забирает список (путь к файлу, дата, отпечаток), загруженных в staging (используется процессами-обработчиками)"""
+        staged, self.__staged = self.__staged, []
+        return staged
 
     def __take_all_file(self):
         print("Поиск новых файлов...")
 
-        except_file_path = "except.csv"
-        try:
-            except_df = pd.read_csv(except_file_path)
-            excluded_files = except_df.iloc[:, 0].tolist()
-        except FileNotFoundError:
-            excluded_files = []
-
-        txt_files = [
-            f for f in os.listdir(self.path_to_directory)
-            if f.endswith(".txt") and f not in excluded_files
-        ]
+        txt_files = self.__new_files(self.path_to_directory)
 
         if not txt_files:
             print("Нет новых файлов для обработки.")
@@ -68,37 +548,237 @@ class WorkForData:
         print(f"Найдено новых файлов: {len(txt_files)}")
         #for text in txt_files:
         #    result = self.__process_new_file(text)
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            results = list(executor.map(self.__process_new_file, txt_files))
+        self.__process_files(txt_files, old=False)
 
 
     def __take_all_old_file(self):
+        if not self.load_old_files:
+            print("Выгрузки старого формата не загружаются (load_old_files=False)")
+            return
         print("Поиск старых файлов...")
 
-        except_file_path = "except.csv"
-        try:
-            except_df = pd.read_csv(except_file_path)
-            excluded_files = except_df.iloc[:, 0].tolist()
-        except FileNotFoundError:
-            excluded_files = []
-
-        txt_files = [
-            f for f in os.listdir(self.path_to_directory_old)
-            if f.endswith(".txt") and f not in excluded_files
-        ]
+        txt_files = self.__old_files_allowed(self.__new_files(self.path_to_directory_old))
 
         if not txt_files:
             print("Нет старых файлов для обработки.")
             return
 
         print(f"Найдено старых файлов: {len(txt_files)}")
+        self.__process_files(txt_files, old=True)
+
+    def __old_files_allowed(self, files):
+        """Файлы старого формата, даты которых не покрыты файлами нового формата"""
+        names = {f for f in os.listdir(self.path_to_directory) if f.endswith(".txt")}
+        # Записи из except.csv - файлы нового формата: старый формат до load_old_files не загружался
+        names.update(self.ledger.names_in(self.path_to_directory, include_legacy=True))
+        covered = {self.__file_date(name) for name in names} - {None}
+        allowed = []
+        for file in files:
+            if self.__file_date(file) in covered:
+                print(f"[пропуск] {file} (старый формат): за эту дату есть выгрузка нового формата")
+            else:
+                allowed.append(file)
+        return allowed
+
+    def __file_date(self, file):
+        """Дата остатков из имени файла или None, если имя не дата"""
+        try:
+            return self.__order_date(file)
+        except ValueError:
+            return None
 
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            results = list(executor.map(self.__process_old_file, txt_files))
-
+    def __process_files(self, files, old):
+        if self.executor == "pipeline":
+            self.__run_pipeline(files, old=old)
+            return
+        with self.__make_executor() as executor:
+            results = list(executor.map(self.__file_task(old=old), files))
+        self.__collect_staged(results)
+
+    def repair_unmatched(self):
+        """
+        Досылка в remnants_of_products строк товаров, которых не было в spr_product при загрузке.
+
+        id подставляются только строкам из UnmatchedStore, а в ClickHouse досылается лишь то,
+        что теперь нашлось (clickhouse_add_rows: дата пересобирается в REPAIR_STAGING_TABLE_NAME
+        и подменяется через REPLACE PARTITION) - файлы за даты заново не загружаются.
+        В хранилище остаются строки товаров, которых в справочнике всё ещё нет.
+
+        clickhouse_add_rows прибавляет к тому, что уже есть, поэтому досылка отмечается в хранилище
+        до вставки: повторный запуск не прибавит те же строки второй раз. Если вставка не прошла,
+        запись даты возвращается как была; если процесс упал между отметкой и вставкой, эти строки
+        не будут досланы - их вернёт перезагрузка файла за эту дату.
+        """
+        if self.unmatched is None:
+            raise ValueError("repair_unmatched работает только с unmatched_store")
+        print("Start! Досылка строк товаров, которые появились в spr_product")
+        key_columns = ["id_product", "id_store", "inn", "order_date"]
+        total = 0
+        for date, df in self.unmatched.entries():
+            ids = self.lookup.product.get(df["code"])
+            found = ~np.isnan(ids)
+            if not found.any():
+                continue
+            delta = df.loc[found, self.MEASURE_COLUMNS + ["id_store_rename", "inn", "order_date"]]
+            delta = delta.assign(id_product=ids[found].astype("int32"))
+            delta, _ = self.__aggregate_for_DB(delta)
+            self.unmatched.save(date, df[~found].reset_index(drop=True))
+            if not self.click_house.clickhouse_add_rows(
+                self.TABLE_NAME, self.REPAIR_STAGING_TABLE_NAME, delta, key_columns, columnar=self.columnar_insert
+            ):
+                self.unmatched.save(date, df)
+                print(f"[!] {date:%d.%m.%Y}: досылка не прошла, строки остаются в хранилище")
+                continue
+            total += len(delta)
+            print(
+                f"[досылка] {date:%d.%m.%Y}: найдено товаров {df.loc[found, 'code'].nunique()}, "
+                f"строк {int(found.sum())} из {len(df)}, в ClickHouse {len(delta)}"
+            )
+        print(f"Досылка завершена, строк в ClickHouse: {total}")
+
+    def reresolve_unknown(self):
+        """
+        Повторная подстановка id в уже загруженных файлах, где были товары не из spr_product
+        (такие строки получают id_product == 0 и в ClickHouse не попадают).
+
+        Проверяются только запомненные в кэше разбора неизвестные коды; заново загружаются
+        лишь файлы, часть таких кодов которых появилась в справочнике. Текст при этом
+        не разбирается - данные берутся из кэша, а дата в ClickHouse заменяется целиком,
+        как при обычной загрузке.
+        """
+        if self.parse_cache is None:
+            raise ValueError("reresolve_unknown работает только с кэшем разбора (parse_cache)")
+        print("Start! Ищем файлы, где появились товары, которых не было в справочнике")
+        self.ledger.reload()
+        files = {False: [], True: []}
+        for key, meta in self.parse_cache.entries():
+            codes = meta.get("unknown_products") or []
+            if not codes:
+                continue
+            if meta["old"] and not (self.load_old_files and self.__old_files_allowed([meta["file"]])):
+                continue
+            path = self.__file_path(meta["file"], meta["old"])
+            # Ещё не загруженные и изменившиеся файлы подхватит обычный запуск
+            if not os.path.exists(path) or not self.ledger.is_processed(path):
+                continue
+            if self.parse_cache.key(path, meta["old"]) != key:
+                continue
+            found = int(pd.Index(codes).isin(self.lookup.product.index).sum())
+            if found:
+                print(f"[повтор] {meta['file']}: неизвестных товаров было {len(codes)}, теперь найдено {found}")
+                files[meta["old"]].append(meta["file"])
+        if not any(files.values()):
+            print("Нет файлов, в которых появились новые товары")
+            return
+        self.__start_run()
+        try:
+            for old, names in files.items():
+                if names:
+                    self.__process_files(sorted(names), old)
+        finally:
+            self.__close_insert_buffer()
+        self.__finish_run()
+
+    def __new_files(self, directory):
+        """Файлы .txt папки, которых нет в журнале обработанных (или содержимое которых изменилось)"""
+        # Журнал могли дополнить процессы-обработчики
+        self.ledger.reload()
+        # Файлы, уже загруженные в staging в этом запуске (replace_mode="partition") или ждущие в буфере
+        pending = [path for path, _, _ in self.__staged]
+        if self.insert_buffer is not None:
+            pending += self.insert_buffer.pending_files()
+        excluded_files = {os.path.basename(path) for path in pending}
+
+        return [
+            f for f in os.listdir(directory)
+            if f.endswith(".txt")
+            and f not in excluded_files
+            and not self.ledger.is_processed(os.path.join(directory, f))
+        ]
 
-    def __data_to_DB(self, df):
+    def __collect_staged(self, results):
+        # Процессы возвращают то, что загрузили в staging, и неизвестные ключи; потоки пишут в self сами
+        if self.executor == "process":
+            for result in results:
+                staged, errors, metrics = result
+                self.__staged.extend(staged)
+                self.errors.merge(errors)
+                self.metrics.merge(metrics)
+
+    def __run_pipeline(self, files, old):
+        errors = []
+
+        def on_error(item, error):
+            file = item if isinstance(item, str) else item[0]
+            print(f"[!] Ошибка в файле {file}: {error}")
+            self.metrics.file_done(file, status="error", error=str(error))
+            errors.append(error)
+
+        read_workers, transform_workers, upload_workers = self.pipeline_workers
+        pipeline = Pipeline(
+            [
+                ("чтение", partial(self.__read_stage, old=old), read_workers),
+                ("обработка", partial(self.__transform_stage, old=old), transform_workers),
+                ("загрузка", partial(self.__upload_stage, old=old), upload_workers),
+            ],
+            queue_size=self.pipeline_queue_size,
+            on_error=on_error,
+        )
+        seconds = pipeline.run(files)
+        busy = ", ".join(f"{name} {value:.1f} с" for name, value in pipeline.busy_seconds.items())
+        print(f"Конвейер: {len(files)} файлов за {seconds:.1f} с (занятость стадий: {busy})")
+        # Как и с ThreadPoolExecutor: ошибка в файле нового формата прерывает запуск после обработки остальных
+        if errors and not old:
+            raise errors[0]
+
+    def __make_executor(self):
+        if self.executor == "process":
+            # Справочники уходят в каждый процесс один раз через initializer, а не с каждой задачей
+            return ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=_init_worker,
+                initargs=(self.__worker_settings(), (self.store, self.store_channel, self.product, self.inn)),
+            )
+        if self.executor == "serial":
+            return SerialExecutor()
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def __file_task(self, old):
+        if self.executor == "process":
+            return partial(_process_file_in_worker, old=old)
+        return self.__process_old_file if old else self.__process_new_file
+
+    def __worker_settings(self):
+        return {
+            "columnar_insert": self.columnar_insert,
+            "chunk_size": self.chunk_size,
+            "path_to_directory": self.path_to_directory,
+            "path_to_directory_old": self.path_to_directory_old,
+            "channels": self.channels,
+            "replace_mode": self.replace_mode,
+            "ledger_path": self.ledger_path,
+            "postgres_upsert": self.postgres_upsert,
+            "pre_aggregate": self.pre_aggregate,
+            "parse_cache": self.parse_cache_directory,
+            "unmatched_store": self.unmatched_store_directory,
+            # JSON-лог процессы дописывают сами, счётчики возвращают в основной процесс
+            "metrics_log": self.metrics_log,
+        }
+
+    def process_file(self, file, old=False):
+        """Обработка одного файла из папки нового (old=False) или старого формата"""
+        if old:
+            return self.__process_old_file(file)
+        return self.__process_new_file(file)
+
+
+    def __data_to_DB(self, df, path=None):
         """Это типо подключение к бд"""
+        df, date_start = self.__aggregate_for_DB(df)
+        return self.__upload_to_DB(df, date_start, path)
+
+    def __aggregate_for_DB(self, df):
+        """Приводим столбцы к именам и типам remnants_of_products и группируем по ключу"""
         df.rename(
             columns={
                 "Начальный остаток": "opening_balance",
@@ -113,7 +793,7 @@ class WorkForData:
             inplace=True,
         )
         df['order_date'] = pd.to_datetime(df['order_date']).dt.date
-        date_start = date_end = df['order_date'].iloc[0]
+        date_start = df['order_date'].iloc[0]
         df['order_date'] = pd.to_datetime(df['order_date'])
 
         df['opening_balance'] = df['opening_balance'].astype('float64')
@@ -124,9 +804,6 @@ class WorkForData:
 
 
 
-        table_name = 'remnants_of_products'
-
-
         key_columns = ["id_product", "id_store", "inn", "order_date"]
 
         # Группируем по ключевым столбцам и суммируем остальные
@@ -140,225 +817,272 @@ class WorkForData:
 
         for i in columns:
             df[i] = df[i].astype('float').round(3)
-
-
+        return df, date_start
+
+    def __upload_to_DB(self, df, date_start, path=None):
+        date_end = date_start
+        table_name = self.TABLE_NAME
+
+        if self.postgres_upsert:
+            self.__upsert_to_postgres(df)
+        if self.insert_buffer is not None:
+            self.insert_buffer.add(path, date_start, df)
+            return date_start
+        if self.replace_mode == "partition":
+            if self.columnar_insert:
+                inserted = self.click_house.clickhouse_insert_columnar(self.STAGING_TABLE_NAME, df)
+            else:
+                inserted = self.click_house.clickhouse_insert(self.STAGING_TABLE_NAME, df)
+            if not inserted:
+                raise RuntimeError(f"Не удалось загрузить данные за {date_start} в {self.STAGING_TABLE_NAME}")
+            return date_start
         self.click_house.clickhouse_del_date_on_insert(table_name=table_name,
                                                        date_start=date_start,
                                                        date_end=date_end,
                                                        delete_columns='',
-                                                       df=df)
-        #self.post_conn_analyt.psycopg2_upsert(df)
+                                                       df=df,
+                                                       columnar=self.columnar_insert)
+        return date_start
+
+    def __upsert_to_postgres(self, df):
+        # Своё подключение из пула на вызов: файлы загружаются из нескольких потоков
+        with PostConn(db="an", pooled=True) as conn:
+            start = time.perf_counter()
+            # psycopg2_upsert переименовывает столбцы на месте - отдаём ему копию
+            conn.psycopg2_upsert(df.copy(deep=False), method=self.postgres_upsert)
+            self.metrics.observe_db("postgres", "UPSERT", time.perf_counter() - start)
+
+    def __read_options(self, old):
+        """Общие параметры read_csv для чтения целиком и кусками: схема типов и только нужные столбцы"""
+        column_names = self.OLD_FILE_COLUMNS if old else self.NEW_FILE_COLUMNS
+        usecols = [column for column in column_names if column not in self.SKIP_COLUMNS]
+        return {
+            "sep": "\t",
+            "skiprows": 8,
+            "names": column_names,
+            "usecols": usecols,
+            "dtype": {column: self.READ_DTYPES[column] for column in usecols},
+            "encoding": "utf-8",
+            "skipinitialspace": old,
+        }
+
     def __take_data_for_file(self, file_path):
         """Получаем данные с файла"""
-        # Столбцы, которые будут в датасете
-        column_names = [
-            "Организация",
-            "Магазин",
-            "Номер магазина",
-            "Номенклатура.Код",
-            "Начальный остаток",
-            "Начальный остаток себестоимость",
-            "Конечный остаток",
-            "Конечный остаток себестоимость",
-        ]
-
         # Считываем данные из файла, пропуская первые 8 строк
-        df = pd.read_csv(
-            file_path, sep="\t", skiprows=8, names=column_names, encoding="utf-8"
-        )
+        df = pd.read_csv(file_path, **self.__read_options(old=False))
         # Убираем последнюю, где Итог
-        df = df.iloc[:-1]
-        # Преобразование столбцов в численные выражения. Первые две это Организация и Магазин. Их пропускаем, как и Номенклатуру
-        for column in column_names[2:]:
-            if column != "Номенклатура.Код":
-                df[column] = self.__column_to_float(df, column)
-        return df
+        return df.iloc[:-1]
 
     def __take_data_for_file_old(self, file_path):
         """Получаем данные с файла"""
-        # Столбцы, которые будут в датасете
-        column_names = [
-            "Организация",
-            "Магазин",
-            "Номер магазина",
-            "Номенклатура",
-            "Код",
-            "Магазин.Номер магазина",
-            "По дням",
-            "Начальный остаток",
-            "Начальный остаток себестоимость",
-            "Конечный остаток",
-            "Конечный остаток себестоимость",
-        ]
-
         # Считываем данные из файла, пропуская первые 8 строк
-        df = pd.read_csv(
-            file_path,
-            sep="\t",
-            skiprows=8,
-            names=column_names,
-            encoding="utf-8",
-            skipinitialspace=True,
-        )
-
+        df = pd.read_csv(file_path, **self.__read_options(old=True))
         # Убираем последнюю, где Итог
-        df = df.dropna(subset=["Номенклатура"], how="all")
-
-        # Преобразование столбцов в численные выражения. Первые две это Организация и Магазин. Их пропускаем, как и Номенклатуру
-        for column in column_names[2:]:
-            if column not in ["Номенклатура", "Код", "По дням"]:
+        return df.dropna(subset=["Номенклатура"], how="all")
+
+    def __raw_parts(self, file_path, old):
+        """Строки файла без разбора: весь файл одним куском или кусками по chunk_size строк"""
+        file = os.path.basename(file_path)
+        self.metrics.add_bytes(file, os.path.getsize(file_path))
+        yield from self.metrics.timed_parts(file, "read", self.__read_parts(file_path, old))
+
+    def __read_parts(self, file_path, old):
+        if self.chunk_size:
+            yield from self.__take_chunks_for_file(file_path, old=old)
+        elif old:
+            yield self.__take_data_for_file_old(file_path)
+        else:
+            yield self.__take_data_for_file(file_path)
+
+    def __parse_part(self, df, file):
+        if self.parse_cache is None:
+            # Без кэша строки чужих каналов отбрасываем ещё до разбора чисел.
+            # В кэш же пишется весь файл: отбор магазинов зависит от справочников
+            df = self.__filter_stores(df, file)
+        with self.metrics.stage(file, "parse") as stage:
+            # Преобразование числовых столбцов; Организация, Магазин и код товара остаются категориями
+            for column in self.MEASURE_COLUMNS:
                 df[column] = self.__column_to_float(df, column)
+            stage["rows_in"] = stage["rows_out"] = len(df)
         return df
 
-    def __column_to_float(self, df, column_name):
-        """Необходимо для преобразования столбцов в int или float"""
-        # Убираем пробелы и табуляцию между числами
-
-        df[column_name] = df[column_name].str.replace("\xa0", "").str.replace(" ", "")
-
-        # Если число с остатком меняем , на .. Пример: 1,000 в 1.000
-        df[column_name] = df[column_name].str.replace(",", ".")
-        # Преобразуем данные в численные
-        df[column_name] = pd.to_numeric(df[column_name], errors="coerce")
-        # Проверка, чтобы Номер магазины был целочисленным
-        return df[column_name]
-
-    def __full_id_store_merge(self, df):
-        """В ф-ии соединяем три датасета: продукты(Номенклатура), магазины(Названия) и наши данные"""
-        # Соединяем с продуктами
-        merged_df = pd.merge(
-            df,
-            self.product,
-            left_on="Номенклатура.Код",
-            right_on="id_product_code",
-            how="left",
-        )
-
-        # Соединяем с магазинами
+    def __parsed_parts(self, file, old):
+        """Разобранные куски файла: из кэша разбора, если файл уже разбирался этой версией разбора"""
+        path = self.__file_path(file, old)
+        if self.parse_cache is None:
+            for part in self.__raw_parts(path, old):
+                yield self.__parse_part(part, file)
+            return
+        with self.__file_stats_lock:
+            fingerprint = self.__fingerprints.get(file)
+        # Хэш файла уже снят при чтении (FileLedger.fingerprint) - второй раз файл не читаем
+        key = self.parse_cache.key(path, old, sha256=fingerprint[2] if fingerprint else None)
+        self.__remember_cache_key(file, key)
+        parts = self.parse_cache.read(key)
+        if parts is not None:
+            print(f"[кэш разбора] {file}: попадание, текст не разбираем")
+            yield from self.metrics.timed_parts(file, "cache_read", parts)
+            return
+        # Кэш сохраняется, только если файл разобран до конца
+        with self.parse_cache.writer(key, file, old) as add_part:
+            for part in self.__raw_parts(path, old):
+                part = self.__parse_part(part, file)
+                with self.metrics.stage(file, "cache_write"):
+                    add_part(part)
+                yield part
+
+    def __clean_parts(self, file, old):
+        """Разобранные куски файла только с магазинами нужных каналов (с pre_aggregate - свёрнутые)"""
+        for part in self.__parsed_parts(file, old):
+            if self.parse_cache is not None:
+                part = self.__filter_stores(part, file)
+            if self.pre_aggregate:
+                part = self.__pre_aggregate_rows(part, file, "Код" if old else "Номенклатура.Код")
+            yield part
+
+    def __pre_aggregate_rows(self, df, file, code_column):
+        """
+        Сворачиваем строки с одинаковыми исходными ключами до поиска id.
+        Ключи - категории, поэтому группировка идёт по целочисленным кодам. Пропуски в ключах
+        сохраняются (dropna=False): что с ними делать, решают подстановка id и итоговая группировка.
+        """
+        start = time.perf_counter()
+        rows = len(df)
+        with self.metrics.stage(file, "pre_aggregate") as stage:
+            df = df.groupby(
+                [code_column, "Магазин", "Организация"], as_index=False, observed=True, dropna=False, sort=False
+            )[self.MEASURE_COLUMNS].sum()
+            stage["rows_in"], stage["rows_out"] = rows, len(df)
+        self.__add_pre_aggregation_stats(file, rows=rows, grouped=len(df), group_seconds=time.perf_counter() - start)
+        return df
 
-        merged_df = pd.merge(
-            merged_df,
-            self.store,
-            left_on="Магазин",
-            right_on="search_store",
-            how="left",
-        )
-        merged_df = pd.merge(
-            merged_df,
-            self.inn,
-            left_on="Организация",
-            right_on="search_entity",
-            how="left",
-        )
+    def __add_pre_aggregation_stats(self, file, **values):
+        with self.__file_stats_lock:
+            stats = self.__pre_aggregation.setdefault(
+                file, dict.fromkeys(["rows", "grouped", "group_seconds", "resolve_seconds"], 0)
+            )
+            for key, value in values.items():
+                stats[key] += value
 
-        merged_df = pd.merge(
-            merged_df,
-            self.store_channel,
-            left_on="id_store_rename",
-            right_on="id_store",
-            how="left",
+    def __report_pre_aggregation(self, file):
+        with self.__file_stats_lock:
+            stats = self.__pre_aggregation.pop(file, None)
+        if stats is None or not stats["rows"]:
+            return
+        print(
+            f"[агрегация] {file}: строк {stats['rows']} -> {stats['grouped']} "
+            f"(-{1 - stats['grouped'] / stats['rows']:.0%}), группировка {stats['group_seconds']:.2f} с, "
+            f"подстановка id {stats['resolve_seconds']:.2f} с"
         )
-        words = [ 'Франшиза в аренду', 'Франшиза инвестиционная', 'ФРС']
-        merged_df = merged_df[merged_df['channel'].isin(words)]
-        # Заполняем пустые значения. Без этого не сможем преобразовать в целочисленный столбец
-        merged_df["id_product"] = merged_df["id_product"].fillna(0)
-        md = merged_df[merged_df["id_product"] == 0]['Номенклатура.Код']
-        err_nomun = pd.read_csv('Номенклатура_не_в_бд.csv')
 
+    def __remember_cache_key(self, file, key):
+        with self.__file_stats_lock:
+            self.__cache_keys[file] = key
+
+    def __forget_file_state(self, file):
+        """Перед обработкой файла сбрасываем то, что могло остаться от его прошлой неудачной обработки"""
+        with self.__file_stats_lock:
+            for state in (self.__pre_aggregation, self.__cache_keys, self.__unmatched_rows, self.__fingerprints):
+                state.pop(file, None)
+
+    def __save_unmatched(self, file):
+        """
+        Строки товаров не из spr_product - в UnmatchedStore (для repair_unmatched) вместо строк
+        прежней загрузки этой даты, их коды - в кэш разбора файла (для reresolve_unknown)
+        """
+        with self.__file_stats_lock:
+            key = self.__cache_keys.pop(file, None)
+            frames = self.__unmatched_rows.pop(file, [])
+        date = self.__order_date(file)
+        if frames:
+            df = concat_frames(frames)
+            # Строки без кода или без ИНН в ClickHouse не попадут и после пополнения справочника
+            df = df.dropna(subset=["code", "inn"])
+            df = df.groupby(["code", "id_store_rename", "inn"], as_index=False, observed=True)[
+                self.MEASURE_COLUMNS
+            ].sum()
+            df["order_date"] = date
+        else:
+            df = pd.DataFrame(columns=UnmatchedStore.KEY_COLUMNS + self.MEASURE_COLUMNS)
+        if self.unmatched is not None:
+            self.unmatched.save(date, df)
+        if key is not None:
+            self.parse_cache.set_unknown_products(key, set(df["code"].astype(str)))
+
+    def __filter_stores(self, df, file):
+        """Сразу отбрасываем строки магазинов не тех каналов: дальше они всё равно не нужны"""
+        with self.metrics.stage(file, "filter") as stage:
+            self.errors.add("store", file, self.lookup.unknown_stores(df["Магазин"]))
+            stage["rows_in"] = len(df)
+            df = df.take(np.flatnonzero(self.lookup.store_mask(df["Магазин"])))
+            stage["rows_out"] = len(df)
+        return df
 
-        err_nomun = pd.concat([err_nomun, md])
-        err_nomun.to_csv('Номенклатура_не_в_бд.csv')
-        # Этих двух магазинов нет в БД, поэтому вручную заполняю данные
-        merged_df["id_product"] = merged_df["id_product"].astype(int)
-
-        # print(merged_df[merged_df['id_product'] == 0])
+    def __take_chunks_for_file(self, file_path, old=False):
+        """
+        Читаем файл кусками по self.chunk_size строк и отдаём куски без строки Итог.
+
+        Типы столбцов задаются схемой READ_DTYPES, как и при чтении целиком: иначе pandas
+        определял бы типы по каждому куску отдельно, и код номенклатуры мог бы стать числом
+        в одном куске и остаться строкой в другом. Категории у каждого куска свои - это не мешает,
+        куски сворачиваются по id независимо.
+        """
+        reader = pd.read_csv(file_path, chunksize=self.chunk_size, **self.__read_options(old))
+        # Держим один кусок в запасе: в новом формате последняя строка файла - Итог
+        previous = None
+        with reader:
+            for chunk in reader:
+                if previous is not None:
+                    yield previous.dropna(subset=["Номенклатура"], how="all") if old else previous
+                previous = chunk
+        if previous is not None:
+            yield previous.dropna(subset=["Номенклатура"], how="all") if old else previous.iloc[:-1]
 
-        # Убираем лишние столбцы
-        try:
-            merged_df = merged_df.drop(
-                [
-                    "Номер магазина",
-                    "search_store",
-                    "Номенклатура.Код",
-                    "id_product_code",
-                    "Организация",
-                    "search_entity",
-                    "id_store",
-                    'channel'
-                ],
-                axis=1,
-            )
-        except KeyError:
-            merged_df = merged_df.drop(
-                [
-                    "Номер магазина",
-                    "search_store",
-                    "Код",
-                    "Организация",
-                    "id_product_code",
-                    "search_entity",
-                ],
-                axis=1,
+    def __column_to_float(self, df, column_name):
+        """Необходимо для преобразования столбцов в int или float"""
+        # Убираем пробелы между числами, меняем , на . и преобразуем в численные. Пример: 1 000,5 в 1000.5
+        return ru_number_to_float(df[column_name])
+
+    def __full_id_store_merge(self, df, file):
+        """В ф-ии подставляем в наши данные id из справочников: продукты(Номенклатура), магазины(Названия) и ИНН"""
+        return self.__resolve_ids(df, file, "Номенклатура.Код")
+
+    def __full_id_store_merge_old(self, df, file):
+        """В ф-ии подставляем в наши данные id из справочников: продукты(Номенклатура), магазины(Названия) и ИНН"""
+        return self.__resolve_ids(df, file, "Код")
+
+    def __resolve_ids(self, df, file, code_column):
+        start = time.perf_counter()
+        # Ищем id по словарям и сразу оставляем только магазины франшизы
+        mask, ids = self.lookup.resolve(df, code_column)
+        rows = np.flatnonzero(mask)
+        # Собираем результат сразу из отфильтрованных массивов, без промежуточных широких копий.
+        # Названия и коды дальше не нужны - остаются только суммы и id
+        columns = {column: df[column].to_numpy()[mask] for column in self.MEASURE_COLUMNS}
+        merged_df = pd.DataFrame({**columns, **ids}, index=df.index[mask])
+
+        # Товары, которых нет в справочнике
+        missing = np.isnan(ids["id_product"])
+        unknown = df[code_column].take(rows[missing])
+        self.errors.add("product", file, unknown)
+        if self.unmatched is not None or self.parse_cache is not None:
+            unmatched = pd.DataFrame(
+                {
+                    "code": unknown.reset_index(drop=True),
+                    "id_store_rename": ids["id_store_rename"][missing].astype("int32"),
+                    "inn": ids["inn"][missing],
+                    **{column: values[missing] for column, values in columns.items()},
+                }
             )
-
-        return merged_df
-
-    def __full_id_store_merge_old(self, df):
-        """В ф-ии соединяем три датасета: продукты(Номенклатура), магазины(Названия) и наши данные"""
-        # Соединяем с продуктами
-
-        merged_df = pd.merge(
-            df, self.product, left_on="Код", right_on="id_product_code", how="left"
-        )
-
-        # Соединяем с магазинами
-        merged_df = pd.merge(
-            merged_df,
-            self.store,
-            left_on="Магазин",
-            right_on="search_store",
-            how="left",
-        )
-        merged_df = pd.merge(
-            merged_df,
-            self.inn,
-            left_on="Организация",
-            right_on="search_entity",
-            how="left",
-        )
-        merged_df = pd.merge(
-            merged_df,
-            self.store_channel,
-            left_on="id_store_rename",
-            right_on="id_store",
-            how="left",
-        )
-        words = ['Франшиза в аренду', 'Франшиза инвестиционная', 'ФРС']
-        merged_df = merged_df[merged_df['channel'].isin(words)]
-        # Заполняем пустые значения. Без этого не сможем преобразовать в целочисленный столбец
-        merged_df["id_product"] = merged_df["id_product"].fillna(0)
-        md = merged_df[merged_df["id_product"] == 0]['Номенклатура.Код']
-        err_nomun = pd.read_csv('Номенклатура_не_в_бд.csv')
-
-        err_nomun = pd.concat([err_nomun, md])
-        err_nomun.to_csv('Номенклатура_не_в_бд.csv')
-
-        # Убираем лишние столбцы
-        merged_df = merged_df.drop(
-            [
-                "Номенклатура",
-                "Магазин.Номер магазина",
-                "Номер магазина",
-                "search_store",
-                "Номенклатура",
-                "id_product_code",
-                "Код",
-                "Организация",
-                "search_entity",
-            ],
-            axis=1,
-        )
-
+            with self.__file_stats_lock:
+                self.__unmatched_rows.setdefault(file, []).append(unmatched)
+
+        # Заполняем пустые значения (ненайденный товар - 0). id в справочниках помещаются в int32,
+        # магазин у оставшихся строк найден всегда (иначе не определился бы канал)
+        merged_df["id_product"] = merged_df["id_product"].fillna(0).astype("int32")
+        merged_df["id_store_rename"] = merged_df["id_store_rename"].astype("int32")
+        if self.pre_aggregate:
+            self.__add_pre_aggregation_stats(file, resolve_seconds=time.perf_counter() - start)
         return merged_df
 
     def __take_data_for_DB(self, columns_list, table, db):
@@ -367,138 +1091,165 @@ class WorkForData:
             column = column + i + ','
         query = f"""SELECT {column[:-1]} FROM {table}"""
 
-        # Создаём новое подключение в каждом вызове (или в каждом потоке)
-        conn = PostConn(db=db)
-        df = conn.fetch_to_dataframe(query)
-        conn.close()  # Закрываем соединение после использования
-
-        return df
+        # Подключение берётся из пула и возвращается туда после запроса (справочники грузятся из нескольких потоков)
+        with PostConn(db=db, pooled=True) as conn:
+            start = time.perf_counter()
+            df = conn.fetch_to_dataframe(
+                query, chunk_size=self.REFERENCE_FETCH_ROWS, dtypes=self.REFERENCE_DTYPES
+            )
+            self.metrics.observe_db("postgres", "SELECT", time.perf_counter() - start)
+            return df
 
-    def __error_data(self, df_err):
+    def __take_aggregated_chunks(self, file, old=False):
+        """
+        Потоковая обработка файла: каждый кусок очищается, соединяется со справочниками
+        и сразу сворачивается по ключу. В памяти одновременно только кусок и частичные суммы,
+        окончательная группировка остаётся в __data_to_DB.
+        """
+        prepare = self.__prepare_old_file if old else self.__prepare_new_file
+        parts = []
+        for chunk in self.__clean_parts(file, old):
+            chunk = prepare(chunk, file)
+            with self.metrics.stage(file, "aggregate") as stage:
+                parts.append(chunk.groupby(self.GROUP_COLUMNS, as_index=False).sum())
+                stage["rows_in"], stage["rows_out"] = len(chunk), len(parts[-1])
+        return pd.concat(parts, ignore_index=True)
+
+    def __order_date(self, file):
+        """Дата остатков берётся из имени файла"""
         try:
-            # Путь к вашему текстовому файлу
-            file_path = "NON_DB_ERROR.txt"  # Замените на фактический путь
-
-            # Считываем существующие строки из файла в множество
-            existing_lines = set()
-            if os.path.exists(file_path):
-                with open(file_path, "r", encoding="utf-8") as file:
-                    existing_lines = set(list(file.read().splitlines()))
-
-            # Создаем пустое множество для хранения новых уникальных строк
-            new_unique_lines = set()
-
-            line = "; ".join(df_err)
-
-            # Проверяем, уникальна ли строка
-            if line not in existing_lines:
-                new_unique_lines.add(line)
-
-            # Открываем файл в режиме добавления
-            with open(file_path, "a", encoding="utf-8") as file:
-                for line in new_unique_lines:
-                    file.write(line + "\n")
-
-            # Создаем пустое множество для хранения уникальных значений
-            unique_values = set()
-
-            # Чтение данных из текстового файла
-            with open(file_path, "r", encoding="utf-8") as file:
-                for line in file:
-                    # Убираем пробелы и разбиваем строку по запятой
-                    addresses = line.split(";")
-                    # Добавляем адреса в множество для уникальности
-                    unique_values.update(addresses)
-
-            # Запись уникальных значений обратно в текстовый файл
-            with open(file_path, "w", encoding="utf-8") as file:
-                for value in unique_values:
-                    file.write(value + "\n")
-        except TypeError as e:
-            print(f"Вышла ошибочка: {e}")
-
-    def __add_except(self, filename):
-        file_path = "except.csv"  # Замените на фактический путь
-
-        # Считывание данных из CSV-файла
-        try:
-            df = pd.read_csv(file_path)
-        except FileNotFoundError:
-            print(f"Файл '{file_path}' не найден.")
-            df = pd.DataFrame(columns=["Исключения"])
+            return pd.to_datetime(file.rsplit(".", 1)[0], format="%d.%m.%Y")
+        except ValueError:
+            return pd.to_datetime(file.rsplit(".", 1)[0], format="%d.%m.%y")
 
-        # Создание DataFrame для новой строки
-        new_row = pd.DataFrame({"Исключения": [filename]})
+    def __prepare_new_file(self, df, file):
+        with self.metrics.stage(file, "resolve") as stage:
+            stage["rows_in"] = len(df)
+            df = self.__full_id_store_merge(df, file)
+            stage["rows_out"] = len(df)
 
-        # Объединение DataFrames
-        df = pd.concat([df, new_row], ignore_index=True)
+        df["order_date"] = self.__order_date(file)
+        return df
 
-        # Запись обратно в CSV-файл
-        df.to_csv(file_path, index=False)
+    def __prepare_old_file(self, df, file):
+        with self.metrics.stage(file, "resolve") as stage:
+            stage["rows_in"] = len(df)
+            df = self.__full_id_store_merge_old(df, file)
+            stage["rows_out"] = len(df)
 
-        print("Данные успешно обновлены и сохранены.")
+        df["order_date"] = self.__order_date(file)
+
+        for col in [
+            "Начальный остаток себестоимость",
+            "Начальный остаток",
+            "Конечный остаток себестоимость",
+            "Конечный остаток",
+        ]:
+            df[col] = df[col].fillna(0)
+        return df
+
+    def __file_path(self, file, old):
+        return os.path.join(self.path_to_directory_old if old else self.path_to_directory, file)
+
+    def __mark_loaded(self, path, date, fingerprint):
+        # fingerprint снят при чтении: отметка бывает много позже, когда файл уже могли перезаписать
+        if self.replace_mode == "partition":
+            # В журнал файл попадёт только после замены партиций в конце запуска
+            self.__staged.append((path, date, fingerprint))
+        else:
+            self.ledger.mark(path, fingerprint)
+
+    # -------- СТАДИИ ОБРАБОТКИ ФАЙЛА: чтение -> обработка -> загрузка --------
+    def __read_stage(self, file, old):
+        print(f"[+] Обработка {'старого' if old else 'нового'} файла: {file}")
+        self.__forget_file_state(file)
+        fingerprint = FileLedger.fingerprint(self.__file_path(file, old))
+        with self.__file_stats_lock:
+            self.__fingerprints[file] = fingerprint
+        if self.chunk_size:
+            # Кусками: соединение со справочниками идёт сразу при чтении
+            return file, self.__take_aggregated_chunks(file, old=old)
+        # Целиком: без кэша это один кусок, из кэша - столько, сколько было при разборе
+        return file, concat_frames(self.__clean_parts(file, old))
+
+    def __transform_stage(self, item, old):
+        file, df = item
+        if not self.chunk_size:
+            df = self.__prepare_old_file(df, file) if old else self.__prepare_new_file(df, file)
+        self.__report_pre_aggregation(file)
+        with self.metrics.stage(file, "aggregate") as stage:
+            stage["rows_in"] = len(df)
+            df, date = self.__aggregate_for_DB(df)
+            stage["rows_out"] = len(df)
+        return file, df, date
+
+    def __upload_stage(self, item, old):
+        file, df, date = item
+        path = self.__file_path(file, old)
+        with self.__file_stats_lock:
+            fingerprint = self.__fingerprints.pop(file, None)
+            if self.insert_buffer is not None:
+                # Буфер может сброситься уже внутри add
+                self.__buffered_fingerprints[path] = fingerprint
+        with self.metrics.stage(file, "upload") as stage:
+            stage["rows_in"] = len(df)
+            self.__upload_to_DB(df, date, path)
+        if self.unmatched is not None or self.parse_cache is not None:
+            with self.metrics.stage(file, "unmatched"):
+                self.__save_unmatched(file)
+        if self.insert_buffer is None:
+            # С буфером файл отмечается обработанным после сброса буфера
+            with self.metrics.stage(file, "ledger"):
+                self.__mark_loaded(path, date, fingerprint)
+        self.metrics.file_done(file, old=old, rows=len(df), buffered=self.insert_buffer is not None)
+        print(f"[✓] Готово: {file}")
 
     # -------- ОБРАБОТКА ОДНОГО ФАЙЛА (НОВЫЙ ФОРМАТ) --------
     def __process_new_file(self, file):
         try:
-            print(f"[+] Обработка нового файла: {file}")
-            df = self.__take_data_for_file(os.path.join(self.path_to_directory, file))
-            df = self.__full_id_store_merge(df)
-
-            df_err = df[df["id_store_rename"] == 0]["Магазин"].unique()
-            df = df.drop(["Магазин"], axis=1)
-            self.__error_data(df_err)
-
-            try:
-                df["order_date"] = pd.to_datetime(file.rsplit(".", 1)[0], format="%d.%m.%Y")
-            except ValueError:
-                df["order_date"] = pd.to_datetime(file.rsplit(".", 1)[0], format="%d.%m.%y")
-
-
-            self.__data_to_DB(df)
-            self.__add_except(file)
-
-            print(f"[✓] Готово: {file}")
-            return df  # можно вернуть DataFrame, если нужно потом объединить
+            item = self.__transform_stage(self.__read_stage(file, old=False), old=False)
+            self.__upload_stage(item, old=False)
+            return item[1]  # можно вернуть DataFrame, если нужно потом объединить
         except Exception as e:
             print(f"[!] Ошибка в файле {file}: {e}")
+            self.metrics.file_done(file, status="error", old=False, error=str(e))
             raise e
 
     # -------- ОБРАБОТКА ОДНОГО ФАЙЛА (СТАРЫЙ ФОРМАТ) --------
     def __process_old_file(self, file):
         try:
-            print(f"[+] Обработка старого файла: {file}")
-            df = self.__take_data_for_file_old(os.path.join(self.path_to_directory_old, file))
-            df = self.__full_id_store_merge_old(df)
+            item = self.__transform_stage(self.__read_stage(file, old=True), old=True)
+            self.__upload_stage(item, old=True)
+            return item[1]
+        except Exception as e:
+            print(f"[!] Ошибка в файле {file}: {e}")
+            self.metrics.file_done(file, status="error", old=True, error=str(e))
+            return None
 
-            df_err = df[df["id_store_rename"] == 0]["Магазин"].unique()
-            df = df.drop(["Магазин"], axis=1)
-            self.__error_data(df_err)
 
-            df.rename(columns={"По дням": "order_date"}, inplace=True)
+class SerialExecutor(Executor):
+    """Executor без потоков: задача выполняется сразу в вызывающем потоке (executor="serial")"""
 
-            try:
-                df["order_date"] = pd.to_datetime(file.rsplit(".", 1)[0], format="%d.%m.%Y")
-            except ValueError:
-                df["order_date"] = pd.to_datetime(file.rsplit(".", 1)[0], format="%d.%m.%y")
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as error:
+            future.set_exception(error)
+        return future
 
-            for col in [
-                "Начальный остаток себестоимость",
-                "Начальный остаток",
-                "Конечный остаток себестоимость",
-                "Конечный остаток",
-            ]:
-                df[col] = df[col].fillna(0)
 
-            df["id_product"] = pd.to_numeric(df["id_product"], errors="coerce").astype("Int64")
-            df["id_store_rename"] = pd.to_numeric(df["id_store_rename"], errors="coerce").astype("Int64")
+# Экземпляр WorkForData внутри процесса-обработчика (executor="process")
+_worker = None
 
-            self.__data_to_DB(df)
-            self.__add_except(file)
 
-            print(f"[✓] Готово: {file}")
-            return df
-        except Exception as e:
-            print(f"[!] Ошибка в файле {file}: {e}")
-            return None
+def _init_worker(settings, reference):
+    global _worker
+    _worker = WorkForData(reference=reference, **settings)
+
 
+def _process_file_in_worker(file, old):
+    # DataFrame обратно в основной процесс не возвращаем, чтобы не гонять его через pickle,
+    # только то, что загружено в staging (для replace_mode="partition"), неизвестные ключи и счётчики замеров
+    _worker.process_file(file, old=old)
+    return _worker.pop_staged(), _worker.errors.pop_pending(), _worker.metrics.pop_pending()